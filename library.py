@@ -1,6 +1,27 @@
 # Classes and methods for a simple library program
 # Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
 #--------------------------------------------------------------
+import array
+import ast
+import bisect
+import collections
+import heapq
+import itertools
+import json
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+import weakref
+import zlib
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # LoanTable works without it, only more slowly
 
 class Calendar(object):
     """Keeps track of the current date (as an integer)."""
@@ -13,9 +34,10 @@ class Calendar(object):
         """Returns (as a positive integer) the current date."""
         return self.day
 
-    def advance(self):
-        """Advances this calendar to the next date."""
-        self.day += 1
+    def advance(self, days=1):
+        """Advances this calendar to the next date, or by the given
+           number of days."""
+        self.day += days
 
 #--------------------------------------------------------------
 
@@ -26,13 +48,27 @@ class Book(object):
          * An id (a unique integer)
          * A title
          * An author (one string, even if many authors)
-         * A due date (or None if the book is not checked out.)."""
+         * A due date (or None if the book is not checked out.).
+       The id is given to the book when it is added to a library's
+       collection; until then it is None.
+       There are many books, so they are kept small: they have no
+       instance dictionary, and the copies of one title share the
+       title and author strings of their Work."""
+
+    __slots__ = ('id', 'title', 'author', 'due_date', 'work')
 
     def __init__(self, title, author):
         """Creates a book, not checked out to anyone."""
+        self.id = None
         self.title = title
         self.author = author
         self.due_date = None
+        self.work = None    # The Work this is a copy of, once indexed
+
+    def get_id(self):
+        """Returns the id of this book, or None if it is not yet in
+           a library's collection."""
+        return self.id
 
     def get_title(self):
         """Returns the title of this book."""
@@ -49,10 +85,14 @@ class Book(object):
 
     def check_out(self, due_date):
         """Sets the due date for this book."""
+        if self.work and self.due_date is None:
+            self.work.taken(self)
         self.due_date = due_date
 
     def check_in(self):
         """Clears the due date for this book (sets it to None)."""
+        if self.work and self.due_date is not None:
+            self.work.returned(self)
         self.due_date = None
 
     def __str__(self):
@@ -62,309 +102,2548 @@ class Book(object):
 
     def __eq__(self, other):
         """Tests if this book equals the given parameter. Not
-        required by assignment, but fairly important."""
-        return self.title == other.title and self.author == other.author
+        required by assignment, but fairly important. Books are
+        equal only if they are the same copy, which is the same
+        object, since a library makes only one Book for each id."""
+        return self is other
+
+    def __ne__(self, other):
+        """Tests if this book is not equal to the given parameter."""
+        return not self == other
+
+    def __hash__(self):
+        """Returns a hash code consistent with __eq__, which does not
+           change when the book is given its id."""
+        return object.__hash__(self)
 
 #--------------------------------------------------------------
 
 class Patron(object):
     """Represents a patron of the library. A patron has:
          * A name
-         * A set of books checked out"""
+         * A list of books checked out, in the order they were
+           checked out, which are numbered from 1 in that order (so
+           returning a book renumbers those checked out after it)
+       Since a patron may have only a few books, the list is as quick
+       to search as a set or dictionary would be, and smaller."""
+
+    __slots__ = ('name', 'checked_out')
 
     def __init__(self, name):
         """Constructs a new patron, with no books checked out yet."""
         self.name = name
-        self.checked_out = set()
+        self.checked_out = []
 
     def get_name(self):
         """Returns this patron's name."""
         return self.name
 
     def get_books(self):
-        """Returns the set of books checked out to this patron."""
-        return self.checked_out
+        """Returns a (frozen) set of the books checked out to this
+           patron."""
+        return frozenset(self.checked_out)
+
+    def get_loans(self):
+        """Returns a tuple of the books checked out to this patron, in
+           the order they were checked out."""
+        return tuple(self.checked_out)
+
+    def get_loan(self, number):
+        """Returns book number number (counting from 1) of the books
+           checked out to this patron, or None if there is no such
+           book."""
+        if 1 <= number <= len(self.checked_out):
+            return self.checked_out[number - 1]
+        return None
+
+    def count_books(self):
+        """Returns the number of books checked out to this patron."""
+        return len(self.checked_out)
+
+    def has_book(self, book):
+        """Tests if the given book is checked out to this patron."""
+        return book in self.checked_out
 
     def take(self, book):
-        """Adds a book to the set of books checked out to this patron."""
-        self.checked_out.add(book)
+        """Adds a book to the books checked out to this patron."""
+        if book not in self.checked_out:
+            self.checked_out.append(book)
 
     def give_back(self, book):
-        """Removes a book from the set of books checked out to this patron."""
-        self.checked_out.discard(book)
+        """Removes a book from the books checked out to this patron."""
+        if book in self.checked_out:
+            self.checked_out.remove(book)
 
     def __str__(self):
         """Returns the name of this patron."""
         return self.name
 
 #--------------------------------------------------------------
-    
+
+class Response(object):
+    """The answer to a request made of a library or desk: the records
+       (such as books) it is about, and a list of the lines of text
+       that tell the librarian about them, each kept as a format string
+       and the values to put into it. The values must be ones that do
+       not change (strings, numbers, books, whose titles and authors
+       are fixed, and notices, which keep their own due dates), so the
+       text is the same whenever it is made. It is only made when the
+       response is printed, written out, or compared with a string, so
+       a program that wants only the records never pays for it."""
+
+    def __init__(self, format=None, *values):
+        """Creates a response with no records, and with the given line,
+           if any."""
+        self.records = []
+        self.lines = []
+        self.text = None
+        if format is not None:
+            self.add(format, *values)
+
+    def add(self, format, *values):
+        """Adds a line, which will be format % values."""
+        self.lines.append((format, values))
+        self.text = None
+
+    def extend(self, response):
+        """Adds the lines and records of another response."""
+        self.lines.extend(response.lines)
+        self.records.extend(response.records)
+        self.text = None
+
+    def write(self, stream):
+        """Writes the text of this response to the given stream (an
+           open file, or anything else with a write method), one line
+           at a time."""
+        for format, values in self.lines:
+            stream.write(format % values)
+
+    def __str__(self):
+        """Returns the text of this response, making it only once."""
+        if self.text is None:
+            self.text = ''.join([format % values
+                                 for format, values in self.lines])
+        return self.text
+
+    def __repr__(self):
+        """Returns a representation of this response, showing its text."""
+        return "Response(%r)" % str(self)
+
+    def __eq__(self, other):
+        """Tests if this response has the same text as the given
+           string or response."""
+        if isinstance(other, Response):
+            other = str(other)
+        return str(self) == other
+
+    def __ne__(self, other):
+        """Tests if this response does not have the given text."""
+        return not self == other
+
+    def __hash__(self):
+        """Returns a hash code consistent with __eq__."""
+        return hash(str(self))
+
+    def __nonzero__(self):
+        """Tests if this response has any lines, without making its
+           text."""
+        return bool(self.lines)
+
+#--------------------------------------------------------------
+
 class OverdueNotice(object):
     """Represents a message that will be sent to a patron."""
 
-    def __init__(self, set_of_books):
-        """Takes note of all the books checked out to some patron."""
-        self.set_of_books = set_of_books
+    def __init__(self, books, today):
+        """Takes note of all the books checked out to some patron,
+           in the order they were checked out, and of their due dates,
+           as of the given date."""
+        self.books = tuple(books)
+        self.due_dates = [book.get_due_date() for book in self.books]
+        self.today = today
 
     def __str__(self):
-        """From a set of books, returns a multi-line string giving
+        """From a list of books, returns a multi-line string giving
            the dates on which the books were or will be due.
            This should only be called when at least one of the books
            is overdue, but ALL the patron's books are listed, with
            their due dates, and the overdue ones specially marked."""
-        notice = 'Patron has the following books checked out:\n'
-        for book in self.set_of_books:
-            if book.get_due_date() < calendar.get_date():
-                notice += "%s which is overdue (was due on %d)\n" \
-                          % (book, book.get_due_date())
+        return ''.join(self.lines())
+
+    def lines(self):
+        """Generates the lines of this notice, one at a time, each
+           ending with a newline. The books are listed as they were
+           when the notice was made."""
+        yield 'Patron has the following books checked out:\n'
+        for book, due_date in zip(self.books, self.due_dates):
+            if due_date < self.today:
+                yield "%s which is overdue (was due on %d)\n" % (book, due_date)
+            else:
+                yield "%s which is due on %d\n" % (book, due_date)
+
+#--------------------------------------------------------------
+
+class Work(object):
+    """Represents all the copies of a book with the same title and
+       author. The copies that are available (not checked out) are
+       kept on a "shelf", which the copies update themselves as they
+       are checked out and in."""
+
+    __slots__ = ('title', 'author', 'number', 'copies', 'shelf')
+
+    def __init__(self, title, author):
+        """Creates a work with no copies yet."""
+        self.title = title
+        self.author = author
+        self.number = None       # Its number in the SearchIndex
+        self.copies = []
+        self.shelf = set()       # The copies that are available
+
+    def get_title(self):
+        """Returns the title of this work."""
+        return self.title
+
+    def get_author(self):
+        """Returns the author(s) of this work, as a single string."""
+        return self.author
+
+    def add(self, book):
+        """Adds a copy of this work. The copy is made to share this
+           work's title and author strings, so that its own copies
+           of the strings can be freed."""
+        book.work = self
+        book.title = self.title
+        book.author = self.author
+        self.copies.append(book)
+        if book.get_due_date() is None:
+            self.shelf.add(book)
+
+    def count_available(self):
+        """Returns the number of copies that are not checked out."""
+        return len(self.shelf)
+
+    def get_available_copy(self):
+        """Returns some copy that is not checked out, or None if
+           every copy is checked out. This may be called while another
+           thread is changing the shelf."""
+        while True:
+            try:
+                for book in self.shelf:
+                    return book
+                return None
+            except RuntimeError:    # The shelf changed; look again
+                pass
+
+    def taken(self, book):
+        """Notes that the given copy has been checked out."""
+        self.shelf.discard(book)
+
+    def returned(self, book):
+        """Notes that the given copy has been checked in."""
+        self.shelf.add(book)
+
+    def __str__(self):
+        """Returns a string representation of this work,
+        of the form: title, by author"""
+        return "%s, by %s" % (self.title, self.author)
+
+#--------------------------------------------------------------
+
+class SearchIndex(object):
+    """An index of the titles and authors in a collection, so that
+       books containing a given string can be found without looking
+       at every book. Each distinct title and author pair is one
+       Work, holding all the copies with that title and author.
+       Every three-character sequence (trigram) that occurs in a
+       title or author maps to the (increasing) list of numbers of
+       the works that contain it."""
+
+    gram_length = 3
+
+    def __init__(self, first_number=0):
+        """Creates an empty index, whose works will be numbered
+           starting from first_number."""
+        self.first_number = first_number
+        self.works = []          # All Works, in the order first added
+        self.work_numbers = {}   # (title, author) -> work number
+        self.postings = {}       # Trigram -> list of work numbers
+
+    def add(self, book):
+        """Adds one copy of a book to the index."""
+        title, author = book.get_title(), book.get_author()
+        work = self.find_work(title, author)
+        if work is None:
+            work = Work(title, author)
+            work.number = self.count_works()
+            self.work_numbers[(title, author)] = work.number
+            self.works.append(work)
+            grams = self.trigrams(title.lower())
+            grams.update(self.trigrams(author.lower()))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(work.number)
+        work.add(book)
+
+    def count_works(self):
+        """Returns the number of works in the index."""
+        return self.first_number + len(self.works)
+
+    def get_work(self, number):
+        """Returns the work with the given number."""
+        return self.works[number - self.first_number]
+
+    def get_text(self, number):
+        """Returns the (title, author) of the work with the given
+           number."""
+        work = self.get_work(number)
+        return work.get_title(), work.get_author()
+
+    def get_postings(self, gram):
+        """Returns the increasing sequence of the numbers of the works
+           containing the given trigram, or None if there are none."""
+        return self.postings.get(gram)
+
+    def all_postings(self):
+        """Generates (trigram, postings) pairs for every trigram in the
+           index, in order of the trigrams encoded as UTF-8."""
+        for key, gram in sorted((encode_text(gram), gram)
+                                for gram in self.postings):
+            yield key, self.postings[gram]
+
+    def find_work(self, title, author):
+        """Returns the work with exactly the given title and author,
+           or None if there is no such work."""
+        number = self.work_numbers.get((title, author))
+        if number is None:
+            return None
+        return self.get_work(number)
+
+    def find(self, string):
+        """Generates, in the order they were added, the works whose
+           title or author contains the given lowercase string, which
+           must be at least gram_length characters long."""
+        for number in self.find_numbers(string):
+            yield self.get_work(number)
+
+    def find_numbers(self, string):
+        """Generates, in increasing order, the numbers of the works
+           whose title or author contains the given lowercase string."""
+        for number, title, author in self.matches(string):
+            yield number
+
+    def matches(self, string):
+        """Generates, in increasing order of work number, a (number,
+           title, author) triple for each work whose title or author
+           contains the given lowercase string. Only the works that
+           contain every trigram of the string are looked at, starting
+           from the trigram with the fewest works."""
+        lists = []
+        for gram in self.trigrams(string):
+            postings = self.get_postings(gram)
+            if postings is None:
+                return
+            lists.append(postings)
+        lists.sort(key=len)
+        # Since the numbers increase, each list need only be searched
+        # from where the last number was found
+        others = [(work_list, len(work_list)) for work_list in lists[1:]]
+        starts = [0] * len(others)
+        bisect_left = bisect.bisect_left
+        for number in lists[0]:
+            j = 0
+            for work_list, length in others:
+                i = starts[j] = bisect_left(work_list, number, starts[j], length)
+                if i == length or work_list[i] != number:
+                    break
+                j += 1
+            else:
+                title, author = self.get_text(number)
+                if string in title.lower() or string in author.lower():
+                    yield number, title, author
+
+    def ranked(self, string):
+        """Returns a heap (a list ordered as by heapq.heapify) of a
+           (rank, number) pair for each work whose title or author
+           contains the given lowercase string."""
+        heap = [(self.rank(string, title, author), number)
+                for number, title, author in self.matches(string)]
+        heapq.heapify(heap)
+        return heap
+
+    def rank(self, string, title, author):
+        """Returns how well a work with the given title and author
+           matches the given lowercase string, which it contains: 0 if
+           the string is the whole title, 1 if the title begins with
+           it, 2 if the author contains it, and 3 otherwise."""
+        title = title.lower()
+        if title == string:
+            return 0
+        elif title.startswith(string):
+            return 1
+        elif string in author.lower():
+            return 2
+        else:
+            return 3
+
+    def trigrams(self, text):
+        """Returns the set of all trigrams in the given text."""
+        n = self.gram_length
+        return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+#--------------------------------------------------------------
+
+# A word of a title, an author's name, or a search string
+word_pattern = re.compile(r'(\w+)', re.UNICODE)
+
+class WordIndex(object):
+    """The distinct words of the titles and authors of the works in a
+       SearchIndex, for correcting misspelt words. As in the SymSpell
+       method, each word is filed under itself and under each string
+       made by deleting one of its letters, and a misspelt word is
+       looked up under itself and each string made by deleting one or
+       two of its letters. This finds every word within one typing
+       mistake (a letter left out, added or changed, or two letters
+       swapped), and many within two, with a few dozen lookups however
+       many words there are. The words found are ranked by the Jaccard
+       similarity of their sets of bigrams (pairs of letters, with a
+       space added at each end, so " tolkien " gives " t", "to", ...,
+       "n "). To save memory, the strings are filed by their CRC-32,
+       in two parallel arrays sorted by it; the few words added since
+       the arrays were last sorted are kept in a dictionary until
+       there are enough of them to be worth merging in. An index that
+       others may be reading is never changed: updated returns a new
+       one to take its place."""
+
+    gram_length = 2
+    min_length = 3          # Shorter words are never corrected
+    min_similarity = 0.3    # Least similarity of a correction
+
+    def __init__(self):
+        """Creates an index of no words."""
+        self.index = None        # The SearchIndex whose words these are
+        self.works_indexed = 0   # How many of its works have been read
+        self.words = []          # Word number -> word
+        self.numbers = {}        # Word -> word number
+        self.hashes = array.array('I')       # Sorted CRC-32s of strings
+        self.hash_words = array.array('I')   # The word number of each
+        self.recent = {}         # CRC-32 -> list of word numbers
+        self.added = []          # (CRC-32 << 32) | word number, unsorted
+
+    def is_current(self, index):
+        """Tests if this index has the words of all the works of the
+           given SearchIndex."""
+        return index is self.index and self.works_indexed == index.count_works()
+
+    def updated(self, index):
+        """Returns a new WordIndex with the words of the given
+           SearchIndex, made by adding to a copy of this one (which is
+           left unchanged) the words of the works added since it was
+           updated. The sorted arrays, which merge replaces rather than
+           changes, are shared."""
+        other = WordIndex()
+        if index is self.index:
+            other.index = index
+            other.works_indexed = self.works_indexed
+            other.words = list(self.words)
+            other.numbers = dict(self.numbers)
+            other.hashes = self.hashes
+            other.hash_words = self.hash_words
+            other.recent = dict((hash_value, list(numbers)) for hash_value, numbers
+                                in self.recent.iteritems())
+        other.update(index)
+        return other
+
+    def update(self, index):
+        """Adds the words of the works added to the given SearchIndex
+           since the last update, or of all of its works, if it is not
+           the index last updated from."""
+        if index is not self.index:
+            self.index = index
+            self.works_indexed = 0
+            self.words = []
+            self.numbers = {}
+            self.hashes = array.array('I')
+            self.hash_words = array.array('I')
+            self.recent = {}
+            self.added = []
+        for number in xrange(self.works_indexed, index.count_works()):
+            title, author = index.get_text(number)
+            for text in (title, author):
+                for word in word_pattern.findall(text.lower()):
+                    if len(word) >= self.min_length and word not in self.numbers:
+                        self.add(word)
+        self.works_indexed = index.count_works()
+        if (len(self.added) + len(self.recent)) * 4 > len(self.hashes):
+            self.merge()
+        else:
+            for key in self.added:
+                self.recent.setdefault(key >> 32, []).append(key & 0xffffffff)
+            self.added = []
+
+    def add(self, word):
+        """Adds a word that is not yet in the index."""
+        number = len(self.words)
+        self.words.append(word)
+        self.numbers[word] = number
+        self.added.extend((self.hash(string) << 32) | number
+                          for string in self.deletions(word))
+
+    def merge(self):
+        """Merges the recently added words into the sorted arrays."""
+        keys = self.added
+        keys.extend((hash_value << 32) | number for hash_value, number
+                    in itertools.izip(self.hashes, self.hash_words))
+        for hash_value, numbers in self.recent.iteritems():
+            keys.extend((hash_value << 32) | number for number in numbers)
+        keys.sort()
+        self.hashes = array.array('I', (key >> 32 for key in keys))
+        self.hash_words = array.array('I', (key & 0xffffffff for key in keys))
+        self.recent = {}
+        self.added = []
+
+    def hash(self, string):
+        """Returns the CRC-32 by which the given string is filed."""
+        return zlib.crc32(encode_text(string)) & 0xffffffff
+
+    def lookup(self, string):
+        """Returns the numbers of the words filed under the given
+           string (and perhaps a few under others with the same CRC)."""
+        hash_value = self.hash(string)
+        hashes = self.hashes
+        i = bisect.bisect_left(hashes, hash_value)
+        j = bisect.bisect_right(hashes, hash_value, i)
+        return list(self.hash_words[i:j]) + self.recent.get(hash_value, [])
+
+    def deletions(self, word):
+        """Returns the set of the given word and the strings made from
+           it by deleting one letter."""
+        strings = set(word[:i] + word[i + 1:] for i in range(len(word)))
+        strings.add(word)
+        return strings
+
+    def grams(self, word):
+        """Returns the set of bigrams of the given word."""
+        text = ' ' + word + ' '
+        n = self.gram_length
+        return set(text[i:i + n] for i in range(len(text) - n + 1))
+
+    def similar(self, word, count=3):
+        """Returns a list of (similarity, word) pairs for the (at most)
+           count words of the index most like the given lowercase word,
+           best first, leaving out those less similar than
+           min_similarity. A word in the index is only similar to
+           itself."""
+        if word in self.numbers or len(word) < self.min_length:
+            return [(1.0, word)]
+        keys = self.deletions(word)
+        for key in list(keys):
+            if len(key) >= self.min_length:
+                keys.update(self.deletions(key))
+        found = set()
+        for key in keys:
+            found.update(self.lookup(key))
+        grams = self.grams(word)
+        scores = []
+        for number in found:
+            other = self.grams(self.words[number])
+            shared = len(grams & other)
+            scores.append((shared / float(len(grams) + len(other) - shared),
+                           number))
+        return [(similarity, self.words[number])
+                for similarity, number in heapq.nlargest(count, scores)
+                if similarity >= self.min_similarity]
+
+    def corrections(self, string, count=5):
+        """Returns a list of (at most) count (similarity, string) pairs,
+           best first: the given lowercase string itself, then strings
+           made from it by replacing the words that are not in the
+           index by similar words that are. The similarity of a string
+           is the product of the similarities of its words. Besides
+           the best replacement for every word, only strings in which
+           a single word is replaced by its next best are tried, so
+           long strings do not make exponentially many."""
+        parts = word_pattern.split(string)  # Words are at odd positions
+        choices = [self.similar(parts[i], count) or [(1.0, parts[i])]
+                   for i in range(1, len(parts), 2)]
+        best = [choice[0] for choice in choices]
+        candidates = [(similarity_of(best), best)]
+        for i, choice in enumerate(choices):
+            for other in choice[1:]:
+                words = best[:i] + [other] + best[i + 1:]
+                candidates.append((similarity_of(words), words))
+        corrections = [(1.0, string)]
+        seen = set([string])
+        for similarity, words in sorted(candidates, reverse=True):
+            parts[1::2] = [word for word_similarity, word in words]
+            text = ''.join(parts)
+            if text not in seen:
+                seen.add(text)
+                corrections.append((similarity, text))
+        return corrections[:count]
+
+def similarity_of(words):
+    """Returns the product of the similarities of the given (similarity,
+       word) pairs."""
+    result = 1.0
+    for similarity, word in words:
+        result *= similarity
+    return result
+
+#--------------------------------------------------------------
+
+class SearchCursor(object):
+    """The results of a search, ranked by how well each work matches
+       (see SearchIndex.rank), and then in the order the works were
+       added, from which pages are taken one after another. Each work
+       is ranked once, when the search is made; the ranked works are
+       kept in a heap, so that each page takes only the best works
+       left, without the rest ever being sorted."""
+
+    def __init__(self, index, heap, include_checked_out=False):
+        """Creates a cursor over the works of the given SearchIndex in
+           the given heap, as returned by SearchIndex.ranked (which is
+           copied, not changed). Works with no copy available are
+           skipped, unless include_checked_out is true."""
+        self.index = index
+        self.heap = list(heap)
+        self.include_checked_out = include_checked_out
+        self.pages = 0      # Number of pages taken so far
+
+    def next_page(self, size):
+        """Returns a list of one available copy of each of the next
+           (at most) size best works with a copy available (or, for
+           works with none, if they are included, any copy)."""
+        page = []
+        while self.heap and len(page) < size:
+            rank, number = heapq.heappop(self.heap)
+            work = self.index.get_work(number)
+            book = work.get_available_copy()
+            if book is None and self.include_checked_out:
+                book = work.copies[0]
+            if book:
+                page.append(book)
+        self.pages += 1
+        return page
+
+    def has_more(self):
+        """Tests if there are works that have not yet been looked at."""
+        return bool(self.heap)
+
+#--------------------------------------------------------------
+
+class SearchCache(object):
+    """Remembers the ranked works found by the most recently used
+       searches, as returned by SearchIndex.ranked, so that popular
+       searches need not look through the index again. Only which
+       works match is remembered, not which copies are available, so
+       checking books out and in changes nothing here; adding works
+       to the index forgets just the searches that the new works
+       match. Counts hits and misses, to help choose its size."""
+
+    def __init__(self, size=256):
+        """Creates an empty cache of at most size searches."""
+        self.size = size
+        self.entries = collections.OrderedDict() # String -> heap, oldest first
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0  # Changed whenever works are added
+
+    def get(self, string):
+        """Returns the remembered heap for the given lowercase search
+           string, or None if it is not remembered."""
+        with self.lock:
+            heap = self.entries.pop(string, None)
+            if heap is None:
+                self.misses += 1
+            else:
+                self.entries[string] = heap
+                self.hits += 1
+            return heap
+
+    def put(self, string, heap, generation):
+        """Remembers the heap found for the given search string, unless
+           works have been added since the given generation (so that
+           the heap may be out of date). Forgets the least recently
+           used searches if the cache is full."""
+        with self.lock:
+            if generation == self.generation and self.size > 0:
+                self.entries[string] = heap
+                while len(self.entries) > self.size:
+                    self.entries.popitem(last=False)
+
+    def works_added(self, index, first):
+        """Forgets the searches that may match the works that have
+           been added to the given index, from number first on."""
+        count = index.count_works() - first
+        if count <= 0:
+            return
+        with self.lock:
+            self.generation += 1
+            if count > len(self.entries):
+                self.entries.clear()
+                return
+            texts = [(title.lower(), author.lower()) for title, author in
+                     (index.get_text(number)
+                      for number in xrange(first, first + count))]
+            for string in list(self.entries):
+                if any(string in title or string in author
+                       for title, author in texts):
+                    del self.entries[string]
+
+    def clear(self):
+        """Forgets every search."""
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+#--------------------------------------------------------------
+
+class Holds(object):
+    """The holds placed by patrons on works whose copies are all
+       checked out. Each work has a queue of the patrons waiting for
+       it, first come, first served. When a copy of the work is
+       returned, it is set aside ("on the hold shelf") for the first
+       patron waiting, who may pick it up until the hold expires.
+       Placing, cancelling and filling a hold take constant time, and
+       expiring one takes time logarithmic in the number set aside."""
+
+    def __init__(self):
+        """Creates a record of holds with nobody waiting."""
+        self.queues = {}     # Work -> deque of Patrons waiting for it
+        self.waiting = set() # (Work, Patron) pairs still waiting
+        self.ready = {}      # Book set aside -> (Patron, last day to pick up)
+        self.ready_for = {}  # Patron -> list of Books set aside
+        self.expiries = []   # Heap of (last day, book id, Book) set aside
+
+    def place(self, work, patron):
+        """Puts the given patron at the end of the queue for the given
+           work. Returns False, and does nothing, if the patron is
+           already waiting for the work."""
+        if (work, patron) in self.waiting:
+            return False
+        self.waiting.add((work, patron))
+        self.queues.setdefault(work, collections.deque()).append(patron)
+        return True
+
+    def cancel(self, work, patron):
+        """Takes the given patron out of the queue for the given work.
+           (The patron is skipped, rather than removed, so this takes
+           constant time.)"""
+        self.waiting.discard((work, patron))
+
+    def is_waiting(self, work, patron):
+        """Tests if the given patron is waiting for the given work."""
+        return (work, patron) in self.waiting
+
+    def count_waiting(self, work):
+        """Returns the number of patrons waiting for the given work."""
+        return sum(1 for patron in self.queues.get(work, ())
+                   if (work, patron) in self.waiting)
+
+    def is_set_aside(self, book):
+        """Tests if the given book is on the hold shelf."""
+        return book in self.ready
+
+    def get_books_set_aside(self, patron):
+        """Returns a list of the books set aside for the given patron."""
+        return list(self.ready_for.get(patron, ()))
+
+    def fill(self, book, last_day):
+        """Sets the given book, which has just been returned, aside for
+           the first patron waiting for its work, if any, until the
+           given last day. Returns that patron, or None if nobody is
+           waiting (and the book stays on the shelf)."""
+        work = book.work
+        queue = self.queues.get(work)
+        while queue:
+            patron = queue.popleft()
+            if (work, patron) in self.waiting:
+                self.waiting.remove((work, patron))
+                if not queue:
+                    del self.queues[work]
+                self.set_aside(book, patron, last_day)
+                return patron
+        self.queues.pop(work, None)
+        return None
+
+    def set_aside(self, book, patron, last_day):
+        """Puts the given book on the hold shelf for the given patron,
+           until the given last day."""
+        book.work.taken(book)
+        self.ready[book] = (patron, last_day)
+        self.ready_for.setdefault(patron, []).append(book)
+        heapq.heappush(self.expiries, (last_day, book.get_id(), book))
+
+    def pick_up(self, patron, book):
+        """Takes the given book, set aside for the given patron, off
+           the hold shelf, so that it can be checked out."""
+        del self.ready[book]
+        books = self.ready_for[patron]
+        books.remove(book)
+        if not books:
+            del self.ready_for[patron]
+        book.work.returned(book)
+
+    def expire(self, today, last_day):
+        """Takes off the hold shelf every book whose last day to be
+           picked up was before today, and sets each aside for the next
+           patron waiting for its work (until the given last day), or
+           puts it back on the shelf. Returns the number of holds that
+           expired."""
+        count = 0
+        while self.expiries and self.expiries[0][0] < today:
+            day, book_id, book = heapq.heappop(self.expiries)
+            patron, last = self.ready.get(book, (None, None))
+            if last != day:
+                continue    # Already picked up, or set aside again
+            self.pick_up(patron, book)
+            self.fill(book, last_day)
+            count += 1
+        return count
+
+    def waiting_in_order(self):
+        """Generates a (Work, Patron) pair for each patron still
+           waiting, in the order they are queued for each work."""
+        for work, queue in self.queues.items():
+            for patron in queue:
+                if (work, patron) in self.waiting:
+                    yield work, patron
+
+#--------------------------------------------------------------
+
+class LoanTable(object):
+    """Every book checked out, kept in two ways, which this table keeps
+       in step. First, as three parallel columns: the number of the
+       patron who has it, its id, and its due date. Questions about all
+       the loans at once, such as which are overdue and what fines each
+       patron owes, are answered a column at a time. With NumPy, this
+       is done by vectorized operations, fast enough for millions of
+       loans; without it, the columns are arrays from the array module,
+       and are looked at one loan at a time. Second, grouped by the
+       date on which they are due, so that the overdue books can be
+       found without looking at every loan. Since the books due before
+       today are exactly the overdue ones, nothing needs to be done
+       when the calendar advances."""
+
+    def __init__(self, use_numpy=None):
+        """Creates a table with no loans, using NumPy if use_numpy is
+           true, or (if it is None) if NumPy is installed."""
+        if use_numpy is None:
+            use_numpy = numpy is not None
+        self.use_numpy = use_numpy
+        self.count = 0            # Number of loans
+        self.rows = {}            # Book id -> row of its loan
+        self.patron_numbers = {}  # Patron name -> patron number
+        self.patron_names = []    # Patron number -> patron name
+        self.buckets = {}         # Due date -> {Book: Patron}
+        self.dates = []           # The keys of self.buckets, in increasing order
+        if use_numpy:
+            self.patron_column = numpy.zeros(1024, numpy.int32)
+            self.book_column = numpy.zeros(1024, numpy.int64)
+            self.due_column = numpy.zeros(1024, numpy.int64)
+        else:
+            self.patron_column = array.array('i')
+            self.book_column = array.array('l')
+            self.due_column = array.array('l')
+
+    def __len__(self):
+        """Returns the number of loans."""
+        return self.count
+
+    def add(self, patron, book, due_date):
+        """Records that the given patron has the given book, which has
+           an id, due on the given date."""
+        book_id = book.get_id()
+        if book_id in self.rows:
+            self.remove(book)
+        name_of_patron = patron.get_name()
+        number = self.patron_numbers.get(name_of_patron)
+        if number is None:
+            number = self.patron_numbers[name_of_patron] = len(self.patron_names)
+            self.patron_names.append(name_of_patron)
+        row = self.count
+        if self.use_numpy:
+            if row == len(self.due_column):
+                self.patron_column = numpy.resize(self.patron_column, 2 * row)
+                self.book_column = numpy.resize(self.book_column, 2 * row)
+                self.due_column = numpy.resize(self.due_column, 2 * row)
+            self.patron_column[row] = number
+            self.book_column[row] = book_id
+            self.due_column[row] = due_date
+        else:
+            self.patron_column.append(number)
+            self.book_column.append(book_id)
+            self.due_column.append(due_date)
+        self.rows[book_id] = row
+        self.count += 1
+        self.file(book, patron, due_date)
+
+    def remove(self, book):
+        """Forgets the loan of the given book, if it is checked out, by
+           moving the last loan into its row."""
+        row = self.rows.pop(book.get_id(), None)
+        if row is None:
+            return
+        self.unfile(book, int(self.due_column[row]))
+        last = self.count - 1
+        if row != last:
+            for column in self.patron_column, self.book_column, self.due_column:
+                column[row] = column[last]
+            self.rows[int(self.book_column[row])] = row
+        if not self.use_numpy:
+            for column in self.patron_column, self.book_column, self.due_column:
+                column.pop()
+        self.count = last
+
+    def renew(self, book, due_date):
+        """Changes the due date of the given book."""
+        row = self.rows[book.get_id()]
+        patron = self.unfile(book, int(self.due_column[row]))
+        self.due_column[row] = due_date
+        self.file(book, patron, due_date)
+
+    def file(self, book, patron, due_date):
+        """Puts the given book, and the patron who has it, in the group
+           of books due on the given date."""
+        bucket = self.buckets.get(due_date)
+        if bucket is None:
+            bucket = self.buckets[due_date] = {}
+            bisect.insort(self.dates, due_date)
+        bucket[book] = patron
+
+    def unfile(self, book, due_date):
+        """Takes the given book out of the group of books due on the
+           given date, and returns the patron who has it."""
+        bucket = self.buckets[due_date]
+        patron = bucket.pop(book)
+        if not bucket:
+            del self.buckets[due_date]
+            del self.dates[bisect.bisect_left(self.dates, due_date)]
+        return patron
+
+    def count_overdue(self, today):
+        """Returns the number of books that were due before today."""
+        return sum(len(self.buckets[date]) for date in
+                   self.dates[:bisect.bisect_left(self.dates, today)])
+
+    def count_overdue_days(self, first, last):
+        """Returns the total, over the days from first up to (but not
+           including) last, of the number of books overdue on each day,
+           if none are checked out or in meanwhile. Takes time in
+           proportion to the number of due dates, not of days."""
+        total = 0
+        for date in self.dates[:bisect.bisect_left(self.dates, last - 1)]:
+            total += len(self.buckets[date]) * (last - max(first, date + 1))
+        return total
+
+    def overdue_patrons(self, today):
+        """Generates the patrons who have a book that was due before
+           today, ordered by their earliest due date. Each patron is
+           generated only from the group of the first of the patron's
+           books to fall due, so nothing need be remembered about the
+           patrons already generated."""
+        for date in self.dates[:bisect.bisect_left(self.dates, today)]:
+            for book, patron in self.buckets.get(date, {}).items():
+                if min(patron.get_loans(), key=Book.get_due_date) is book:
+                    yield patron
+
+    def days_overdue(self, today):
+        """Returns, for each row, the number of days its book has been
+           overdue (0 if it is not yet overdue)."""
+        if self.use_numpy:
+            return numpy.maximum(today - self.due_column[:self.count], 0)
+        return array.array('l', [max(today - due_date, 0)
+                                 for due_date in self.due_column])
+
+    def overdue(self, today):
+        """Returns a list of a (patron name, book id, days overdue)
+           triple for each book that was due before today."""
+        names = self.patron_names
+        if self.use_numpy:
+            rows = numpy.flatnonzero(self.due_column[:self.count] < today)
+            return zip([names[number] for number in self.patron_column[rows]],
+                       self.book_column[rows].tolist(),
+                       (today - self.due_column[rows]).tolist())
+        return [(names[number], book_id, today - due_date)
+                for number, book_id, due_date in
+                zip(self.patron_column, self.book_column, self.due_column)
+                if due_date < today]
+
+    def patron_totals(self, today, fine_per_day):
+        """Returns a dictionary giving, for each patron with a book that
+           was due before today, a (number of overdue books, fine) pair,
+           where the fine is fine_per_day for each day each book has
+           been overdue."""
+        names = self.patron_names
+        if self.use_numpy:
+            due = self.due_column[:self.count]
+            rows = due < today
+            numbers = self.patron_column[:self.count][rows]
+            counts = numpy.bincount(numbers, minlength=len(names))
+            days = numpy.bincount(numbers, weights=today - due[rows],
+                                  minlength=len(names))
+            return dict((names[number], (int(counts[number]),
+                                         int(days[number]) * fine_per_day))
+                        for number in numpy.flatnonzero(counts))
+        counts = [0] * len(names)
+        days = [0] * len(names)
+        for number, due_date in zip(self.patron_column, self.due_column):
+            if due_date < today:
+                counts[number] += 1
+                days[number] += today - due_date
+        return dict((names[number], (counts[number], days[number] * fine_per_day))
+                    for number in xrange(len(names)) if counts[number])
+
+#--------------------------------------------------------------
+
+class Journal(object):
+    """An append-only log of the changes made to a library, kept in
+       a file with one JSON list per line, so that the changes can be
+       replayed after a restart. Entries are written in groups: all
+       those waiting are saved on disk with a single fsync when a
+       writer calls sync (or commit) to wait for its own, or once
+       group_size of them are waiting. Writers that call sync while an
+       fsync is under way wait for it, and the next saves all their
+       entries at once. A Library syncs the entries of each call that
+       changes it before the call returns, so an entry can be lost only
+       if the process dies before the call that made it has returned.
+       The first line of
+       the file gives the journal's generation, which goes up by one
+       each time the journal is emptied after a checkpoint; the
+       snapshot notes the generation whose changes it holds, so that
+       they are not replayed again if the process dies before the
+       journal is emptied."""
+
+    def __init__(self, path, group_size=64, generation=1):
+        """Opens the journal in the named file, for appending, first
+           cutting off a partly written last line. If there is no such
+           file, or its generation is before the given one, the journal
+           is started again, empty, as the given generation."""
+        self.path = path
+        self.group_size = group_size
+        self.file = None
+        self.pending = []
+        self.recorded = 0        # Entries recorded, ever
+        self.saved = 0           # Entries saved on disk, ever
+        self.saving = False      # Whether some writer is saving
+        self.changed = threading.Condition()
+        self.generation = Journal.generation_of(path)
+        if self.generation is None or self.generation < generation:
+            self.truncate(generation)
+        else:
+            Journal.cut_torn_line(path)
+            self.file = open(path, 'a')
+
+    def record(self, *entry):
+        """Adds an entry (a kind of change, and its details) to the
+           journal, and returns its number, for sync."""
+        line = json.dumps(entry)
+        with self.changed:
+            self.pending.append(line)
+            self.recorded += 1
+            number = self.recorded
+            full = len(self.pending) >= self.group_size
+        if full:
+            self.sync(number)
+        return number
+
+    def sync(self, number):
+        """Returns once the entry with the given number, and all those
+           before it, are saved on disk. If another writer is saving
+           entries, waits for it, then saves all the entries waiting,
+           for every writer, with one fsync."""
+        with self.changed:
+            while self.saved < number:
+                if self.saving:
+                    self.changed.wait()
+                    continue
+                lines, self.pending = self.pending, []
+                end = self.recorded
+                self.saving = True
+                self.changed.release()
+                try:
+                    self.file.write('\n'.join(lines) + '\n')
+                    self.file.flush()
+                    os.fsync(self.file.fileno())
+                finally:
+                    self.changed.acquire()
+                    self.saving = False
+                    self.changed.notify_all()
+                self.saved = end
+
+    def commit(self):
+        """Saves all waiting entries on disk."""
+        self.sync(self.recorded)
+
+    def truncate(self, generation=None):
+        """Discards every entry, once they have all been captured in
+           a snapshot, and starts the next generation (or the given
+           one). The empty journal replaces the old one only once it
+           has been completely written."""
+        if generation is None:
+            generation = self.generation + 1
+        with self.changed:
+            while self.saving:
+                self.changed.wait()
+            self.pending = []
+            self.saved = self.recorded
+        if self.file:
+            self.file.close()
+        temporary_path = self.path + '.new'
+        file = open(temporary_path, 'w')
+        try:
+            file.write(json.dumps(('journal', generation)) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        finally:
+            file.close()
+        os.rename(temporary_path, self.path)
+        self.generation = generation
+        self.file = open(self.path, 'a')
+
+    def close(self):
+        """Saves all waiting entries and closes the file."""
+        self.commit()
+        self.file.close()
+
+    @staticmethod
+    def generation_of(path):
+        """Returns the generation of the journal in the named file, or
+           None if there is no such file, or it is empty."""
+        if not os.path.exists(path):
+            return None
+        file = open(path)
+        try:
+            line = file.readline()
+        finally:
+            file.close()
+        if not line.endswith('\n'):
+            return None
+        kind, generation = json.loads(line)
+        return generation
+
+    @staticmethod
+    def cut_torn_line(path):
+        """Cuts off the partly written last line, if any, of the named
+           file, so that new entries do not run on from it."""
+        file = open(path, 'r+b')
+        try:
+            file.seek(0, os.SEEK_END)
+            size = end = file.tell()
+            while end > 0:
+                start = max(end - 4096, 0)
+                file.seek(start)
+                newline = file.read(end - start).rfind('\n')
+                if newline >= 0:
+                    end = start + newline + 1
+                    break
+                end = start
+            if end < size:
+                file.truncate(end)
+                os.fsync(file.fileno())
+        finally:
+            file.close()
+
+    @staticmethod
+    def entries(path):
+        """Generates the entries in the named journal file, as lists,
+           or nothing if there is no such file. A partly written last
+           line is ignored."""
+        if os.path.exists(path):
+            file = open(path)
+            try:
+                for line in file:
+                    if line.endswith('\n'):
+                        entry = json.loads(line)
+                        if entry[0] != 'journal':
+                            yield entry
+            finally:
+                file.close()
+
+#--------------------------------------------------------------
+
+class EventLog(object):
+    """A bounded, in-memory log of the changes made to a library, for
+       other parts of a program (reports, notices, replicas) to follow
+       as they happen. Each event is a journal entry, such as
+       ('out', name of patron, book id, due date), and is numbered by
+       its offset in the log: the first event has offset 0. The events
+       are kept in a ring of the given size; when it is full, either
+       the oldest event is dropped, and subscribers that had not read
+       it miss it (overflow='drop'), or the change that made the new
+       event waits until every subscriber has read the oldest one
+       (overflow='block'). A library stages its events while its lock
+       is held, and publishes them once the lock is released, so only
+       the change that made them waits. With overflow='block', every
+       cursor must be read to the end or closed, or changes wait for
+       it forever."""
+
+    def __init__(self, size=65536, overflow='drop'):
+        """Creates an empty log of the given size."""
+        if overflow not in ('drop', 'block'):
+            raise ValueError("overflow must be 'drop' or 'block'")
+        self.size = size
+        self.overflow = overflow
+        self.events = [None] * size
+        self.first = 0          # Offset of the oldest event kept
+        self.next = 0           # Offset of the next event
+        self.staged = collections.deque()  # Events not yet published
+        self.changed = threading.Condition()
+        self.cursors = weakref.WeakSet()
+
+    def append(self, event):
+        """Adds an event, after the slowest subscriber has made room
+           for it, if the log is full and blocks."""
+        self.publish(self.stage(event))
+
+    def stage(self, event):
+        """Puts an event at the end of those waiting to be published,
+           without waiting, and returns the offset just after it."""
+        with self.changed:
+            self.staged.append(event)
+            return self.next + len(self.staged)
+
+    def publish(self, end):
+        """Adds the staged events, in order, until the one before the
+           given offset has been added, waiting for the slowest
+           subscriber to make room for each, if the log is full and
+           blocks."""
+        with self.changed:
+            while self.next < end:
+                if self.next - self.first == self.size:
+                    if self.overflow == 'block' and self.cursors and \
+                       min(cursor.offset for cursor in self.cursors) == self.first:
+                        self.changed.wait()
+                        continue    # Another writer may have added some
+                    self.first += 1
+                self.events[self.next % self.size] = self.staged.popleft()
+                self.next += 1
+            self.changed.notify_all()
+
+    def read(self, offset, max_count=100):
+        """Returns a pair: the offset of the first event at or after the
+           given offset that is still kept, and a list of at most
+           max_count events from there on. The list is empty if there
+           are no such events yet, or they are staged but not yet
+           published."""
+        with self.changed:
+            if offset > self.next + len(self.staged):
+                raise ValueError("No event has offset %d yet" % offset)
+            offset = max(offset, self.first)
+            end = min(self.next, offset + max_count)
+            return offset, [self.events[i % self.size] for i in xrange(offset, end)]
+
+    def subscribe(self, offset=None):
+        """Returns an EventCursor that reads the events from the given
+           offset on (which may be that of an event already read, to
+           replay the events since then), or, if no offset is given,
+           only the events added from now on, which leaves out those
+           staged by changes already made but not yet published. If the
+           log blocks, the cursor must be kept reading, or closed."""
+        with self.changed:
+            if offset is None:
+                offset = self.next + len(self.staged)
+            elif offset > self.next + len(self.staged):
+                raise ValueError("No event has offset %d yet" % offset)
+            cursor = EventCursor(self, max(offset, self.first))
+            cursor.missed = cursor.offset - offset
+            self.cursors.add(cursor)
+            return cursor
+
+class EventCursor(object):
+    """A subscriber's place in an EventLog: the offset of the next event
+       it will read, and the number of events it has missed because
+       they were dropped before it read them."""
+
+    def __init__(self, log, offset):
+        """Creates a cursor at the given offset; use log.subscribe."""
+        self.log = log
+        self.offset = offset
+        self.missed = 0
+
+    def read(self, max_count=100, timeout=0):
+        """Returns a list of the next events, at most max_count of them,
+           and moves past them. If there are none yet, waits up to
+           timeout seconds for some (forever, if timeout is None)."""
+        log = self.log
+        with log.changed:
+            if timeout is None:
+                while self.offset >= log.next:
+                    log.changed.wait()
+            elif timeout and self.offset >= log.next:
+                log.changed.wait(timeout)
+            offset, events = log.read(self.offset, max_count)
+            self.missed += offset - self.offset
+            self.offset = offset + len(events)
+            if events and log.overflow == 'block':
+                log.changed.notify_all()
+            return events
+
+    def close(self):
+        """Stops following the log, so that a blocking log no longer
+           waits for this cursor."""
+        with self.log.changed:
+            self.log.cursors.discard(self)
+            self.log.changed.notify_all()
+
+class ChangeLock(object):
+    """The lock held while changing a library. It is reentrant, like an
+       RLock, and when its holder finally releases it, it waits for the
+       holder's journal entries to be saved, then publishes the events
+       the holder staged to the library's EventLog. So a change waits
+       for the disk, or for room in a log that blocks, only after it
+       has released the lock, and does not hold up the rest of the
+       library, while other changes made meanwhile share its fsync."""
+
+    def __init__(self, library):
+        """Creates an unlocked lock for the given Library."""
+        self.library = library
+        self.lock = threading.RLock()
+        self.owner = None        # The ident of the thread holding it
+        self.depth = 0           # The number of times it is held
+        self.publish_to = 0      # Offset after the holder's last event
+        self.save_to = None      # (Journal, number of holder's last entry)
+
+    def acquire(self, blocking=True):
+        """Acquires the lock, waiting for it only if blocking is true.
+           Returns True if it was acquired."""
+        if not self.lock.acquire(blocking):
+            return False
+        self.owner = threading.current_thread().ident
+        self.depth += 1
+        return True
+
+    def release(self):
+        """Releases the lock, then, if it is no longer held, waits for
+           the journal entries recorded while it was to be saved, and
+           publishes the events staged."""
+        self.depth -= 1
+        if self.depth:
+            self.lock.release()
+            return
+        end, self.publish_to, self.owner = self.publish_to, 0, None
+        save_to, self.save_to = self.save_to, None
+        self.lock.release()
+        if save_to:
+            journal, number = save_to
+            journal.sync(number)
+        if end:
+            self.library.events.publish(end)
+
+    def is_held(self):
+        """Tests if the lock is held by the calling thread."""
+        return self.owner == threading.current_thread().ident
+
+    def __enter__(self):
+        """Acquires the lock, for a with statement."""
+        self.acquire()
+
+    def __exit__(self, type, value, traceback):
+        """Releases the lock at the end of a with statement."""
+        self.release()
+
+#--------------------------------------------------------------
+
+# The layout of a snapshot file. After the header come the strings
+# (titles, authors and patron names, in UTF-8), then tables of the
+# works, of the copies of each work, of the work and the id of each
+# copy, of (id, position) pairs in order of id, of the trigrams and
+# their postings, of the patrons, of the loans, of the books set aside
+# for holds, and of the holds still waiting, in the order they were
+# placed. All numbers are little-endian; "_at" fields are offsets in
+# the file. The "journal" field is the generation of the journal whose
+# changes the snapshot holds.
+snapshot_magic = 'LIBSNAP4'
+snapshot_header = struct.Struct('<8s23q')
+snapshot_fields = ('day', 'is_open', 'books', 'next_book_id', 'works', 'grams',
+                   'patrons', 'loans', 'strings_at', 'works_at', 'copies_at',
+                   'book_works_at', 'book_ids_at', 'id_positions_at',
+                   'grams_at', 'postings_at', 'patrons_at', 'loans_at',
+                   'journal', 'set_aside', 'holds', 'set_aside_at',
+                   'holds_at')
+number_record = struct.Struct('<I')   # A work number, book id or position
+id_position_record = struct.Struct('<II') # Book id, position
+work_record = struct.Struct('<QIQIII') # Title at, length, author at,
+                                       # length, first copy, copy count
+gram_record = struct.Struct('<12sQI')  # Trigram, postings at, count
+name_record = struct.Struct('<QI')     # Patron name at, length
+loan_record = struct.Struct('<IIq')    # Patron, book id, due date
+set_aside_record = struct.Struct('<IIq') # Patron, book id, last day
+hold_record = struct.Struct('<II')     # Patron, id of a copy of the work
+
+def encode_text(text):
+    """Returns the given title, author or name as a UTF-8 str."""
+    if isinstance(text, unicode):
+        return text.encode('utf-8')
+    return text
+
+def write_numbers(file, numbers):
+    """Writes an array('I') of numbers to a snapshot file."""
+    if sys.byteorder != 'little':
+        numbers = array.array('I', numbers)
+        numbers.byteswap()
+    numbers.tofile(file)
+
+class MappedArray(object):
+    """A read-only sequence of fixed-size records in a memory-mapped
+       snapshot file, which are unpacked only when they are used,
+       optionally followed by an ordinary list of further items."""
+
+    def __init__(self, data, offset, count, record=number_record, tail=()):
+        """Describes count records at offset in data."""
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.record = record
+        self.tail = tail
+
+    def __len__(self):
+        """Returns the number of items in this sequence."""
+        return self.count + len(self.tail)
+
+    def __getitem__(self, i):
+        """Returns item i of this sequence (a number, or a tuple if
+           the records have many fields)."""
+        if i < 0:
+            i += len(self)
+        if 0 <= i < self.count:
+            values = self.record.unpack_from(self.data,
+                                             self.offset + i * self.record.size)
+            if len(values) == 1:
+                return values[0]
+            return values
+        if self.count <= i < len(self):
+            return self.tail[i - self.count]
+        raise IndexError(i)
+
+    def __iter__(self):
+        """Generates the items of this sequence, in order."""
+        if self.record is number_record:
+            for number in self.numbers(0, self.count):
+                yield number
+        else:
+            for i in xrange(self.count):
+                yield self[i]
+        for item in self.tail:
+            yield item
+
+    def numbers(self, start, stop):
+        """Returns records start to stop (not counting any tail) of a
+           sequence of numbers, as an array('I')."""
+        size = self.record.size
+        numbers = array.array('I')
+        numbers.fromstring(self.data[self.offset + start * size:
+                                     self.offset + stop * size])
+        if sys.byteorder != 'little':
+            numbers.byteswap()
+        return numbers
+
+class MappedSearchIndex(SearchIndex):
+    """A SearchIndex whose works, and their copies, are read from a
+       memory-mapped snapshot file, and created only when they are
+       used. Works added after the snapshot was taken are kept as in
+       an ordinary SearchIndex."""
+
+    def __init__(self, data, header, collection):
+        """Creates an index of the works described in the given
+           snapshot data, whose copies are in the given collection."""
+        SearchIndex.__init__(self, header['works'])
+        self.data = data
+        self.collection = collection
+        self.work_records = MappedArray(data, header['works_at'],
+                                        header['works'], work_record)
+        self.copy_positions = MappedArray(data, header['copies_at'],
+                                          header['books'])
+        self.grams = MappedArray(data, header['grams_at'],
+                                 header['grams'], gram_record)
+        self.loaded = {}   # Work number -> Work, for works in use
+
+    def get_work(self, number):
+        """Returns the work with the given number, creating it and
+           its copies if they have not been used before."""
+        if number >= self.first_number:
+            return SearchIndex.get_work(self, number)
+        work = self.loaded.get(number)
+        if work is None:
+            title, author = self.get_text(number)
+            work = Work(title, author)
+            work.number = number
+            first, count = self.work_records[number][4:]
+            for position in self.copy_positions.numbers(first, first + count):
+                book = Book(title, author)
+                book.id = self.collection.book_ids[position]
+                work.add(book)
+                self.collection.loaded(position, book)
+            self.loaded[number] = work
+        return work
+
+    def get_text(self, number):
+        """Returns the (title, author) of the work with the given
+           number."""
+        if number >= self.first_number:
+            return SearchIndex.get_text(self, number)
+        title_at, title_length, author_at, author_length = \
+                  self.work_records[number][:4]
+        return (self.data[title_at:title_at + title_length],
+                self.data[author_at:author_at + author_length])
+
+    def get_postings(self, gram):
+        """Returns the increasing sequence of the numbers of the works
+           containing the given trigram, or None if there are none."""
+        tail = self.postings.get(gram, [])
+        key = encode_text(gram)
+        low, high = 0, len(self.grams)
+        while low < high:
+            middle = (low + high) // 2
+            if self.grams[middle][0].rstrip('\0') < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.grams):
+            gram_key, offset, count = self.grams[low]
+            if gram_key.rstrip('\0') == key:
+                # Copied out of the map at once, to be searched quickly
+                numbers = MappedArray(self.data, offset, count).numbers(0, count)
+                numbers.extend(tail)
+                return numbers
+        return tail or None
+
+    def all_postings(self):
+        """Generates (trigram, postings) pairs for every trigram in the
+           index, in order of the trigrams encoded as UTF-8."""
+        mapped = {}
+        for gram_key, offset, count in self.grams:
+            mapped[gram_key.rstrip('\0')] = (offset, count)
+        added = dict((encode_text(gram), numbers)
+                     for gram, numbers in self.postings.items())
+        for key in sorted(set(mapped) | set(added)):
+            offset, count = mapped.get(key, (0, 0))
+            yield key, MappedArray(self.data, offset, count,
+                                   tail=added.get(key, []))
+
+    def find_work(self, title, author):
+        """Returns the work with exactly the given title and author,
+           or None if there is no such work."""
+        work = SearchIndex.find_work(self, title, author)
+        if work is None:
+            text = (encode_text(title), encode_text(author))
+            string = max(text[0].lower(), text[1].lower(), key=len)
+            if len(string) >= self.gram_length:
+                numbers = self.find_numbers(string)
+            else:
+                numbers = xrange(self.first_number)
+            for number in numbers:
+                if number < self.first_number and self.get_text(number) == text:
+                    return self.get_work(number)
+        return work
+
+class SnapshotCollection(object):
+    """The list of all books in a library's collection, as read from
+       a memory-mapped snapshot file. A Book is created only when it,
+       or another copy of the same work, is first used. Books added
+       after the snapshot was taken are kept in an ordinary list."""
+
+    def __init__(self, data, header):
+        """Creates the collection described in the given snapshot data.
+           Its index must be set before any books are used."""
+        self.book_works = MappedArray(data, header['book_works_at'],
+                                      header['books'])
+        self.book_ids = MappedArray(data, header['book_ids_at'],
+                                    header['books'])
+        self.id_positions = MappedArray(data, header['id_positions_at'],
+                                        header['books'], id_position_record)
+        self.index = None
+        self.books = {}       # Position -> Book, for books in use
+        self.added = []
+
+    def __len__(self):
+        """Returns the number of books in the collection."""
+        return len(self.book_works) + len(self.added)
+
+    def __getitem__(self, position):
+        """Returns the book at the given position (or a list of books,
+           given a slice)."""
+        if isinstance(position, slice):
+            return [self[i] for i in xrange(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        if position >= len(self.book_works):
+            return self.added[position - len(self.book_works)]
+        if position < 0:
+            raise IndexError(position)
+        book = self.books.get(position)
+        if book is None:
+            self.index.get_work(self.book_works[position])
+            book = self.books[position]
+        return book
+
+    def __iter__(self):
+        """Generates all the books in the collection."""
+        for position in xrange(len(self)):
+            yield self[position]
+
+    def append(self, book):
+        """Adds a book to the end of the collection."""
+        self.added.append(book)
+
+    def extend(self, books):
+        """Adds the given books to the end of the collection."""
+        for book in books:
+            self.append(book)
+
+    def loaded(self, position, book):
+        """Notes that the book at the given position has been created."""
+        self.books[position] = book
+
+    def find_position(self, book_id):
+        """Returns the position of the book from the snapshot with the
+           given id, or None if no book from the snapshot has that id."""
+        low, high = 0, len(self.id_positions)
+        while low < high:
+            middle = (low + high) // 2
+            if self.id_positions[middle][0] < book_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.id_positions):
+            found_id, position = self.id_positions[low]
+            if found_id == book_id:
+                return position
+        return None
+
+    def work_numbers(self):
+        """Returns an array('I') of the number of the work of each
+           book, in order. Books added since the snapshot must have
+           been indexed."""
+        numbers = self.book_works.numbers(0, self.book_works.count)
+        numbers.extend(book.work.number for book in self.added)
+        return numbers
+
+    def ids(self):
+        """Returns an array('I') of the id of each book, in order.
+           Books added since the snapshot must have been indexed."""
+        ids = self.book_ids.numbers(0, self.book_ids.count)
+        ids.extend(book.id for book in self.added)
+        return ids
+
+class SnapshotBooks(object):
+    """The books of a library, by id, when its collection was read
+       from a snapshot: a dictionary from id to Book that creates the
+       books from the snapshot only when they are looked up."""
+
+    def __init__(self, collection):
+        """Creates the dictionary of the books in the given
+           SnapshotCollection."""
+        self.collection = collection
+        self.added = {}       # Book id -> Book, for books added since
+
+    def get(self, book_id, default=None):
+        """Returns the book with the given id, or default if there is
+           no such book."""
+        book = self.added.get(book_id)
+        if book is None:
+            position = self.collection.find_position(book_id)
+            if position is None:
+                return default
+            book = self.collection[position]
+        return book
+
+    def __getitem__(self, book_id):
+        """Returns the book with the given id."""
+        book = self.get(book_id)
+        if book is None:
+            raise KeyError(book_id)
+        return book
+
+    def __setitem__(self, book_id, book):
+        """Adds a book that was not in the snapshot."""
+        self.added[book_id] = book
+
+    def __contains__(self, book_id):
+        """Tests if there is a book with the given id."""
+        return self.get(book_id) is not None
+
+    def __len__(self):
+        """Returns the number of books."""
+        return self.collection.book_ids.count + len(self.added)
+
+#--------------------------------------------------------------
+
+class Metrics(object):
+    """A registry of measurements of a running library: for each
+       method called, the number of calls, the number that raised an
+       exception, and a histogram of the time taken; and gauges and
+       counters, functions measuring the library whenever the metrics
+       are read (a counter only ever goes up).
+       Nothing is measured unless a library is instrumented with
+       Library.instrument, and the library's methods are not wrapped
+       until then, so the metrics cost nothing when they are off."""
+
+    # Upper bounds, in seconds, of the buckets of the histograms
+    buckets = (0.00001, 0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+
+    def __init__(self, prefix='library'):
+        """Creates a registry with nothing measured yet, whose metrics
+           are named starting with the given prefix."""
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.calls = {}      # Method name -> number of calls
+        self.errors = {}     # Method name -> number of exceptions raised
+        self.seconds = {}    # Method name -> total time taken
+        self.histograms = {} # Method name -> count of calls in each bucket
+        self.gauges = {}     # Gauge name -> (help text, function)
+        self.counters = {}   # Counter name -> (help text, function)
+        self.hooks = []      # Functions called with each method's time
+
+    def add_gauge(self, name, help_text, function):
+        """Adds a gauge with the given name and description, whose
+           value is found by calling the given function."""
+        self.gauges[name] = (help_text, function)
+
+    def add_counter(self, name, help_text, function):
+        """Adds a counter with the given name and description, whose
+           value (which must never go down) is found by calling the
+           given function."""
+        self.counters[name] = (help_text, function)
+
+    def add_hook(self, hook):
+        """Adds a function to be called, after each call of an
+           instrumented method, with the method's name and the time it
+           took in seconds."""
+        self.hooks.append(hook)
+
+    def observe(self, name, seconds, failed=False):
+        """Records a call of the named method that took the given
+           number of seconds and, if failed, raised an exception."""
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = [0] * len(self.buckets)
+                self.calls[name] = self.errors[name] = 0
+                self.seconds[name] = 0.0
+            self.calls[name] += 1
+            self.seconds[name] += seconds
+            if failed:
+                self.errors[name] += 1
+            i = bisect.bisect_left(self.buckets, seconds)
+            if i < len(histogram):
+                histogram[i] += 1
+        for hook in self.hooks:
+            hook(name, seconds)
+
+    def wrap(self, target, names):
+        """Replaces the named methods of the given object, for that
+           object only, with ones that are measured."""
+        for name in names:
+            target.__dict__.pop(name, None)
+            target.__dict__[name] = self.timed(name, getattr(target, name))
+
+    def unwrap(self, target, names):
+        """Undoes wrap, so that the named methods are not measured."""
+        for name in names:
+            target.__dict__.pop(name, None)
+
+    def timed(self, name, method):
+        """Returns a function that calls the given method, and records
+           how long it took under the given name."""
+        def timed_method(*args, **keywords):
+            start = time.time()
+            try:
+                result = method(*args, **keywords)
+            except:
+                self.observe(name, time.time() - start, True)
+                raise
+            self.observe(name, time.time() - start)
+            return result
+        timed_method.__name__ = method.__name__
+        timed_method.__doc__ = method.__doc__
+        return timed_method
+
+    def read_gauges(self):
+        """Returns a dictionary of the current value of each gauge."""
+        return dict((name, function())
+                    for name, (help_text, function) in self.gauges.items())
+
+    def read_counters(self):
+        """Returns a dictionary of the current value of each counter."""
+        return dict((name, function())
+                    for name, (help_text, function) in self.counters.items())
+
+    def prometheus(self):
+        """Returns all the metrics in the Prometheus text format."""
+        prefix = self.prefix
+        lines = []
+        with self.lock:
+            names = sorted(self.calls)
+            lines.append("# HELP %s_calls_total Calls of each method.\n" % prefix)
+            lines.append("# TYPE %s_calls_total counter\n" % prefix)
+            for name in names:
+                lines.append('%s_calls_total{method="%s"} %d\n' %
+                             (prefix, name, self.calls[name]))
+            lines.append("# HELP %s_errors_total Calls of each method that "
+                         "raised an exception.\n" % prefix)
+            lines.append("# TYPE %s_errors_total counter\n" % prefix)
+            for name in names:
+                lines.append('%s_errors_total{method="%s"} %d\n' %
+                             (prefix, name, self.errors[name]))
+            lines.append("# HELP %s_call_seconds Time taken by each method.\n"
+                         % prefix)
+            lines.append("# TYPE %s_call_seconds histogram\n" % prefix)
+            for name in names:
+                count = 0
+                for bound, in_bucket in zip(self.buckets, self.histograms[name]):
+                    count += in_bucket
+                    lines.append('%s_call_seconds_bucket{method="%s",le="%r"} %d\n'
+                                 % (prefix, name, bound, count))
+                lines.append('%s_call_seconds_bucket{method="%s",le="+Inf"} %d\n'
+                             % (prefix, name, self.calls[name]))
+                lines.append('%s_call_seconds_sum{method="%s"} %r\n' %
+                             (prefix, name, self.seconds[name]))
+                lines.append('%s_call_seconds_count{method="%s"} %d\n' %
+                             (prefix, name, self.calls[name]))
+        for name, value in sorted(self.read_gauges().items()):
+            lines.append("# HELP %s_%s %s\n" % (prefix, name, self.gauges[name][0]))
+            lines.append("# TYPE %s_%s gauge\n" % (prefix, name))
+            lines.append("%s_%s %r\n" % (prefix, name, value))
+        for name, value in sorted(self.read_counters().items()):
+            lines.append("# HELP %s_%s_total %s\n" % (prefix, name,
+                                                      self.counters[name][0]))
+            lines.append("# TYPE %s_%s_total counter\n" % (prefix, name))
+            lines.append("%s_%s_total %r\n" % (prefix, name, value))
+        return ''.join(lines)
+
+#--------------------------------------------------------------
+
+def check_numbers(numbers):
+    """Raises a TypeError, before anything is changed, unless all the
+       given book numbers are integers."""
+    for number in numbers:
+        if not isinstance(number, (int, long)):
+            raise TypeError("A book number must be an integer, not %r"
+                            % (number,))
+
+class Desk(object):
+    """A circulation desk (or other client) of a library. Each desk
+       serves one patron at a time and keeps its own search results,
+       so many desks can work at once, in different threads; changes
+       to the library's shared state are made while holding the
+       library's lock. The library's own methods for serving patrons
+       use its first desk."""
+
+    min_length = 4    # Shortest string that may be searched for
+    page_size = 10    # Most books listed by each page of a search
+
+    # The methods measured when the library is instrumented
+    instrumented_methods = ('issue_card', 'serve', 'search', 'search_all',
+                            'search_similar', 'next_page', 'check_out',
+                            'check_in', 'renew', 'place_hold', 'pick_up')
+
+    def __init__(self, library):
+        """Creates a desk of the given library, serving nobody."""
+        self.library = library
+        self.patron_being_served = None # Current patron
+        self.found_books = []
+        self.cursor = None     # Results of the last search
+
+    @property
+    def current_patrons_books(self):
+        """The books checked out by the patron being served, in the
+           order they were checked out."""
+        if self.patron_being_served:
+            return self.patron_being_served.get_loans()
+        return ()
+
+    def issue_card(self, name_of_patron):
+        """Allows the named person the use of the library. For
+           convenience, immediately begins serving the new patron."""
+        library = self.library
+        if library.is_open:
+            with library.lock:
+                if name_of_patron not in library.patrons:
+                    library.patrons[name_of_patron] = Patron(name_of_patron)
+                    library.record('card', name_of_patron)
+                    response = Response("Library card issued to %s.\n",
+                                        name_of_patron)
+                else:
+                    response = Response("%s already has a library card.\n",
+                                        name_of_patron)
+            response.extend(self.serve(name_of_patron))
+            return response
+        else:
+            return Response("The library is not open.")
+
+    def serve(self, name_of_patron):
+        """Saves the given patron in an instance variable. Subsequent
+           check_in and check_out operations will refer to this patron,
+           so that the patron's name need not be entered many times."""
+        library = self.library
+        response = Response()
+        if library.is_open:
+            if name_of_patron in library.patrons:
+                self.patron_being_served = library.patrons[name_of_patron]
+                response.add("Now serving %s.\n", name_of_patron)
+                books = self.patron_being_served.get_loans()
+                response.records.extend(books)
+                if books:
+                    response.add("%s has the following books checked out:\n", name_of_patron)
+                    i = 1
+                    for book in books:
+                        response.add("%d. %s\n", i, book)
+                        i += 1
+                else:
+                    response.add("%s has no books checked out.", name_of_patron)
+                waiting = len(library.holds.get_books_set_aside(self.patron_being_served))
+                if waiting:
+                    if books:
+                        response.add("%d books are waiting to be picked up.", waiting)
+                    else:
+                        response.add("\n%d books are waiting to be picked up.", waiting)
+            else:
+                response.add("%s does not have a library card.", name_of_patron)
+        else:
+            response.add("The library is not open.")
+        return response
+
+    def check_in(self, *book_numbers):
+        """Accepts books being returned by the patron being served,
+           and puts them back "on the shelf". The books are numbered as
+           serve last listed them; afterwards the books left are
+           numbered again from 1, in the order they were checked out."""
+        check_numbers(book_numbers)
+        library = self.library
+        response = Response()
+        if library.is_open:
+            if self.patron_being_served:
+                count = 0
+                with library.lock:
+                    # Find all the books before returning any, since
+                    # returning a book renumbers those after it
+                    books = [self.patron_being_served.get_loan(book_number)
+                             for book_number in book_numbers]
+                    for book_number, book in zip(book_numbers, books):
+                        if book and self.patron_being_served.has_book(book):
+                            library.return_book(self.patron_being_served, book)
+                            response.records.append(book)
+                            count += 1
+                        else:
+                            response.add("The patron does not have book %d.\n", book_number)
+                if count:
+                    response.add("%s has returned %d books.",
+                                 self.patron_being_served.get_name(), count)
+            else:
+                response.add("No patron is currently being served.")
+        else:
+            response.add("The library is not open.")
+        return response
+
+    def search(self, string, include_checked_out=False, similar=False):
+        """Looks for books with the given string in either the
+           title or the author's name, and creates a numbered list
+           in self.found_books of the first page of results: books
+           whose title is the string, then those whose title begins
+           with it, then those whose author contains it, then the
+           rest. Only one available copy of each title is listed,
+           and titles with no copy available are left out unless
+           include_checked_out is true. If similar is true, books
+           are also found whose title or author contains the string
+           with its misspelt words corrected (see search_similar)."""
+        library = self.library
+        if library.is_open:
+            self.found_books = []
+            self.cursor = None
+            if len(string) >= self.min_length:
+                string = string.lower()
+                library.update_index()
+                if similar:
+                    heap = library.find_similar(string)
+                else:
+                    heap = library.find_ranked(string)
+                self.cursor = SearchCursor(library.search_index, heap,
+                                           include_checked_out)
+                return self.list_page("No books found.")
+            else:
+                return Response("Search string must contain at least four characters.")
+        else:
+            return Response("The library is not open.")
+
+    def search_all(self, string):
+        """Like search, but also lists the titles whose copies are all
+           checked out, so that holds can be placed on them."""
+        return self.search(string, True)
+
+    def search_similar(self, string):
+        """Like search, but allows for misspelt words: after the books
+           that contain the string come those that contain it with
+           each word not in any title or author replaced by one of the
+           most similar words that is, most similar first."""
+        return self.search(string, similar=True)
+
+    def next_page(self):
+        """Replaces self.found_books with a numbered list of the next
+           page of results of the last search."""
+        if self.library.is_open:
+            if self.cursor and self.cursor.has_more():
+                return self.list_page("No more books found.")
+            else:
+                return Response("No more books found.")
+        else:
+            return Response("The library is not open.")
+
+    def list_page(self, none_found):
+        """Takes the next page of results from self.cursor, saves it
+           in self.found_books, and returns it as a numbered list (or
+           the given message if there are none)."""
+        self.found_books = self.cursor.next_page(self.page_size)
+        if not self.found_books:
+            return Response(none_found)
+        library = self.library
+        response = Response()
+        response.records.extend(self.found_books)
+        i = 1
+        for book in self.found_books:
+            if library.is_available(book):
+                format = "%d. %s"
+            else:
+                format = "%d. %s (all copies checked out)"
+            if i > 1:
+                format = "\n" + format
+            response.add(format, i, book)
+            i += 1
+        if self.cursor.has_more():
+            response.add("\nUse next_page() to see more.")
+        return response
+
+    def check_out(self, *book_numbers):
+        """Checks books out to the patron currently being served.
+           Books will be due seven days from "today".
+           Patron must have a library card, and may have not more
+           than three books checked out at a time. If another desk
+           has checked out a copy that was found, another copy of
+           the same book is checked out instead, if there is one."""
+        check_numbers(book_numbers)
+        library = self.library
+        response = Response()
+        if library.is_open:
+            if self.patron_being_served:
+                count = 0
+                with library.lock:
+                    for book_number in book_numbers:
+                        if 1 <= book_number <= len(self.found_books):
+                            book = self.found_books[book_number - 1]
+                            if not library.is_available(book) and book.work:
+                                book = book.work.get_available_copy()
+                            if book is None or not library.is_available(book):
+                                response.add("Book %d is no longer available.\n", book_number)
+                            elif self.patron_being_served.count_books() < library.limit:
+                                library.lend_book(self.patron_being_served, book,
+                                                  library.get_date() + library.checkout_period)
+                                response.records.append(book)
+                                count += 1
+                            else:
+                                response.add("%s already has the maximum # of books checked out.\n", self.patron_being_served.get_name())
+                                break
+                        else:
+                            response.add("The library does not have book %d.\n", book_number)
+                if count:
+                    response.add("%s has checked out %d books.",
+                                 self.patron_being_served.get_name(), count)
+            else:
+                response.add("No patron is currently being served.")
+        else:
+            response.add("The library is not open.")
+        return response
+
+    def renew(self, *book_ids):
+        """Renews books for the patron currently being served.
+        Books renewed will be due 7 days from "today"."""
+        check_numbers(book_ids)
+        library = self.library
+        response = Response()
+        if library.is_open:
+            if self.patron_being_served:
+                count = 0
+                with library.lock:
+                    for book_id in book_ids:
+                        book = self.patron_being_served.get_loan(book_id)
+                        if book:
+                            library.renew_book(self.patron_being_served, book,
+                                               library.get_date() + library.checkout_period)
+                            response.records.append(book)
+                            count += 1
+                        else:
+                            response.add("The patron does not have book %d.", book_id)
+                if count:
+                    response.add("%d books have been renewed for %s.",
+                                 count, self.patron_being_served.get_name())
+            else:
+                response.add("No patron is currently being served.")
+        else:
+            response.add("The library is not open.")
+        return response
+
+    def place_hold(self, *book_numbers):
+        """Places holds, for the patron being served, on books found
+           by the last search whose copies are all checked out. When a
+           copy is returned, it is set aside for the patron."""
+        check_numbers(book_numbers)
+        library = self.library
+        response = Response()
+        if library.is_open:
+            patron = self.patron_being_served
+            if patron:
+                count = 0
+                with library.lock:
+                    for book_number in book_numbers:
+                        if not 1 <= book_number <= len(self.found_books):
+                            response.add("The library does not have book %d.\n", book_number)
+                            continue
+                        book = self.found_books[book_number - 1]
+                        if book.work.count_available():
+                            response.add("Book %d is available, and need not be held.\n", book_number)
+                        elif library.hold_book(patron, book):
+                            count += 1
+                        else:
+                            response.add("%s is already waiting for book %d.\n",
+                                         patron.get_name(), book_number)
+                if count:
+                    response.add("%s has placed %d holds.", patron.get_name(), count)
+            else:
+                response.add("No patron is currently being served.")
+        else:
+            response.add("The library is not open.")
+        return response
+
+    def pick_up(self):
+        """Checks out, to the patron being served, the books that have
+           been set aside for the patron."""
+        library = self.library
+        response = Response()
+        if library.is_open:
+            patron = self.patron_being_served
+            if patron:
+                with library.lock:
+                    books = library.pick_up_books(patron)
+                    left = library.holds.get_books_set_aside(patron)
+                response.records.extend(books)
+                if left:
+                    response.add("%s already has the maximum # of books checked out.\n", patron.get_name())
+                if books:
+                    response.add("%s has checked out %d books.", patron.get_name(), len(books))
+                elif not left:
+                    response.add("No books are waiting for %s.", patron.get_name())
             else:
-                notice += "%s which is due on %d\n" % (book, book.get_due_date())
-        return notice
+                response.add("No patron is currently being served.")
+        else:
+            response.add("The library is not open.")
+        return response
+
+    def stop_serving(self):
+        """Stops serving the current patron, if any."""
+        self.patron_being_served = None
 
 #--------------------------------------------------------------
 
+# A ("title", "author") line of a collection file, without escapes
+simple_tuple = re.compile(r"""\(\s*(?:"([^"]*)"|'([^']*)')\s*,"""
+                          r"""\s*(?:"([^"]*)"|'([^']*)')\s*,?\s*\)$""")
+
+# The status of each operation done by Library.batch
+status_done = 0           # The operation was done
+status_closed = 1         # The library is not open
+status_no_card = 2        # The patron does not have a library card
+status_no_such_book = 3   # There is no book with that number
+status_not_available = 4  # The book is already checked out
+status_at_limit = 5       # The patron has the maximum # of books
+status_not_borrowed = 6   # The patron does not have the book
+status_no_such_action = 7 # The action is not one that batch does
+
 class Library(object):
     """Provides operations available to the librarian."""
+
+    limit = 3              # Most books a patron may have checked out
+    checkout_period = 7    # Days until a book checked out is due
+    search_cache_size = 256 # Most searches whose results are remembered
+    fine_per_day = 25      # Cents owed for each day a book is overdue
+    hold_period = 3        # Days a book is kept for a patron who held it
+    event_log_size = 65536 # Most changes kept for subscribers to read
+    similar_searches = 5   # Most corrected strings tried by search_similar
+
+    # The methods that may be used as commands by the librarian
+    commands = ('help', 'open', 'list_overdue_books', 'issue_card', 'serve',
+                'search', 'search_all', 'search_similar', 'next_page',
+                'check_out', 'check_in', 'renew', 'place_hold', 'pick_up',
+                'close', 'checkpoint', 'quit')
+
+    # The methods measured when the library is instrumented
+    instrumented_methods = ('open', 'list_overdue_books',
+                            'write_overdue_notices', 'issue_card', 'serve',
+                            'search', 'search_all', 'search_similar',
+                            'next_page', 'check_out', 'check_in', 'renew',
+                            'place_hold', 'pick_up', 'batch', 'close',
+                            'checkpoint', 'restore', 'read_in_collection')
     
     def __init__(self):
         """Constructs a library, which involves reading in a
            list of books that are in this library's collection."""
         
-        # Create a global calendar, to be used by many classes
-        global calendar
-        calendar = Calendar()
-        
         # Initialize some instance variables for _this_ library
+        self.calendar = Calendar()      # Today's date, for this library
+        self.lock = ChangeLock(self)    # Held while changing anything
+        self.desks = weakref.WeakSet()  # All desks, for closing time
+        self.metrics = None             # Metrics, if instrumented
+        self.desk = self.open_desk()    # Desk used by this library's methods
         self.is_open = False            # Is library open?
         self.collection = []            # List of all Books
         self.patrons = {}            # Set of all Patrons
-        self.patron_being_served = None # Current patron
-        self.current_patrons_books = [] # books checked out by current patron
-        self.found_books = set()
+        self.search_index = SearchIndex() # Index of self.collection
+        self.search_cache = SearchCache(self.search_cache_size)
+        self.word_index = WordIndex()   # Words of self.search_index
+        self.indexed_collection = self.collection # What was indexed
+        self.number_indexed = 0         # How many books were indexed
+        self.loans = LoanTable()        # Checked-out books
+        self.holds = Holds()            # Patrons waiting for books
+        self.journal = None             # Journal of changes, if kept
+        self.generation = 0             # Of the journal in the snapshot loaded
+        self.events = None              # EventLog of changes, if kept
+        self.books = {}                 # Book id -> Book
+        self.next_book_id = 0           # Id of the next book added
+
+    # The patron being served, that patron's books, and the books
+    # found by the last search, all at this library's own desk
+    patron_being_served = property(
+        lambda self: self.desk.patron_being_served,
+        lambda self, patron: setattr(self.desk, 'patron_being_served', patron))
+    current_patrons_books = property(
+        lambda self: self.desk.current_patrons_books)
+    found_books = property(
+        lambda self: self.desk.found_books,
+        lambda self, books: setattr(self.desk, 'found_books', books))
 
     def get_date(self):
-        """Returns the current value of the global calendar -
+        """Returns the current value of this library's calendar -
         useful for unittests."""
-        return calendar.get_date()
+        return self.calendar.get_date()
+
+    def open_desk(self):
+        """Returns a new Desk, at which patrons can be served at the
+           same time as at this library's other desks."""
+        desk = Desk(self)
+        with self.lock:
+            self.desks.add(desk)
+            if self.metrics:
+                self.metrics.wrap(desk, Desk.instrumented_methods)
+        return desk
+
+    def instrument(self, metrics=None):
+        """Starts measuring this library: the number of calls and time
+           taken of each of its instrumented_methods (and those of its
+           other desks), and gauges of the number of books, patrons,
+           books checked out and overdue books, and counters of the
+           search cache's hits and misses. Returns the Metrics
+           (a new registry, if none is given)."""
+        if metrics is None:
+            metrics = Metrics()
+        with self.lock:
+            self.uninstrument()
+            self.metrics = metrics
+            metrics.add_gauge('books', "Copies of books in the collection.",
+                              lambda: len(self.collection))
+            metrics.add_gauge('patrons', "Patrons with a library card.",
+                              lambda: len(self.patrons))
+            metrics.add_gauge('loans', "Books checked out.",
+                              lambda: len(self.loans))
+            metrics.add_gauge('overdue', "Books checked out and overdue.",
+                              lambda: self.loans.count_overdue(self.get_date()))
+            metrics.add_counter('search_cache_hits',
+                                "Searches found in the search cache.",
+                                lambda: self.search_cache.hits)
+            metrics.add_counter('search_cache_misses',
+                                "Searches not found in the search cache.",
+                                lambda: self.search_cache.misses)
+            metrics.wrap(self, Library.instrumented_methods)
+            for desk in self.desks:
+                if desk is not self.desk:
+                    metrics.wrap(desk, Desk.instrumented_methods)
+        return metrics
+
+    def uninstrument(self):
+        """Stops measuring this library."""
+        with self.lock:
+            if self.metrics:
+                self.metrics.unwrap(self, Library.instrumented_methods)
+                for desk in self.desks:
+                    self.metrics.unwrap(desk, Desk.instrumented_methods)
+                self.metrics = None
         
-    def read_in_collection(self):
-        # Read in the book collection
-        file = open('collection.txt')
-        for line in file:
-            if len(line) > 1:
-                tuple = eval(line.strip())
-                self.collection.append(Book(tuple[0], tuple[1]))
-        file.close()
+    def read_in_collection(self, source='collection.txt', batch_size=10000):
+        """Reads in the book collection from source, which may be the
+           name of a file or an open file. Each nonblank line describes
+           one copy of a book, as a ("title", "author") tuple, as a JSON
+           list or {"title": ..., "author": ...} object, or as a title
+           and author separated by a tab. The file is read a line at a
+           time and the books are added in batches of batch_size.
+           Returns a message telling how fast the books were read."""
+        start = time.time()
+        if isinstance(source, basestring):
+            file = open(source)
+        else:
+            file = source
+        count = 0
+        batch = []
+        try:
+            for line_number, line in enumerate(file, 1):
+                line = line.strip()
+                if line:
+                    title, author = self.parse_collection_line(line, line_number)
+                    batch.append(Book(title, author))
+                    if len(batch) >= batch_size:
+                        count += self.add_to_collection(batch)
+                        batch = []
+            count += self.add_to_collection(batch)
+        finally:
+            if file is not source:
+                file.close()
+        seconds = max(time.time() - start, 1e-6)
+        return "Read %d books in %.2f seconds (%d books per second)." % \
+               (count, seconds, count / seconds)
 
     def set_collection(self, *list_of_books):
-        for line in list_of_books:
-            self.collection.append(Book(line[0], line[1]))        
+        self.add_to_collection([Book(line[0], line[1])
+                                for line in list_of_books])
     
-    def open(self):
-        """Opens this library for business at the start of a new day."""
-        if self.is_open:
-            return "The library is already open!"
-        else:
-            self.is_open = True
-            calendar.advance()
-            return "Today is day %d." % calendar.get_date()
+    def open(self, days=1):
+        """Opens this library for business at the start of a new day:
+           the next day, or the given number of days after it was last
+           open, if it stayed closed in between. Holds that expired in
+           the days skipped are dealt with all at once. Raises a
+           TypeError if days is not an integer, and a ValueError if it
+           is less than 1."""
+        if not isinstance(days, (int, long)):
+            raise TypeError("days must be an integer, not %r" % (days,))
+        if days < 1:
+            raise ValueError("The library cannot open %d days on" % days)
+        with self.lock:
+            if self.is_open:
+                return "The library is already open!"
+            else:
+                self.is_open = True
+                self.calendar.advance(days)
+                self.record('open', self.get_date())
+                self.holds.expire(self.get_date(),
+                                  self.get_date() + self.hold_period)
+                return "Today is day %d." % self.get_date()
 
     def list_overdue_books(self):
         """Checks records and prints overdue notices to all
            delinquent patrons who have an overdue book."""
-        message = ''
         if self.is_open:
-            for patron in self.patrons:
-                for book in self.patrons[patron].get_books():
-                    if book.get_due_date() < calendar.get_date():
-                        message += self.patrons[patron].get_name() + '\n' + \
-                                  OverdueNotice(self.patrons[patron].get_books()).__str__()
-                        break
-            if not message:
-                message = "No books are overdue."
+            response = Response()
+            for patron, notice in self.overdue_notices():
+                response.records.append((patron, notice))
+                response.add("%s\n%s", patron.get_name(), notice)
+            if not response.records:
+                response.add("No books are overdue.")
+            return response
         else:
-            message += "The library is not open."
-        return message
+            return Response("The library is not open.")
+
+    def overdue_notices(self):
+        """Generates a (patron, OverdueNotice) pair for each delinquent
+           patron, one at a time, so that the notices can be sent as
+           they are produced. Generates nothing if the library is not
+           open."""
+        if self.is_open:
+            today = self.get_date()
+            for patron in self.loans.overdue_patrons(today):
+                yield patron, OverdueNotice(patron.get_loans(), today)
+
+    def write_overdue_notices(self, sink):
+        """Writes the overdue notice for each delinquent patron to the
+           given sink (an open file, or anything else with a write
+           method), one line at a time, and returns the number of
+           notices written."""
+        count = 0
+        for patron, notice in self.overdue_notices():
+            sink.write(patron.get_name() + '\n')
+            for line in notice.lines():
+                sink.write(line)
+            count += 1
+        return count
                 
+    def fines(self):
+        """Returns a dictionary giving, for each delinquent patron, the
+           number of books the patron has overdue and the fine owed for
+           them, in cents, as of today."""
+        with self.lock:
+            return self.loans.patron_totals(self.get_date(),
+                                            self.fine_per_day)
+
     def issue_card(self, name_of_patron):
         """Allows the named person the use of this library. For
            convenience, immediately begins serving the new patron."""
-        if self.is_open:
-            if name_of_patron not in self.patrons:
-                self.patrons[name_of_patron] = Patron(name_of_patron)
-                message = "Library card issued to %s.\n" % name_of_patron
-            else:
-                message = "%s already has a library card.\n" % name_of_patron
-            return message + self.serve(name_of_patron)
-        else:
-            return "The library is not open."
+        return self.desk.issue_card(name_of_patron)
 
     def serve(self, name_of_patron):
         """Saves the given patron in an instance variable. Subsequent
            check_in and check_out operations will refer to this patron,
            so that the patron's name need not be entered many times."""
-        message = ''
-        if self.is_open:
-            if name_of_patron in self.patrons:
-                self.patron_being_served = self.patrons[name_of_patron]
-                self.current_patrons_books = []
-                message += "Now serving %s.\n" % name_of_patron
-                if self.patron_being_served.get_books():
-                    message += "%s has the following books checked out:\n" % name_of_patron
-                    i = 1
-                    for book in self.patron_being_served.get_books():
-                        message += "%d. %s\n" % (i, book)
-                        self.current_patrons_books.append(book)
-                        i += 1
-                else:
-                    message += "%s has no books checked out." % name_of_patron
-            else:
-                message += "%s does not have a library card." % name_of_patron
-        else:
-            message += "The library is not open."
-        return message
-		
+        return self.desk.serve(name_of_patron)
+
     def check_in(self, *book_numbers):
         """Accepts books being returned by the patron being served,
            and puts them back "on the shelf"."""
-        message = ''
-        if self.is_open:
-            if self.patron_being_served:
-                count = 0
-                for book_number in book_numbers:
-                    if book_number <= len(self.current_patrons_books):
-                        book = self.current_patrons_books[book_number - 1]
-                        self.patron_being_served.give_back(book)
-                        book.check_in()
-                        count += 1
-                    else:
-                        message += "The patron does not have book %d.\n" % book_number
-                if count:
-                    self.current_patrons_books = list(self.patron_being_served.get_books())
-                    message += "%s has returned %d books." % \
-                         (self.patron_being_served.get_name(), count)
-            else:
-                message += "No patron is currently being served."
-        else:
-            message += "The library is not open."
-        return message
+        return self.desk.check_in(*book_numbers)
 
     def search(self, string):
         """Looks for books with the given string in either the
            title or the author's name, and creates a globally
-           available numbered list in self.found_books."""
-        if self.is_open:
-            min_length = 4
-            search_limit = 10
-            self.found_books = []
-            found_titles = set()
-            if len(string) >= min_length:
-                string = string.lower()
-                for book in self.collection:
-                    if (string in book.get_title().lower() or \
-                        string in book.get_author().lower()) \
-                       and not book.get_due_date() \
-                       and not book.__str__() in found_titles:
-                        self.found_books.append(book)
-                        found_titles.add(book.__str__() + '\n')
-                        if len(self.found_books) > search_limit:
-                            break
-                if found_titles:
-                    return self.create_numbered_list(self.found_books)
-                else:
-                    return "No books found."
-            else:
-                return "Search string must contain at least four characters."
-        else:
-            return "The library is not open."
+           available numbered list in self.found_books. Only one
+           available copy of each title is listed."""
+        return self.desk.search(string)
+
+    def search_all(self, string):
+        """Like search, but also lists the titles whose copies are all
+           checked out, so that holds can be placed on them."""
+        return self.desk.search_all(string)
+
+    def search_similar(self, string):
+        """Like search, but also finds books whose title or author
+           contains the string with its misspelt words corrected."""
+        return self.desk.search_similar(string)
+
+    def next_page(self):
+        """Lists the next page of results of the last search, which
+           replace those in self.found_books."""
+        return self.desk.next_page()
 
     def create_numbered_list(self, items):
-        """Creates and returns a numbered list of the given items,
-           as a multiline string. Returns "Nothing found." if the
-           list of items is empty."""
+        """Creates and returns a numbered list of the given items, as
+           a Response whose records are the items and whose text has
+           one line per item. Says "Nothing found." if the list of
+           items is empty."""
         if self.is_open:
+            response = Response()
             i = 1
-            numbered_list = ''
             for item in items:
-                numbered_list += "%d. %s\n" % (i, item)
+                response.records.append(item)
+                response.add("%d. %s" if i == 1 else "\n%d. %s", i, item)
                 i += 1
-            if not numbered_list:
-                return "Nothing found."
-            return numbered_list.strip()
+            if not response.records:
+                response.add("Nothing found.")
+            return response
         else:
-            return "The library is not open."
+            return Response("The library is not open.")
 
     def check_out(self, *book_numbers):
         """Checks books out to the patron currently being served.
            Books will be due seven days from "today".
            Patron must have a library card, and may have not more
            than three books checked out at a time."""
-        message = ''
-        if self.is_open:
-            limit = 3
-            checkout_period = 7
-            if self.patron_being_served:
-                count = 0
-                for book_number in book_numbers:
-                    if book_number <= len(self.found_books):
-                        book = self.found_books[book_number - 1]
-                        if len(self.patron_being_served.get_books()) < limit:
-                            self.patron_being_served.take(book)
-                            book.check_out(calendar.get_date() + checkout_period)
-                            count += 1
-                        else:
-                            message += "%s already has the maximum # of books checked out.\n" % self.patron_being_served.get_name()
-                            break
-                    else:
-                        message += "The library does not have book %d.\n" % book_number
-                if count:
-                    self.current_patrons_books = list(self.patron_being_served.get_books())
-                    message += "%s has checked out %d books." % \
-                         (self.patron_being_served.get_name(), count)
-            else:
-                message += "No patron is currently being served."
-        else:
-            message += "The library is not open."
-        return message
-            
+        return self.desk.check_out(*book_numbers)
+
     def renew(self, *book_ids):
         """Renews books for the patron currently being served.
         Books renewed will be due 7 days from "today"."""
-        message = ''
-        if self.is_open:
-            if self.patron_being_served:
-                count = 0
-                checkout_period = 7
-                for book_id in book_ids:
-                    if book_id <= len(self.current_patrons_books):
-                        book = self.current_patrons_books[book_id - 1]
-                        book.check_out(calendar.get_date() + checkout_period)
-                        count += 1
-                    else:
-                        message += "The patron does not have book %d." % book_id
-                if count:
-                    message += "%d books have been renewed for %s." % \
-                         (count, self.patron_being_served.get_name())
+        return self.desk.renew(*book_ids)
+
+    def place_hold(self, *book_numbers):
+        """Places holds, for the patron being served, on books found
+           by the last search whose copies are all checked out."""
+        return self.desk.place_hold(*book_numbers)
+
+    def pick_up(self):
+        """Checks out, to the patron being served, the books that have
+           been set aside for the patron."""
+        return self.desk.pick_up()
+
+    def batch(self, operations):
+        """Does many check_out, check_in and renew operations in one
+           pass, without serving each patron. Each operation is a
+           (name_of_patron, book_id, action) triple, where the action
+           is "check_out", "check_in" or "renew", or "hold" (place a
+           hold on the work of the book, none of whose copies is
+           available) or "pick_up" (check out the books set aside for
+           the patron; the book_id is ignored). The usual rules (a
+           library card, at most three books, seven days until due)
+           apply. Returns an array with the status of each operation:
+           status_done if it was done, or another of the status_
+           numbers telling why not."""
+        statuses = array.array('B')
+        if not self.is_open:
+            statuses.extend([status_closed] * len(operations))
+            return statuses
+        with self.lock:
+            self.batch_under_lock(operations, statuses)
+        return statuses
+
+    def batch_under_lock(self, operations, statuses):
+        """Does the operations for batch, appending their statuses to
+           the given array. The library's lock must be held."""
+        due_date = self.get_date() + self.checkout_period
+        self.update_index()
+        for name_of_patron, book_id, action in operations:
+            patron = self.patrons.get(name_of_patron)
+            book = self.books.get(book_id)
+            if patron is None:
+                status = status_no_card
+            elif action == 'pick_up':
+                if self.pick_up_books(patron):
+                    status = status_done
+                elif self.holds.get_books_set_aside(patron):
+                    status = status_at_limit
+                else:
+                    status = status_not_available
+            elif book is None:
+                status = status_no_such_book
             else:
-                message += "No patron is currently being served."
-        else:
-            message += "The library is not open."
-        return message
-            
+                if action == 'hold':
+                    if book.work.count_available() or \
+                       not self.hold_book(patron, book):
+                        status = status_not_available
+                    else:
+                        status = status_done
+                elif action == 'check_out':
+                    if not self.is_available(book):
+                        status = status_not_available
+                    elif patron.count_books() >= self.limit:
+                        status = status_at_limit
+                    else:
+                        self.lend_book(patron, book, due_date)
+                        status = status_done
+                elif action not in ('check_in', 'renew'):
+                    status = status_no_such_action
+                elif not patron.has_book(book):
+                    status = status_not_borrowed
+                elif action == 'check_in':
+                    self.return_book(patron, book)
+                    status = status_done
+                else:
+                    self.renew_book(patron, book, due_date)
+                    status = status_done
+            statuses.append(status)
+
     def close(self):
         """Closes the library for the day."""
-        if self.is_open:
-            self.patron_being_served = None
-            self.current_patrons_books = []
-            self.is_open = False
-            return "Good night."
-        else:
-            return "The library is not open."
+        with self.lock:
+            if self.is_open:
+                self.stop_serving()
+                self.is_open = False
+                self.record('close')
+                if self.journal:
+                    self.journal.commit()
+                return "Good night."
+            else:
+                return "The library is not open."
 
     def quit(self):
-        self.patron_being_served = None
-        self.current_patrons_books = []
-        self.is_open = False
+        with self.lock:
+            self.stop_serving()
+            if self.is_open:
+                self.record('close')
+            self.is_open = False
+            if self.journal:
+                self.journal.close()
+                self.journal = None
         return "The library is now closed for renovations."
 
     def help(self):
@@ -385,17 +2664,37 @@ serve("name_of_patron")
      
 search("string")
      Searches for any book or author containing this string
-     and displays a numbered list of results.
+     and displays a numbered list of the best ten results.
+
+next_page()
+     Displays the next ten results of the last search.
      
 check_out(books...)
      Checks out books (by number) to the current patron.
      
 check_in(books...)
      Accepts returned books (by number) from the current patron.
+
+search_all("string")
+     Like search, but also lists books whose copies are all checked out.
+
+search_similar("string")
+     Like search, but also finds books when words are misspelt.
+
+place_hold(books...)
+     Places holds (by number) on checked-out books for the current
+     patron, who is next given a copy when one is returned.
+
+pick_up()
+     Checks out to the current patron the books held for the patron.
      
 close()
      Closes the library at the end of the day.
 
+checkpoint("library.snapshot")
+     Saves the whole library in a snapshot, so it can be restored
+     quickly when the program is next started.
+
 quit()
      Closes the library for good. Hope you never have to use this!"""
 
@@ -403,11 +2702,482 @@ quit()
 
     # Feel free to add any more helper methods you would like
 
+    def stop_serving(self):
+        """Stops serving patrons at every desk."""
+        for desk in self.desks:
+            desk.stop_serving()
+
+    def lend_book(self, patron, book, due_date):
+        """Checks the given book out to the given patron, until the
+           given date, and records the change."""
+        patron.take(book)
+        book.check_out(due_date)
+        self.loans.add(patron, book, due_date)
+        if self.journal or self.events:
+            self.record('out', patron.get_name(), book.get_id(), due_date)
+
+    def return_book(self, patron, book):
+        """Checks in the given book, returned by the given patron, and
+           records the change."""
+        patron.give_back(book)
+        self.loans.remove(book)
+        book.check_in()
+        if self.journal or self.events:
+            self.record('in', patron.get_name(), book.get_id())
+        if book.work in self.holds.queues:
+            last_day = self.get_date() + self.hold_period
+            holder = self.holds.fill(book, last_day)
+            if holder and (self.journal or self.events):
+                self.record('set_aside', holder.get_name(), book.get_id(), last_day)
+
+    def renew_book(self, patron, book, due_date):
+        """Changes the due date of the given book, checked out to the
+           given patron, and records the change."""
+        book.check_out(due_date)
+        self.loans.renew(book, due_date)
+        if self.journal or self.events:
+            self.record('renew', patron.get_name(), book.get_id(), due_date)
+
+    def hold_book(self, patron, book):
+        """Places a hold for the given patron on the work of the given
+           book, and records the change. Returns False, and does
+           nothing, if the patron is already waiting for the work."""
+        if not self.holds.place(book.work, patron):
+            return False
+        self.record('hold', patron.get_name(), book.get_id())
+        return True
+
+    def pick_up_books(self, patron):
+        """Checks out to the given patron the books set aside for the
+           patron, up to the limit, and returns a list of them."""
+        due_date = self.get_date() + self.checkout_period
+        books = []
+        for book in self.holds.get_books_set_aside(patron):
+            if patron.count_books() >= self.limit:
+                break
+            self.holds.pick_up(patron, book)
+            self.lend_book(patron, book, due_date)
+            books.append(book)
+        return books
+
+    def is_available(self, book):
+        """Tests if the given book may be checked out: it is not
+           checked out, or set aside for a patron who held it."""
+        return book.get_due_date() is None and not self.holds.is_set_aside(book)
+
+    def record(self, *entry):
+        """Adds an entry to the journal and the event log, if they are
+           being kept. The entry is saved, and the event published, once
+           the lock is released, if it is held, and at once otherwise."""
+        if self.journal:
+            number = self.journal.record(*entry)
+            if self.lock.is_held():
+                self.lock.save_to = (self.journal, number)
+            else:
+                self.journal.sync(number)
+        if self.events:
+            end = self.events.stage(entry)
+            if self.lock.is_held():
+                self.lock.publish_to = end
+            else:
+                self.events.publish(end)
+
+    def keep_events(self, size=None, overflow='drop'):
+        """Starts keeping an EventLog of the changes made to this
+           library, of the given size (event_log_size, by default),
+           which drops or blocks when full, as overflow says. Returns
+           the log (the one already kept, if there is one)."""
+        with self.lock:
+            if self.events is None:
+                self.events = EventLog(size or self.event_log_size, overflow)
+            return self.events
+
+    def subscribe(self, offset=None):
+        """Returns an EventCursor for reading the changes made to this
+           library from the given offset, or from now on, starting to
+           keep them if they are not being kept."""
+        return self.keep_events().subscribe(offset)
+
+    def restore(self, snapshot_path, journal_path, group_size=64):
+        """Restores the state of this library (which should be newly
+           constructed) from the named snapshot file, if there is one,
+           then replays the changes in the named journal file, if there
+           is one. From then on, all changes are added to the journal.
+           Returns a message telling what was restored."""
+        with self.lock:
+            if os.path.exists(snapshot_path):
+                self.load_snapshot(snapshot_path)
+            changes = 0
+            # If the journal is of the snapshot's generation, the process
+            # died before emptying it, and its changes are in the snapshot
+            generation = Journal.generation_of(journal_path)
+            if generation is not None and generation > self.generation:
+                for entry in Journal.entries(journal_path):
+                    self.replay(entry)
+                    changes += 1
+            self.journal = Journal(journal_path, group_size,
+                                   self.generation + 1)
+        return "Restored %d books and %d patrons, and replayed %d changes." % \
+               (len(self.collection), len(self.patrons), changes)
+
+    def replay(self, entry):
+        """Makes the change described by one journal entry again."""
+        kind = entry[0]
+        if kind == 'open':
+            self.calendar.day = entry[1]
+            self.is_open = True
+            self.holds.expire(self.get_date(),
+                              self.get_date() + self.hold_period)
+        elif kind == 'close':
+            self.stop_serving()
+            self.is_open = False
+        elif kind == 'card':
+            self.patrons[entry[1]] = Patron(entry[1])
+        else:
+            patron = self.patrons[entry[1]]
+            book = self.get_book(entry[2])
+            if kind == 'out':
+                if self.holds.is_set_aside(book):
+                    self.holds.pick_up(patron, book)
+                self.lend_book(patron, book, entry[3])
+            elif kind == 'in':
+                self.return_book(patron, book)
+            elif kind == 'hold':
+                self.holds.place(book.work, patron)
+            elif kind == 'set_aside':
+                # Replaying the 'in' before it has already set the book
+                # aside, unless the holds were lost
+                if not self.holds.is_set_aside(book):
+                    self.holds.cancel(book.work, patron)
+                    self.holds.set_aside(book, patron, entry[3])
+            else:
+                self.renew_book(patron, book, entry[3])
+
+    def checkpoint(self, snapshot_path):
+        """Writes the whole state of this library to the named snapshot
+           file, then empties the journal, whose changes are now all in
+           the snapshot. The new snapshot replaces the old one only once
+           it has been completely written."""
+        with self.lock:
+            if self.journal:
+                self.journal.commit()
+            temporary_path = snapshot_path + '.new'
+            file = open(temporary_path, 'wb')
+            try:
+                self.write_snapshot(file)
+                file.flush()
+                os.fsync(file.fileno())
+            finally:
+                file.close()
+            os.rename(temporary_path, snapshot_path)
+            if self.journal:
+                self.journal.truncate()
+        return "Saved %d books and %d patrons." % \
+               (len(self.collection), len(self.patrons))
+
+    def write_snapshot(self, file):
+        """Writes the whole state of this library to the given binary
+           file, in a form that load_snapshot can map into memory.
+           Books from an earlier snapshot that have not been used are
+           copied across without being created."""
+        self.update_index()
+        index = self.search_index
+        header = dict.fromkeys(snapshot_fields, 0)
+        header['day'] = self.get_date()
+        header['is_open'] = int(self.is_open)
+        header['books'] = len(self.collection)
+        header['next_book_id'] = self.next_book_id
+        header['works'] = index.count_works()
+        if self.journal:
+            header['journal'] = self.journal.generation
+        else:
+            header['journal'] = self.generation
+        if isinstance(self.collection, SnapshotCollection):
+            book_works = self.collection.work_numbers()
+            book_ids = self.collection.ids()
+        else:
+            book_works = array.array('I', (book.work.number
+                                           for book in self.collection))
+            book_ids = array.array('I', (book.id for book in self.collection))
+        file.write(snapshot_header.pack(snapshot_magic, *[0] * len(snapshot_fields)))
+
+        header['strings_at'] = file.tell()
+        texts = []
+        for number in xrange(header['works']):
+            text = []
+            for string in index.get_text(number):
+                string = encode_text(string)
+                text.extend((file.tell(), len(string)))
+                file.write(string)
+            texts.append(text)
+        names = list(self.patrons)
+        name_records = []
+        for name in names:
+            string = encode_text(name)
+            name_records.append(name_record.pack(file.tell(), len(string)))
+            file.write(string)
+
+        header['works_at'] = file.tell()
+        counts = array.array('I', [0]) * header['works']
+        for number in book_works:
+            counts[number] += 1
+        starts = array.array('I', [0]) * header['works']
+        total = 0
+        for number in xrange(header['works']):
+            starts[number] = total
+            total += counts[number]
+            file.write(work_record.pack(*(texts[number] +
+                                          [starts[number], counts[number]])))
+        texts = None
+
+        header['copies_at'] = file.tell()
+        copies = array.array('I', [0]) * header['books']
+        for position, number in enumerate(book_works):
+            copies[starts[number]] = position
+            starts[number] += 1
+        write_numbers(file, copies)
+        copies = None
+
+        header['book_works_at'] = file.tell()
+        write_numbers(file, book_works)
+        book_works = None
+
+        header['book_ids_at'] = file.tell()
+        write_numbers(file, book_ids)
+        header['id_positions_at'] = file.tell()
+        positions = array.array('I', xrange(len(book_ids)))
+        if any(book_ids[i] > book_ids[i + 1] for i in xrange(len(book_ids) - 1)):
+            positions = array.array('I', sorted(positions,
+                                                key=book_ids.__getitem__))
+        pairs = array.array('I', [0]) * (2 * len(book_ids))
+        pairs[0::2] = array.array('I', (book_ids[position]
+                                        for position in positions))
+        pairs[1::2] = positions
+        write_numbers(file, pairs)
+        book_ids = positions = pairs = None
+
+        header['postings_at'] = file.tell()
+        grams = []
+        for key, numbers in index.all_postings():
+            grams.append(gram_record.pack(key, file.tell(), len(numbers)))
+            write_numbers(file, array.array('I', numbers))
+        header['grams'] = len(grams)
+        header['grams_at'] = file.tell()
+        file.write(''.join(grams))
+
+        header['patrons'] = len(names)
+        header['patrons_at'] = file.tell()
+        file.write(''.join(name_records))
+
+        header['loans_at'] = file.tell()
+        for patron_number, name in enumerate(names):
+            for book in self.patrons[name].get_loans():
+                file.write(loan_record.pack(patron_number, book.get_id(),
+                                            book.get_due_date()))
+                header['loans'] += 1
+
+        patron_numbers = dict((name, number)
+                              for number, name in enumerate(names))
+        header['set_aside_at'] = file.tell()
+        for book, (patron, last_day) in self.holds.ready.items():
+            file.write(set_aside_record.pack(patron_numbers[patron.get_name()],
+                                             book.get_id(), last_day))
+            header['set_aside'] += 1
+        header['holds_at'] = file.tell()
+        for work, patron in self.holds.waiting_in_order():
+            file.write(hold_record.pack(patron_numbers[patron.get_name()],
+                                        work.copies[0].get_id()))
+            header['holds'] += 1
+
+        file.seek(0)
+        file.write(snapshot_header.pack(snapshot_magic, *[header[field]
+                                        for field in snapshot_fields]))
+
+    def load_snapshot(self, path):
+        """Replaces the collection, patrons, loans and holds of this
+           library, and the date, with those in the named snapshot file. The
+           file is mapped into memory, and books are created only as
+           they are used, so this takes time proportional to the number
+           of patrons and loans, not the size of the collection.
+           Returns a message telling how long it took."""
+        start = time.time()
+        file = open(path, 'rb')
+        try:
+            data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            file.close()
+        fields = snapshot_header.unpack_from(data, 0)
+        if fields[0] != snapshot_magic:
+            raise ValueError("%s is not a library snapshot" % path)
+        header = dict(zip(snapshot_fields, fields[1:]))
+        self.collection = SnapshotCollection(data, header)
+        self.search_index = MappedSearchIndex(data, header, self.collection)
+        self.collection.index = self.search_index
+        self.search_cache.clear()
+        self.books = SnapshotBooks(self.collection)
+        self.next_book_id = header['next_book_id']
+        self.generation = header['journal']
+        self.indexed_collection = self.collection
+        self.number_indexed = len(self.collection)
+        self.calendar.day = header['day']
+        self.is_open = bool(header['is_open'])
+        self.patrons = {}
+        names = []
+        for name_at, length in MappedArray(data, header['patrons_at'],
+                                           header['patrons'], name_record):
+            names.append(data[name_at:name_at + length].decode('utf-8'))
+            self.patrons[names[-1]] = Patron(names[-1])
+        self.loans = LoanTable()
+        for patron_number, book_id, due_date in \
+                MappedArray(data, header['loans_at'], header['loans'],
+                            loan_record):
+            self.lend_book(self.patrons[names[patron_number]],
+                           self.books[book_id], due_date)
+        self.holds = Holds()
+        for patron_number, book_id, last_day in \
+                MappedArray(data, header['set_aside_at'], header['set_aside'],
+                            set_aside_record):
+            self.holds.set_aside(self.books[book_id],
+                                 self.patrons[names[patron_number]], last_day)
+        for patron_number, book_id in \
+                MappedArray(data, header['holds_at'], header['holds'],
+                            hold_record):
+            self.holds.place(self.books[book_id].work,
+                             self.patrons[names[patron_number]])
+        return "Loaded %d books and %d patrons in %.3f seconds." % \
+               (len(self.collection), len(self.patrons), time.time() - start)
+
+    def add_to_collection(self, books):
+        """Adds the given list of books to the collection and the
+           search index, and returns how many books were added."""
+        with self.lock:
+            self.collection.extend(books)
+            self.update_index()
+        return len(books)
+
+    def parse_collection_line(self, line, line_number=None):
+        """Returns the (title, author) described by one stripped line
+           of a collection file. Simple tuples of two quoted strings
+           are matched directly; anything else that looks like a
+           Python literal is read with ast.literal_eval, which cannot
+           run code. Raises ValueError if the line makes no sense."""
+        try:
+            if line[0] == '(':
+                match = simple_tuple.match(line)
+                if match and '\\' not in line:
+                    title, title2, author, author2 = match.groups()
+                    if title is None:
+                        title = title2
+                    if author is None:
+                        author = author2
+                    return title, author
+                fields = ast.literal_eval(line)
+            elif line[0] in '[{':
+                fields = json.loads(line)
+                if isinstance(fields, dict):
+                    fields = (fields['title'], fields['author'])
+            else:
+                fields = line.split('\t')
+            title, author = fields
+            if not isinstance(title, basestring) or \
+               not isinstance(author, basestring):
+                raise ValueError("title and author must be strings")
+            return title, author
+        except (SyntaxError, ValueError, KeyError, TypeError), e:
+            raise ValueError("Bad book on line %s: %r (%s)" %
+                             (line_number, line, e))
+
+    def get_book(self, book_id):
+        """Returns the book with the given id, or None if there is no
+           such book."""
+        self.update_index()
+        return self.books.get(book_id)
+
+    def update_index(self):
+        """Brings the search index up to date with self.collection.
+           Books appended since the last update are given ids and added
+           to the index; if self.collection has been replaced by another
+           list, the index and self.books are rebuilt from scratch, so
+           that books no longer in the collection cannot be found.
+           Books keep their ids, even if they are moved to a
+           replacement collection."""
+        if self.indexed_collection is self.collection and \
+           self.number_indexed == len(self.collection):
+            return
+        with self.lock:
+            if self.indexed_collection is not self.collection:
+                self.search_index = SearchIndex()
+                self.search_cache.clear()
+                self.books = {}
+                self.indexed_collection = self.collection
+                self.number_indexed = 0
+            first_new_work = self.search_index.count_works()
+            for book in self.collection[self.number_indexed:]:
+                if book.id is None:
+                    book.id = self.next_book_id
+                    self.next_book_id += 1
+                self.books[book.id] = book
+                self.search_index.add(book)
+            self.number_indexed = len(self.collection)
+            self.search_cache.works_added(self.search_index, first_new_work)
+
+    def find_ranked(self, string):
+        """Returns the heap of ranked works (see SearchIndex.ranked)
+           found by searching for the given lowercase string, from the
+           search cache if the search was made recently."""
+        heap = self.search_cache.get(string)
+        if heap is None:
+            generation = self.search_cache.generation
+            heap = self.search_index.ranked(string)
+            self.search_cache.put(string, heap, generation)
+        return heap
+
+    def find_similar(self, string):
+        """Returns a heap of ((order, rank), number) pairs for the works
+           found by searching for the given lowercase string and for
+           the similar_searches - 1 best corrections of it (see
+           WordIndex.corrections), where order is the position of the
+           first of those strings that the work contains, and rank is
+           as in SearchIndex.ranked. If the WordIndex is out of date, a
+           new one is made without holding the lock, and then takes its
+           place."""
+        word_index = self.word_index
+        search_index = self.search_index
+        if not word_index.is_current(search_index):
+            word_index = word_index.updated(search_index)
+            self.word_index = word_index
+        heap = []
+        seen = set()
+        for order, (similarity, text) in enumerate(
+                word_index.corrections(string, self.similar_searches)):
+            for rank, number in self.find_ranked(text):
+                if number not in seen:
+                    seen.add(number)
+                    heap.append(((order, rank), number))
+        heapq.heapify(heap)
+        return heap
+
 #--------------------------------------------------------------
 
+def parse_command(command):
+    """Returns the name and the list of arguments of a command typed
+       by the librarian, such as 'search("tolkien")' or 'check_in(1, 2)'.
+       The arguments must be literals; nothing is evaluated. Raises
+       ValueError if the command is not of that form."""
+    try:
+        call = ast.parse(command.strip(), mode='eval').body
+    except SyntaxError:
+        raise ValueError(command)
+    if not isinstance(call, ast.Call) or not isinstance(call.func, ast.Name) \
+       or call.keywords or call.starargs or call.kwargs:
+        raise ValueError(command)
+    return call.func.id, [ast.literal_eval(argument) for argument in call.args]
+
 def main():
     library = Library()
-    library.read_in_collection()
+    if not os.path.exists('library.snapshot'):
+        print library.read_in_collection()
+    print library.restore('library.snapshot', 'library.journal')
     print len(library.collection), 'books in collection.'
     print "Ready for input. Type 'help()' for a list of commands.\n"
     command = '\0'
@@ -417,8 +3187,11 @@ def main():
             if len(command) == 0:
                 print "What? Speak up!\n"
             else:
-                print eval('library.' + command)
-        except AttributeError, e:
+                name, arguments = parse_command(command)
+                if name not in Library.commands:
+                    raise AttributeError(name)
+                print getattr(library, name)(*arguments)
+        except (AttributeError, ValueError), e:
             print "Sorry, I didn't understand:", command
             print "Type 'help()' for a list of the things I do understand.\n"
         except Exception, e:
@@ -0,0 +1,229 @@
+# Benchmarks for a simple library program
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import argparse
+import gc
+import json
+import platform
+import random
+import resource
+import sys
+import time
+
+from library import Book, Library
+
+# Syllables from which the words of synthetic titles and names are made
+syllables = ('ba', 'ce', 'di', 'fo', 'gu', 'ha', 'ke', 'li', 'mo', 'nu',
+             'pa', 're', 'si', 'to', 'vu', 'wa', 'xe', 'yo', 'za', 'lor',
+             'man', 'tis', 'ver', 'dun', 'gal', 'hes', 'ort', 'quin')
+
+# The operations timed by the benchmark, in the order they are reported
+operations = ('open', 'issue_card', 'serve', 'search', 'check_out',
+              'check_in', 'renew', 'list_overdue_books', 'close')
+
+#--------------------------------------------------------------
+
+class Workload(object):
+    """A synthetic collection and population of patrons, made from
+       a seeded random number generator so that the same parameters
+       always give the same workload."""
+
+    def __init__(self, copies, patrons, seed=0, words=2000, authors=1000):
+        """Creates a workload of the given number of copies of books
+           and patrons, with titles made from the given number of
+           different words, by the given number of different authors."""
+        self.copies = copies
+        self.random = random.Random(seed)
+        self.words = self.make_words(words)
+        self.authors = [self.make_name() for i in xrange(authors)]
+        self.patrons = ["%s %d" % (self.make_name(), i) for i in xrange(patrons)]
+
+    def make_words(self, count):
+        """Returns a list of the given number of different words."""
+        words = set()
+        while len(words) < count:
+            words.add(''.join(self.random.choice(syllables)
+                              for i in xrange(self.random.randint(2, 4))))
+        return sorted(words)
+
+    def make_name(self):
+        """Returns a made-up name, such as "Gufo Lormanza"."""
+        return "%s %s" % (self.random.choice(self.words).capitalize(),
+                          self.random.choice(self.words).capitalize())
+
+    def books(self, batch_size=10000):
+        """Generates the copies of the collection, in lists of at most
+           batch_size Books, so that a large collection need never be
+           held in memory twice. Each title has from one to five copies."""
+        batch = []
+        count = 0
+        while count < self.copies:
+            title = ' '.join(self.random.choice(self.words).capitalize()
+                             for i in xrange(self.random.randint(1, 4)))
+            author = self.random.choice(self.authors)
+            for i in xrange(min(self.random.randint(1, 5), self.copies - count)):
+                batch.append(Book(title, author))
+                count += 1
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def search_string(self):
+        """Returns a word that a patron might search for."""
+        while True:
+            word = self.random.choice(self.words)
+            if len(word) >= 4:
+                return word
+
+#--------------------------------------------------------------
+
+class Timer(object):
+    """Records how long each call of each operation takes."""
+
+    def __init__(self):
+        """Creates a timer with no calls recorded."""
+        self.latencies = dict((op, []) for op in operations)
+
+    def call(self, op, function, *args):
+        """Calls the function with the given arguments, records the
+           time taken under the name op, and returns the result."""
+        start = time.time()
+        result = function(*args)
+        self.latencies[op].append(time.time() - start)
+        return result
+
+    def report(self):
+        """Returns a dictionary giving, for each operation called, the
+           number of calls, the calls per second, and the median (p50),
+           90th, 99th percentile and slowest latencies in milliseconds."""
+        report = {}
+        for op, latencies in self.latencies.iteritems():
+            if latencies:
+                latencies = sorted(latencies)
+                seconds = max(sum(latencies), 1e-9)
+                report[op] = {'count': len(latencies),
+                              'ops_per_second': len(latencies) / seconds,
+                              'p50_ms': percentile(latencies, 0.50),
+                              'p90_ms': percentile(latencies, 0.90),
+                              'p99_ms': percentile(latencies, 0.99),
+                              'max_ms': 1000 * latencies[-1]}
+        return report
+
+def percentile(latencies, fraction):
+    """Returns the given percentile (as a fraction) of the given sorted
+       list of latencies in seconds, in milliseconds."""
+    return 1000 * latencies[int(round(fraction * (len(latencies) - 1)))]
+
+def peak_memory():
+    """Returns the most memory this process has used, in megabytes."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return peak / 1048576.0  # Bytes on Mac OS X
+    return peak / 1024.0         # Kilobytes elsewhere
+
+#--------------------------------------------------------------
+
+def run_benchmark(copies=10000, patrons=1000, days=10, visits=1000, seed=0):
+    """Builds a library of the given number of copies and runs it for
+       the given number of days. Each day the library opens, the given
+       number of visits are made by randomly chosen patrons, overdue
+       books are listed, and the library closes. At each visit the
+       patron is issued a card or served, returns any books with
+       probability one half, otherwise renews them with probability
+       one quarter, and searches for a word and checks out the first
+       book found. Returns a dictionary reporting the parameters, the
+       time taken to build the library, the latencies and throughput
+       of each operation, and the peak memory used."""
+    workload = Workload(copies, patrons, seed)
+    choose = workload.random
+    timer = Timer()
+    library = Library()
+    start = time.time()
+    for batch in workload.books():
+        library.add_to_collection(batch)
+    library.update_index()
+    build_seconds = time.time() - start
+
+    has_card = set()
+    start = time.time()
+    for day in xrange(days):
+        timer.call('open', library.open)
+        for visit in xrange(visits):
+            name = choose.choice(workload.patrons)
+            if name in has_card:
+                timer.call('serve', library.serve, name)
+            else:
+                timer.call('issue_card', library.issue_card, name)
+                has_card.add(name)
+            count = len(library.current_patrons_books)
+            if count and choose.random() < 0.5:
+                timer.call('check_in', library.check_in, *range(1, count + 1))
+            elif count and choose.random() < 0.25:
+                timer.call('renew', library.renew, *range(1, count + 1))
+            timer.call('search', library.search, workload.search_string())
+            if library.found_books:
+                timer.call('check_out', library.check_out, 1)
+        timer.call('list_overdue_books', library.list_overdue_books)
+        timer.call('close', library.close)
+    seconds = max(time.time() - start, 1e-9)
+
+    report = timer.report()
+    return {'parameters': {'copies': copies, 'patrons': patrons,
+                           'days': days, 'visits': visits, 'seed': seed},
+            'python': platform.python_version(),
+            'build_seconds': build_seconds,
+            'books_per_second': copies / max(build_seconds, 1e-9),
+            'seconds': seconds,
+            'ops_per_second': sum(op['count'] for op in report.values()) / seconds,
+            'operations': report,
+            'peak_memory_mb': peak_memory()}
+
+def compare(baseline, report):
+    """Compares a report with a baseline report (both as returned by
+       run_benchmark) and returns a dictionary giving, for each
+       operation in both, the ratio of the new median latency and
+       throughput to the old. A latency ratio above 1 is a slowdown."""
+    ratios = {}
+    for op, new in report['operations'].iteritems():
+        old = baseline['operations'].get(op)
+        if old:
+            ratios[op] = {'p50_ratio': new['p50_ms'] / max(old['p50_ms'], 1e-9),
+                          'p99_ratio': new['p99_ms'] / max(old['p99_ms'], 1e-9),
+                          'throughput_ratio': new['ops_per_second'] /
+                                              max(old['ops_per_second'], 1e-9)}
+    return ratios
+
+#--------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the library "
+                                     "on a synthetic collection.")
+    parser.add_argument('--copies', type=int, default=10000,
+                        help="copies of books (10^3 to 10^7)")
+    parser.add_argument('--patrons', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=10)
+    parser.add_argument('--visits', type=int, default=1000,
+                        help="patron visits per day")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="file in which to write the report "
+                        "as JSON (default: standard output)")
+    parser.add_argument('--baseline', help="report of an earlier run to "
+                        "compare this one with")
+    options = parser.parse_args()
+    gc.collect()
+    report = run_benchmark(options.copies, options.patrons, options.days,
+                           options.visits, options.seed)
+    if options.baseline:
+        with open(options.baseline) as file:
+            report['compared_with_baseline'] = compare(json.load(file), report)
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if options.output:
+        with open(options.output, 'w') as file:
+            file.write(text + '\n')
+    else:
+        print text
+
+if __name__ == '__main__':
+    main()
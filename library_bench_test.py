@@ -0,0 +1,38 @@
+# Unit tests for the benchmarks of a simple library program
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import json
+import unittest
+from library_bench import *
+
+class WorkloadTest(unittest.TestCase):
+
+    def test_books(self):
+        workload = Workload(2500, 10, seed=1)
+        batches = list(workload.books(batch_size=1000))
+        self.assertEqual(2500, sum(len(batch) for batch in batches))
+        self.assertTrue(all(len(batch) <= 1004 for batch in batches))
+        again = Workload(2500, 10, seed=1)
+        self.assertEqual([str(book) for book in batches[0]],
+                         [str(book) for book in list(again.books(1000))[0]])
+        self.assertEqual(10, len(set(workload.patrons)))
+
+class RunBenchmarkTest(unittest.TestCase):
+
+    def test_report(self):
+        report = run_benchmark(copies=1000, patrons=50, days=9, visits=40)
+        json.dumps(report)
+        operations = report['operations']
+        self.assertEqual(9, operations['open']['count'])
+        self.assertEqual(9, operations['list_overdue_books']['count'])
+        self.assertEqual(360, operations['search']['count'])
+        self.assertEqual(360, operations['serve']['count'] +
+                              operations['issue_card']['count'])
+        for op in operations.values():
+            self.assertTrue(op['p50_ms'] <= op['p90_ms'] <= op['p99_ms'] <= op['max_ms'])
+        self.assertTrue(report['peak_memory_mb'] > 0)
+
+        ratios = compare(report, report)
+        self.assertEqual(1.0, ratios['search']['throughput_ratio'])
+
+unittest.main()
@@ -0,0 +1,158 @@
+# Read-only replicas of a simple library program, in other processes
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import multiprocessing
+import threading
+import time
+
+from library import Library, Response
+
+# The requests that a replica answers
+reads = ('search', 'search_all', 'search_similar', 'serve',
+         'list_overdue_books', 'get_date')
+
+def run_replica(snapshot_path, connection):
+    """Runs a replica in a worker process: loads the library from the
+       given snapshot file, then, for each (name, arguments) pair received on the given
+       connection, either replays a list of events (if the name is
+       'replay'), or makes the named request and sends back a
+       (result, error) pair, until a name of None is received."""
+    library = Library()
+    library.load_snapshot(snapshot_path)
+    while True:
+        name, args = connection.recv()
+        if name is None:
+            break
+        if name == 'replay':
+            for event in args:
+                library.replay(event)
+            continue
+        try:
+            if name not in reads:
+                raise ValueError("Replicas do not answer %s" % name)
+            result = getattr(library, name)(*args)
+            if isinstance(result, Response):
+                result = str(result)  # Rather than send the books
+            connection.send((result, None))
+        except Exception, e:
+            connection.send((None, "%s: %s" % (e.__class__.__name__, e)))
+    connection.close()
+
+#--------------------------------------------------------------
+
+class Replica(object):
+    """A read-only copy of a library, kept in its own process, which
+       answers searches, serve-style lookups of a patron's books, and
+       overdue reports, so that they do not slow down the changes made
+       at the library itself (the primary). The replica starts from a
+       snapshot of the primary, then follows the changes made to it,
+       which are read from the primary's EventLog and sent down a pipe.
+       The changes are sent just before a request, if the last were
+       sent more than max_lag seconds earlier, so no answer is more
+       than max_lag seconds out of date. If the replica falls so far
+       behind that the log has dropped changes it has not seen, it is
+       started again from a new snapshot. So the primary's log must
+       drop changes when it is full, rather than block: an idle
+       replica does not read it, and would hold up every change."""
+
+    max_lag = 1.0  # Most seconds by which answers may be out of date
+
+    def __init__(self, primary, snapshot_path, max_lag=None):
+        """Starts a replica of the given Library, writing the snapshot
+           from which it starts to the named file. Raises a ValueError
+           if the library keeps an EventLog that blocks when full."""
+        if primary.keep_events().overflow == 'block':
+            raise ValueError("A replica cannot follow an event log that blocks")
+        self.primary = primary
+        self.snapshot_path = snapshot_path
+        if max_lag is not None:
+            self.max_lag = max_lag
+        self.lock = threading.Lock()  # Held while using the pipe
+        self.start()
+
+    def start(self):
+        """Writes a snapshot of the primary and starts the replica's
+           process from it."""
+        primary = self.primary
+        with primary.lock:
+            self.cursor = primary.subscribe()
+            file = open(self.snapshot_path, 'wb')
+            try:
+                primary.write_snapshot(file)
+            finally:
+                file.close()
+        self.connection, worker_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=run_replica,
+            args=(self.snapshot_path, worker_connection))
+        self.process.daemon = True
+        self.process.start()
+        self.synced_at = time.time()
+
+    def stop(self):
+        """Stops the replica's process and stops following the primary."""
+        self.connection.send((None, None))
+        self.process.join()
+        self.cursor.close()
+
+    def sync(self):
+        """Sends the replica all the changes made to the primary that it
+           has not yet seen, or starts it again if some have been lost."""
+        with self.lock:
+            while True:
+                events = self.cursor.read(1000)
+                if self.cursor.missed:
+                    self.stop()
+                    self.start()
+                    return
+                if not events:
+                    break
+                self.connection.send(('replay', events))
+            self.synced_at = time.time()
+
+    def call(self, name, *args):
+        """Makes the named request of the replica, with the given
+           arguments, and returns the answer, or raises a RuntimeError
+           if the request raised an exception."""
+        if time.time() - self.synced_at >= self.max_lag:
+            self.sync()
+        with self.lock:
+            self.connection.send((name, args))
+            result, error = self.connection.recv()
+        if error:
+            raise RuntimeError("Replica: %s" % error)
+        return result
+
+    def search(self, string):
+        """Looks for books with the given string in either the title or
+           the author's name, and lists them, as Library.search does."""
+        return self.call('search', string)
+
+    def search_all(self, string):
+        """Like search, but also lists the titles whose copies are all
+           checked out."""
+        return self.call('search_all', string)
+
+    def search_similar(self, string):
+        """Like search, but also finds books whose title or author
+           contains the string with its misspelt words corrected."""
+        return self.call('search_similar', string)
+
+    def serve(self, name_of_patron):
+        """Lists the books the named patron has checked out, as
+           Library.serve does, without serving the patron."""
+        return self.call('serve', name_of_patron)
+
+    def list_overdue_books(self):
+        """Lists overdue notices to all delinquent patrons."""
+        return self.call('list_overdue_books')
+
+    def get_date(self):
+        """Returns the date as the replica knows it."""
+        return self.call('get_date')
+
+    def quit(self):
+        """Stops the replica."""
+        with self.lock:
+            self.stop()
+        return "The replica has stopped."
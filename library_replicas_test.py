@@ -0,0 +1,92 @@
+# Unit tests for read-only replicas of a simple library program
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import unittest
+from library import *
+from library_replicas import *
+
+books = [("Cosmos", "Carl Sagan"), ("Contact", "Carl Sagan"),
+         ("Cosmos Revisited", "Carl Sagan"), ("Cosmic Dust", "Ann Cosmos"),
+         ("The Jungle", "Upton Sinclair")]
+
+class ReplicaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'replica.snapshot')
+        self.library = Library()
+        self.library.set_collection(*books)
+        self.library.open()
+        self.library.issue_card("Ellie")
+        self.replicas = []
+
+    def tearDown(self):
+        for replica in self.replicas:
+            replica.quit()
+        shutil.rmtree(self.directory)
+
+    def replica(self, max_lag=0):
+        replica = Replica(self.library, self.path, max_lag)
+        self.replicas.append(replica)
+        return replica
+
+    def test_follows_changes(self):
+        library = self.library
+        replica = self.replica()
+        self.assertEqual(library.search("cosmos"), replica.search("cosmos"))
+        library.check_out(1)
+        self.assertEqual(library.serve("Ellie"), replica.serve("Ellie"))
+        self.assertEqual(library.search("cosmos"), replica.search("cosmos"))
+        for i in range(8):
+            library.close()
+            library.open()
+        self.assertEqual(9, replica.get_date())
+        self.assertTrue(str(library.list_overdue_books()).startswith("Ellie\n"))
+        self.assertEqual(library.list_overdue_books(),
+                         replica.list_overdue_books())
+        self.assertRaises(RuntimeError, replica.call, 'check_out', 1)
+
+    def test_staleness_is_bounded(self):
+        library = self.library
+        replica = self.replica(max_lag=3600)
+        library.search("jungle")
+        library.check_out(1)
+        self.assertEqual("Now serving Ellie.\nEllie has no books checked out.",
+                         replica.serve("Ellie"))
+        replica.sync()
+        self.assertEqual(library.serve("Ellie"), replica.serve("Ellie"))
+
+    def test_restarts_after_losing_changes(self):
+        library = self.library
+        library.keep_events(size=2)
+        replica = self.replica()
+        library.search("cosmos")
+        library.check_out(1, 2)
+        library.check_in(1)
+        self.assertEqual(library.serve("Ellie"), replica.serve("Ellie"))
+        self.assertEqual(library.search("cosmos"), replica.search("cosmos"))
+
+    def test_follows_holds(self):
+        library = self.library
+        replica = self.replica()
+        library.search("jungle")
+        library.check_out(1)
+        library.issue_card("Jo")
+        library.search_all("jungle")
+        library.place_hold(1)
+        library.serve("Ellie")
+        library.check_in(1)
+        self.assertEqual("Now serving Jo.\nJo has no books checked out.\n" +\
+                         "1 books are waiting to be picked up.",
+                         replica.serve("Jo"))
+        self.assertEqual(library.serve("Jo"), replica.serve("Jo"))
+        self.assertEqual(library.serve("Jo"), self.replica().serve("Jo"))
+
+    def test_refuses_a_log_that_blocks(self):
+        self.library.keep_events(overflow='block')
+        self.assertRaises(ValueError, Replica, self.library, self.path)
+
+unittest.main()
@@ -0,0 +1,355 @@
+# Network server for a simple library program
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import argparse
+import asynchat
+import asyncore
+import collections
+import json
+import os
+import Queue
+import socket
+import threading
+import time
+
+from library import Library, Response
+
+# Requests that change nothing shared, and so are answered at once,
+# unless the worker thread is making a change
+reads = ('search', 'search_all', 'search_similar', 'next_page', 'serve',
+         'list_overdue_books', 'help', 'get_date')
+
+# Requests that change the library, and so are made one at a time
+writes = ('open', 'close', 'issue_card', 'check_out', 'check_in', 'renew',
+          'place_hold', 'pick_up', 'batch', 'checkpoint')
+
+# Requests made at a client's own desk, rather than by the library
+desk_requests = ('issue_card', 'serve', 'search', 'search_all',
+                 'search_similar', 'next_page', 'check_out', 'check_in',
+                 'renew', 'place_hold', 'pick_up')
+
+#--------------------------------------------------------------
+
+class LibraryServer(asyncore.dispatcher):
+    """Serves a library to many clients at once over TCP. Each client
+       sends requests, one JSON object per line, of the form
+           {"id": 1, "op": "search", "args": ["tolkien"]}
+       and gets back, for each, a line of the form
+           {"id": 1, "result": "1. The Hobbit, by JRR Tolkien"}
+       or {"id": 1, "error": "..."}. Each client has its own desk.
+       Everything runs in a single asyncore event loop, except that
+       requests which change the library are handed to one worker
+       thread, which makes them in the order they arrive, so that a
+       slow change (such as waiting for the journal to be saved) does
+       not hold up searches. The event loop never waits for the
+       library's lock: a search that arrives while the worker thread
+       holds it is handed to the worker thread too. A client may ask
+       for a checkpoint, but only of the snapshot file named when the
+       server was started; any arguments it gives are ignored."""
+
+    def __init__(self, library, host='localhost', port=0, snapshot_path=None):
+        """Starts listening on the given host and port (any free port,
+           if port is 0) for clients of the given library, which is
+           checkpointed to the named snapshot file, if one is given."""
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(socket.SOMAXCONN)
+        self.library = library
+        self.snapshot_path = snapshot_path
+        self.changes = Queue.Queue()         # (channel, request) pairs
+        self.finished = collections.deque()  # (channel, response) pairs
+        self.waker = Waker(self)
+        self.worker = threading.Thread(target=self.make_changes)
+        self.worker.daemon = True
+        self.worker.start()
+
+    def get_port(self):
+        """Returns the port on which this server is listening."""
+        return self.socket.getsockname()[1]
+
+    def handle_accept(self):
+        """Starts talking to all the clients waiting to connect."""
+        while True:
+            pair = self.accept()
+            if pair is None:
+                break
+            ClientChannel(self, pair[0])
+
+    def serve_forever(self):
+        """Handles clients until shutdown is called."""
+        while self.map:
+            asyncore.loop(timeout=0.5, use_poll=True, map=self.map, count=1)
+
+    def shutdown(self):
+        """Stops the worker thread and closes every connection."""
+        self.changes.put((None, None))
+        self.worker.join()
+        asyncore.close_all(self.map)
+
+    def make_changes(self):
+        """Makes the queued requests, one at a time, in the worker
+           thread, and hands the responses back to the event loop."""
+        while True:
+            channel, request = self.changes.get()
+            if channel is None:
+                break
+            self.finished.append((channel, channel.respond(request)))
+            self.waker.wake()
+
+    def deliver(self):
+        """Sends the responses to the requests made by the worker
+           thread, in the event loop."""
+        while self.finished:
+            channel, response = self.finished.popleft()
+            channel.waiting -= 1
+            if channel.connected:
+                channel.send_response(response)
+
+#--------------------------------------------------------------
+
+class Waker(asyncore.file_dispatcher):
+    """The reading end of a pipe, to which the worker thread writes to
+       wake the event loop when it has finished a request."""
+
+    def __init__(self, server):
+        """Creates the pipe for the given server."""
+        read_end, self.write_end = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read_end, map=server.map)
+        os.close(read_end)
+        self.server = server
+
+    def wake(self):
+        """Wakes the event loop; called from the worker thread."""
+        os.write(self.write_end, 'x')
+
+    def handle_read(self):
+        """Delivers the responses to finished requests."""
+        self.recv(4096)
+        self.server.deliver()
+
+    def writable(self):
+        """Never has anything to write."""
+        return False
+
+    def close(self):
+        """Closes both ends of the pipe."""
+        asyncore.file_dispatcher.close(self)
+        os.close(self.write_end)
+
+#--------------------------------------------------------------
+
+class ClientChannel(asynchat.async_chat):
+    """The connection to one client, with the client's own desk."""
+
+    def __init__(self, server, sock):
+        """Starts reading requests from the given socket."""
+        asynchat.async_chat.__init__(self, sock, map=server.map)
+        self.set_terminator('\n')
+        self.server = server
+        self.desk = None     # Opened when first used, under the lock
+        self.incoming = []
+        self.waiting = 0     # Requests handed to the worker thread
+
+    def collect_incoming_data(self, data):
+        """Saves part of a request."""
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        """Answers a complete request: at once, if it changes nothing,
+           no earlier request from this client is still waiting, and
+           the library's lock is free (it is held while answering, so
+           that no change is seen half made), and it is not slow, and
+           otherwise after the worker thread has made it."""
+        line = ''.join(self.incoming)
+        self.incoming = []
+        try:
+            request = json.loads(line)
+            op = request['op']
+        except (ValueError, KeyError, TypeError):
+            self.send_response({'error': "Bad request: %r" % line})
+            return
+        lock = self.server.library.lock
+        if op in reads and not self.waiting and not self.is_slow(op) and \
+           lock.acquire(False):
+            try:
+                response = self.respond(request)
+            finally:
+                lock.release()
+            self.send_response(response)
+        else:
+            self.waiting += 1
+            self.server.changes.put((self, request))
+
+    def is_slow(self, op):
+        """Tests if the given read would hold up the event loop, as a
+           similar search does when it must first make a new WordIndex
+           (which it does without the lock, in the worker thread)."""
+        library = self.server.library
+        return op == 'search_similar' and \
+               not library.word_index.is_current(library.search_index)
+
+    def respond(self, request):
+        """Carries out a request and returns the response."""
+        op = request.get('op')
+        response = {'id': request.get('id')}
+        if op not in reads and op not in writes:
+            response['error'] = "Unknown request: %s" % op
+            return response
+        if op == 'checkpoint':
+            if self.server.snapshot_path is None:
+                response['error'] = "This server does not save snapshots"
+                return response
+            request = dict(request, args=[self.server.snapshot_path])
+        if op in desk_requests:
+            if self.desk is None:
+                self.desk = self.server.library.open_desk()
+            target = self.desk
+        else:
+            target = self.server.library
+        try:
+            result = getattr(target, op)(*request.get('args', []))
+            if op == 'batch':
+                result = list(result)
+            elif isinstance(result, Response):
+                result = str(result)
+        except Exception, e:
+            response['error'] = "%s: %s" % (e.__class__.__name__, e)
+        else:
+            response['result'] = result
+        return response
+
+    def send_response(self, response):
+        """Sends a response, as one line of JSON."""
+        self.push(json.dumps(response) + '\n')
+
+    def handle_close(self):
+        """Forgets a client that has gone away."""
+        self.close()
+
+#--------------------------------------------------------------
+
+class LoadClient(asynchat.async_chat):
+    """One connection of a load generator: sends requests to a
+       library server one after another, as soon as each answer
+       arrives, and records how long each took."""
+
+    def __init__(self, host, port, requests, latencies, map):
+        """Connects to the server and prepares to send the given
+           list of requests, adding the latency of each to the given
+           list."""
+        asynchat.async_chat.__init__(self, map=map)
+        self.set_terminator('\n')
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.connect((host, port))
+        self.requests = collections.deque(requests)
+        self.latencies = latencies
+        self.incoming = []
+        self.errors = 0
+        self.sent_at = None
+
+    def handle_connect(self):
+        """Sends the first request."""
+        self.send_next()
+
+    def send_next(self):
+        """Sends the next request, or closes the connection if there
+           are none left."""
+        if self.requests:
+            self.sent_at = time.time()
+            self.push(json.dumps(self.requests.popleft()) + '\n')
+        else:
+            self.close_when_done()
+
+    def collect_incoming_data(self, data):
+        """Saves part of an answer."""
+        self.incoming.append(data)
+
+    def found_terminator(self):
+        """Records the latency of a request, counts its answer as an
+           error if it is one, and sends the next request."""
+        self.latencies.append(time.time() - self.sent_at)
+        line = ''.join(self.incoming)
+        self.incoming = []
+        try:
+            if 'error' in json.loads(line):
+                self.errors += 1
+        except ValueError:
+            self.errors += 1
+        self.send_next()
+
+    def handle_close(self):
+        """Gives up on a connection closed by the server, counting the
+           requests not answered as errors."""
+        self.errors += len(self.requests)
+        self.requests.clear()
+        self.close()
+
+    def handle_error(self):
+        """Gives up on a connection that failed."""
+        self.handle_close()
+
+def generate_load(host, port, connections, requests):
+    """Opens the given number of connections to a library server and
+       sends the given list of requests over each, answer by answer.
+       Returns a dictionary reporting the number of requests answered,
+       the time taken, the requests per second, and the median (p50)
+       and 99th percentile (p99) latencies in milliseconds."""
+    map = {}
+    latencies = []
+    clients = [LoadClient(host, port, requests, latencies, map)
+               for i in range(connections)]
+    start = time.time()
+    asyncore.loop(timeout=0.5, use_poll=True, map=map)
+    seconds = max(time.time() - start, 1e-6)
+    latencies.sort()
+    def percentile(fraction):
+        if not latencies:
+            return None
+        return 1000 * latencies[int(round(fraction * (len(latencies) - 1)))]
+    return {'requests': len(latencies),
+            'errors': sum(client.errors for client in clients),
+            'seconds': seconds,
+            'requests_per_second': len(latencies) / seconds,
+            'p50_ms': percentile(0.50),
+            'p99_ms': percentile(0.99)}
+
+#--------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve a library over TCP, "
+                                     "or generate load for such a server.")
+    parser.add_argument('mode', choices=('serve', 'load'))
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--snapshot', default='library.snapshot')
+    parser.add_argument('--journal', default='library.journal')
+    parser.add_argument('--connections', type=int, default=100)
+    parser.add_argument('--requests', type=int, default=100,
+                        help="requests per connection")
+    parser.add_argument('--query', default='tolkien')
+    options = parser.parse_args()
+    if options.mode == 'serve':
+        library = Library()
+        if not os.path.exists(options.snapshot):
+            print library.read_in_collection()
+        print library.restore(options.snapshot, options.journal)
+        server = LibraryServer(library, options.host, options.port,
+                               options.snapshot)
+        print "Serving on port %d." % server.get_port()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            server.shutdown()
+            print library.quit()
+    else:
+        requests = [{'id': i, 'op': 'search', 'args': [options.query]}
+                    for i in range(options.requests)]
+        print json.dumps(generate_load(options.host, options.port,
+                                       options.connections, requests),
+                         indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,122 @@
+# Unit tests for the network server of a simple library program
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from library import *
+from library_server import *
+
+class LibraryServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = Library()
+        self.library.set_collection(("Contact", "Carl Sagan"),
+                                    ("Cosmos", "Carl Sagan"))
+        self.server = LibraryServer(self.library)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.port = self.server.get_port()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def connect(self):
+        connection = socket.create_connection(('localhost', self.port))
+        return connection, connection.makefile()
+
+    def ask(self, connection, file, op, *args):
+        connection.sendall(json.dumps({'id': op, 'op': op, 'args': args}) + '\n')
+        return json.loads(file.readline())
+
+    def test_requests(self):
+        connection, file = self.connect()
+        self.assertEqual({'id': 'open', 'result': "Today is day 1."},
+                         self.ask(connection, file, 'open'))
+        self.assertEqual("Library card issued to Ellie.\nNow serving Ellie.\n" +\
+                         "Ellie has no books checked out.",
+                         self.ask(connection, file, 'issue_card', "Ellie")['result'])
+        self.assertEqual("1. Contact, by Carl Sagan\n2. Cosmos, by Carl Sagan",
+                         self.ask(connection, file, 'search', "sagan")['result'])
+        self.assertEqual("Ellie has checked out 1 books.",
+                         self.ask(connection, file, 'check_out', 1)['result'])
+        self.assertEqual("Unknown request: quit",
+                         self.ask(connection, file, 'quit')['error'])
+        self.assertTrue('error' in self.ask(connection, file, 'check_out', "x"))
+
+        # Another client has its own desk
+        other, other_file = self.connect()
+        self.assertEqual("No patron is currently being served.",
+                         self.ask(other, other_file, 'check_in', 1)['result'])
+        self.assertEqual("1. Cosmos, by Carl Sagan",
+                         self.ask(other, other_file, 'search', "sagan")['result'])
+        connection.close()
+        other.close()
+
+    def test_checkpoint_only_of_the_servers_snapshot(self):
+        connection, file = self.connect()
+        directory = tempfile.mkdtemp()
+        try:
+            target = os.path.join(directory, 'target')
+            self.assertTrue('error' in self.ask(connection, file,
+                                                'checkpoint', target))
+            self.server.snapshot_path = os.path.join(directory, 'snapshot')
+            self.assertEqual("Saved 2 books and 0 patrons.",
+                             self.ask(connection, file,
+                                      'checkpoint', target)['result'])
+            self.assertEqual(['snapshot'], os.listdir(directory))
+        finally:
+            shutil.rmtree(directory)
+        connection.close()
+
+    def test_reads_do_not_wait_for_the_lock(self):
+        self.library.open()
+        connection, file = self.connect()
+        self.library.lock.acquire()
+        try:
+            # The search has to bring the index up to date
+            self.library.collection.append(Book("Pale Blue Dot", "Carl Sagan"))
+            connection.sendall(json.dumps({'id': 1, 'op': 'search',
+                                           'args': ["blue dot"]}) + '\n')
+            connection.sendall('not json\n')
+            connection.settimeout(5)
+            self.assertTrue('error' in json.loads(file.readline()))
+        finally:
+            self.library.lock.release()
+        self.assertEqual({'id': 1, 'result': "1. Pale Blue Dot, by Carl Sagan"},
+                         json.loads(file.readline()))
+        connection.close()
+
+    def test_similar_search_builds_words_off_the_loop(self):
+        self.library.open()
+        connection, file = self.connect()
+        self.ask(connection, file, 'get_date')  # Once the client is accepted
+        self.assertFalse(self.library.word_index.is_current(self.library.search_index))
+        channel = [dispatcher for dispatcher in self.server.map.values()
+                   if isinstance(dispatcher, ClientChannel)][0]
+        self.assertTrue(channel.is_slow('search_similar'))
+        self.assertFalse(channel.is_slow('search'))
+        self.assertEqual("1. Contact, by Carl Sagan",
+                         self.ask(connection, file, 'search_similar', "contcat")['result'])
+        self.assertFalse(channel.is_slow('search_similar'))
+        connection.close()
+
+    def test_generate_load(self):
+        self.library.open()
+        requests = [{'id': i, 'op': 'search', 'args': ["sagan"]} for i in range(20)]
+        report = generate_load('localhost', self.port, 10, requests)
+        self.assertEqual(200, report['requests'])
+        self.assertEqual(0, report['errors'])
+        self.assertTrue(report['p50_ms'] <= report['p99_ms'])
+        requests.append({'id': 20, 'op': 'quit'})
+        self.assertEqual(10, generate_load('localhost', self.port, 10,
+                                           requests)['errors'])
+
+
+
+unittest.main()
@@ -0,0 +1,413 @@
+# A simple library program, split across several processes
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import heapq
+import multiprocessing
+import sys
+import zlib
+
+from library import Book, Library, OverdueNotice, Patron, check_numbers, \
+                    status_done
+
+def write_shards(source, snapshot_paths):
+    """Splits the collection of the given Library into as many shards
+       as there are snapshot paths, and writes each shard as a snapshot
+       file. The works (all the copies of a title and author) are dealt
+       out in turn, so that work number n of the source is work number
+       n // shards of shard n % shards. Only the collection is split;
+       patrons and loans are not copied."""
+    count = len(snapshot_paths)
+    source.update_index()
+    index = source.search_index
+    books = [[] for path in snapshot_paths]
+    for number in xrange(index.count_works()):
+        work = index.get_work(number)
+        title, author = work.get_title(), work.get_author()
+        books[number % count].extend(Book(title, author) for copy in work.copies)
+    for shard_books, path in zip(books, snapshot_paths):
+        shard = Library()
+        shard.add_to_collection(shard_books)
+        shard.checkpoint(path)
+
+#--------------------------------------------------------------
+
+class Shard(object):
+    """The part of a sharded library kept by one worker process: a
+       Library of some of the works, and the cards of some of the
+       patrons, with a list of the books each of them has checked out
+       (from any shard). Its methods are called by ShardedLibrary."""
+
+    def __init__(self, number, count, snapshot_path):
+        """Creates shard number number of count shards, whose works
+           are mapped into memory from the given snapshot file."""
+        self.number = number
+        self.count = count
+        self.library = Library()
+        self.library.load_snapshot(snapshot_path)
+        self.library.limit = sys.maxint  # Checked by the patron's shard
+        self.holdings = {}  # Name -> [(shard, book id, text)] of its books
+
+    def open(self):
+        """Opens this shard's library for the day."""
+        return self.library.open()
+
+    def close(self):
+        """Closes this shard's library for the day."""
+        return self.library.close()
+
+    # ----- Patrons whose cards are kept by this shard -----
+
+    def issue_card(self, name_of_patron):
+        """Issues a card to the named patron, and returns True, or
+           returns False if the patron already has one."""
+        if name_of_patron in self.holdings:
+            return False
+        self.holdings[name_of_patron] = []
+        return True
+
+    def get_holdings(self, name_of_patron):
+        """Returns the list of (shard, book id, text) triples of the
+           books the named patron has checked out, or None if the
+           patron does not have a card."""
+        return self.holdings.get(name_of_patron)
+
+    def take(self, name_of_patron, book, limit):
+        """Adds the given (shard, book id, text) triple to the named
+           patron's books and returns True, unless the patron already
+           has limit books, in which case returns False."""
+        books = self.holdings[name_of_patron]
+        if len(books) >= limit:
+            return False
+        books.append(book)
+        return True
+
+    def give_back(self, name_of_patron, book):
+        """Removes the given triple from the named patron's books."""
+        books = self.holdings[name_of_patron]
+        if book in books:
+            books.remove(book)
+
+    # ----- Works kept by this shard -----
+
+    def search(self, string, count):
+        """Returns a list of (rank, number, shard, book id, text) for an
+           available copy of each of the (at most) count best works of
+           this shard that contain the given lowercase string, where
+           number is the work's number in the whole library."""
+        library = self.library
+        library.update_index()
+        heap = list(library.find_ranked(string))
+        found = []
+        while heap and len(found) < count:
+            rank, number = heapq.heappop(heap)
+            book = library.search_index.get_work(number).get_available_copy()
+            if book:
+                found.append((rank, number * self.count + self.number,
+                              self.number, book.get_id(), str(book)))
+        return found
+
+    def lend(self, name_of_patron, book_id):
+        """Checks out the book with the given id to the named patron or,
+           if it has been checked out, another copy of the same work.
+           Returns the id of the book checked out, or None if there
+           was no copy available."""
+        book = self.library.get_book(book_id)
+        if book.get_due_date() is not None and book.work:
+            book = book.work.get_available_copy()
+        if book is None or \
+           self.change(name_of_patron, book.get_id(), 'check_out') != status_done:
+            return None
+        return book.get_id()
+
+    def return_book(self, name_of_patron, book_id):
+        """Checks in the book with the given id, from the named patron,
+           and returns the batch status."""
+        return self.change(name_of_patron, book_id, 'check_in')
+
+    def renew(self, name_of_patron, book_id):
+        """Renews the book with the given id, for the named patron, and
+           returns the batch status."""
+        return self.change(name_of_patron, book_id, 'renew')
+
+    def change(self, name_of_patron, book_id, action):
+        """Does one batch operation, as a patron of this shard's
+           library (whose card was checked by the patron's own shard)."""
+        library = self.library
+        if name_of_patron not in library.patrons:
+            library.patrons[name_of_patron] = Patron(name_of_patron)
+        return library.batch([(name_of_patron, book_id, action)])[0]
+
+    def overdue_patrons(self):
+        """Returns a list of (name, earliest due date) pairs for the
+           patrons with a book from this shard that is overdue."""
+        library = self.library
+        return [(patron.get_name(),
+                 min(book.get_due_date() for book in patron.get_loans()))
+                for patron in library.loans.overdue_patrons(library.get_date())]
+
+    def books_of(self, names_of_patrons):
+        """Returns a dictionary giving, for each of the named patrons
+           with books from this shard, the lines of an overdue notice
+           listing those books."""
+        notices = {}
+        for name in names_of_patrons:
+            patron = self.library.patrons.get(name)
+            if patron and patron.count_books():
+                notice = OverdueNotice(patron.get_loans(),
+                                       self.library.get_date())
+                notices[name] = list(notice.lines())[1:]
+        return notices
+
+def run_shard(number, count, snapshot_path, connection):
+    """Runs a shard in a worker process: creates the Shard, then calls
+       the method named in each (name, arguments) pair received on the
+       given connection, and sends back a (result, error) pair, until
+       a name of None is received."""
+    shard = Shard(number, count, snapshot_path)
+    while True:
+        name, args = connection.recv()
+        if name is None:
+            break
+        try:
+            connection.send((getattr(shard, name)(*args), None))
+        except Exception, e:
+            connection.send((None, "%s: %s" % (e.__class__.__name__, e)))
+    connection.close()
+
+#--------------------------------------------------------------
+
+class ShardedLibrary(object):
+    """Provides the operations of a Library whose works and patrons
+       are split among shards, each in its own process, so that
+       searches and overdue scans use many cores. The shards read
+       their works from snapshot files (see write_shards), mapped into
+       memory, rather than having them sent when they start. Searches
+       and overdue scans ask every shard at once and merge the
+       answers; each patron's card, and list of books, is kept by the
+       shard chosen by the patron's name, which also enforces the
+       limit on books checked out."""
+
+    limit = Library.limit  # Most books a patron may have checked out
+    page_size = 10         # Most books listed by a search
+
+    def __init__(self, snapshot_paths):
+        """Starts one worker process for each of the given snapshot
+           files, written by write_shards."""
+        self.connections = []
+        self.processes = []
+        for number, path in enumerate(snapshot_paths):
+            connection, worker_connection = multiprocessing.Pipe()
+            process = multiprocessing.Process(
+                target=run_shard,
+                args=(number, len(snapshot_paths), path, worker_connection))
+            process.daemon = True
+            process.start()
+            self.connections.append(connection)
+            self.processes.append(process)
+        self.is_open = False
+        self.patron_being_served = None # Name of current patron
+        self.current_patrons_books = [] # (shard, book id, text) triples
+        self.found_books = []           # (shard, book id, text) triples
+
+    def call(self, shard, name, *args):
+        """Calls the named method of the given shard with the given
+           arguments, and returns the result."""
+        self.connections[shard].send((name, args))
+        return self.receive(shard)
+
+    def call_all(self, name, *args):
+        """Calls the named method of every shard with the given
+           arguments, all at once, and returns the list of results."""
+        for connection in self.connections:
+            connection.send((name, args))
+        return [self.receive(shard) for shard in range(len(self.connections))]
+
+    def receive(self, shard):
+        """Returns the result of the last call of the given shard, or
+           raises a RuntimeError if the call raised an exception."""
+        result, error = self.connections[shard].recv()
+        if error:
+            raise RuntimeError("Shard %d: %s" % (shard, error))
+        return result
+
+    def patron_shard(self, name_of_patron):
+        """Returns the number of the shard keeping the named patron's
+           card."""
+        if isinstance(name_of_patron, unicode):
+            name_of_patron = name_of_patron.encode('utf-8')
+        return (zlib.crc32(name_of_patron) & 0xffffffff) % len(self.connections)
+
+    def open(self):
+        """Opens every shard for business at the start of a new day."""
+        if self.is_open:
+            return "The library is already open!"
+        self.is_open = True
+        return self.call_all('open')[0]
+
+    def close(self):
+        """Closes every shard for the day."""
+        if not self.is_open:
+            return "The library is not open."
+        self.is_open = False
+        self.patron_being_served = None
+        self.current_patrons_books = []
+        self.call_all('close')
+        return "Good night."
+
+    def quit(self):
+        """Stops the worker processes."""
+        for connection in self.connections:
+            connection.send((None, None))
+        for process in self.processes:
+            process.join()
+        self.is_open = False
+        return "The library is now closed for renovations."
+
+    def issue_card(self, name_of_patron):
+        """Allows the named person the use of the library. For
+           convenience, immediately begins serving the new patron."""
+        if not self.is_open:
+            return "The library is not open."
+        if self.call(self.patron_shard(name_of_patron), 'issue_card',
+                     name_of_patron):
+            message = "Library card issued to %s.\n" % name_of_patron
+        else:
+            message = "%s already has a library card.\n" % name_of_patron
+        return message + self.serve(name_of_patron)
+
+    def serve(self, name_of_patron):
+        """Begins serving the given patron, listing the books the
+           patron has checked out."""
+        if not self.is_open:
+            return "The library is not open."
+        books = self.call(self.patron_shard(name_of_patron), 'get_holdings',
+                          name_of_patron)
+        if books is None:
+            return "%s does not have a library card." % name_of_patron
+        self.patron_being_served = name_of_patron
+        self.current_patrons_books = books
+        message = "Now serving %s.\n" % name_of_patron
+        if books:
+            message += "%s has the following books checked out:\n" % name_of_patron
+            for i, (shard, book_id, text) in enumerate(books, 1):
+                message += "%d. %s\n" % (i, text)
+        else:
+            message += "%s has no books checked out." % name_of_patron
+        return message
+
+    def search(self, string):
+        """Looks for books with the given string in either the title
+           or the author's name, in every shard at once, and lists the
+           best of them, ranked as by Library.search."""
+        if not self.is_open:
+            return "The library is not open."
+        if len(string) < 4:
+            return "Search string must contain at least four characters."
+        found = []
+        for shard_found in self.call_all('search', string.lower(), self.page_size):
+            found.extend(shard_found)
+        found = heapq.nsmallest(self.page_size, found)
+        self.found_books = [(shard, book_id, text)
+                            for rank, number, shard, book_id, text in found]
+        if not found:
+            return "No books found."
+        return '\n'.join("%d. %s" % (i, text) for i, (shard, book_id, text)
+                         in enumerate(self.found_books, 1))
+
+    def check_out(self, *book_numbers):
+        """Checks books found by the last search out to the patron
+           being served, who may have not more than three books checked
+           out at a time."""
+        check_numbers(book_numbers)
+        if not self.is_open:
+            return "The library is not open."
+        name = self.patron_being_served
+        if name is None:
+            return "No patron is currently being served."
+        patron_shard = self.patron_shard(name)
+        message = ''
+        count = 0
+        for book_number in book_numbers:
+            if not 1 <= book_number <= len(self.found_books):
+                message += "The library does not have book %d.\n" % book_number
+            elif not self.call(patron_shard, 'take', name,
+                               self.found_books[book_number - 1], self.limit):
+                message += "%s already has the maximum # of books checked out.\n" % name
+                break
+            else:
+                book = self.found_books[book_number - 1]
+                book_id = self.call(book[0], 'lend', name, book[1])
+                if book_id is None:
+                    self.call(patron_shard, 'give_back', name, book)
+                    message += "Book %d is no longer available.\n" % book_number
+                else:
+                    if book_id != book[1]:
+                        # Another copy of the same work was checked out
+                        self.call(patron_shard, 'give_back', name, book)
+                        self.call(patron_shard, 'take', name,
+                                  (book[0], book_id, book[2]), self.limit)
+                    count += 1
+        self.current_patrons_books = self.call(patron_shard, 'get_holdings', name)
+        if count:
+            message += "%s has checked out %d books." % (name, count)
+        return message
+
+    def check_in(self, *book_numbers):
+        """Accepts books being returned by the patron being served."""
+        return self.change_books(book_numbers, 'return_book')
+
+    def renew(self, *book_numbers):
+        """Renews books for the patron being served."""
+        return self.change_books(book_numbers, 'renew')
+
+    def change_books(self, book_numbers, name_of_method):
+        """Checks in or renews (as the shards' name_of_method does) the
+           given books of the patron being served."""
+        check_numbers(book_numbers)
+        if not self.is_open:
+            return "The library is not open."
+        name = self.patron_being_served
+        if name is None:
+            return "No patron is currently being served."
+        patron_shard = self.patron_shard(name)
+        message = ''
+        count = 0
+        for book_number in book_numbers:
+            if not 1 <= book_number <= len(self.current_patrons_books):
+                message += "The patron does not have book %d.\n" % book_number
+                continue
+            book = self.current_patrons_books[book_number - 1]
+            if self.call(book[0], name_of_method, name, book[1]) == status_done:
+                if name_of_method == 'return_book':
+                    self.call(patron_shard, 'give_back', name, book)
+                count += 1
+            else:
+                message += "The patron does not have book %d.\n" % book_number
+        if name_of_method == 'return_book':
+            self.current_patrons_books = self.call(patron_shard, 'get_holdings', name)
+            if count:
+                message += "%s has returned %d books." % (name, count)
+        elif count:
+            message += "%d books have been renewed for %s." % (count, name)
+        return message
+
+    def list_overdue_books(self):
+        """Lists overdue notices to all delinquent patrons, ordered by
+           their earliest due date, gathered from all shards at once."""
+        if not self.is_open:
+            return "The library is not open."
+        earliest = {}
+        for shard_patrons in self.call_all('overdue_patrons'):
+            for name, due_date in shard_patrons:
+                earliest[name] = min(due_date, earliest.get(name, due_date))
+        if not earliest:
+            return "No books are overdue."
+        names = sorted(earliest, key=lambda name: (earliest[name], name))
+        lines = dict((name, []) for name in names)
+        for notices in self.call_all('books_of', names):
+            for name, notice_lines in notices.items():
+                lines[name].extend(notice_lines)
+        return ''.join(name + '\n' +
+                       'Patron has the following books checked out:\n' +
+                       ''.join(lines[name])
+                       for name in names)
@@ -0,0 +1,84 @@
+# Unit tests for the sharded version of a simple library program
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import os
+import shutil
+import tempfile
+import unittest
+from library import *
+from library_shards import *
+
+books = [("Cosmos", "Carl Sagan"), ("Contact", "Carl Sagan"),
+         ("Cosmos Revisited", "Carl Sagan"), ("Cosmos", "Carl Sagan"),
+         ("Cosmic Dust", "Ann Cosmos"), ("The Jungle", "Upton Sinclair"),
+         ("Stars of Cosmos", "Carl Sagan"), ("Pale Blue Dot", "Carl Sagan")]
+
+class ShardedLibraryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        whole = Library()
+        whole.set_collection(*books)
+        paths = [os.path.join(self.directory, 'shard%d.snapshot' % i)
+                 for i in range(3)]
+        write_shards(whole, paths)
+        self.library = ShardedLibrary(paths)
+
+    def tearDown(self):
+        self.library.quit()
+        shutil.rmtree(self.directory)
+
+    def test_search(self):
+        whole = Library()
+        whole.set_collection(*books)
+        whole.open()
+        library = self.library
+        self.assertEqual("The library is not open.", library.search("cosmos"))
+        self.assertEqual("Today is day 1.", library.open())
+        for string in ("cosmos", "sagan", "jungle", "xkcd"):
+            self.assertEqual(whole.search(string), library.search(string))
+
+    def test_circulation(self):
+        library = self.library
+        library.open()
+        self.assertEqual("Library card issued to Ellie.\nNow serving Ellie.\n" +\
+                         "Ellie has no books checked out.",
+                         library.issue_card("Ellie"))
+        library.search("cosmos")
+        self.assertEqual("Ellie has checked out 2 books.", library.check_out(1, 1))
+        library.search("sagan")
+        self.assertEqual("Ellie already has the maximum # of books checked out.\n" +\
+                         "Ellie has checked out 1 books.",
+                         library.check_out(4, 1))
+        self.assertEqual("Now serving Ellie.\n" +\
+                         "Ellie has the following books checked out:\n" +\
+                         "1. Cosmos, by Carl Sagan\n" +\
+                         "2. Cosmos, by Carl Sagan\n" +\
+                         "3. Pale Blue Dot, by Carl Sagan\n",
+                         library.serve("Ellie"))
+        library.issue_card("Jo")
+        self.assertEqual("1. Cosmos Revisited, by Carl Sagan",
+                         library.search("revisited"))
+        self.assertEqual("The library does not have book 0.\n",
+                         library.check_out(0))
+        self.assertRaises(TypeError, library.check_out, "x")
+        self.assertEqual("Jo has checked out 1 books.", library.check_out(1))
+        for i in range(7):
+            library.close()
+            library.open()
+        library.serve("Ellie")
+        self.assertEqual("The patron does not have book 0.\n", library.renew(0))
+        self.assertEqual("1 books have been renewed for Ellie.", library.renew(3))
+        self.assertEqual("Ellie has returned 1 books.", library.check_in(1))
+        library.close()
+        library.open()
+        notices = library.list_overdue_books().split("Patron has the following books checked out:\n")
+        self.assertEqual(["Ellie\n", "Jo\n"],
+                         [notice.split("\n")[-2] + "\n" for notice in notices[:-1]])
+        self.assertEqual(["Cosmos, by Carl Sagan which is overdue (was due on 8)",
+                          "Pale Blue Dot, by Carl Sagan which is due on 15"],
+                         sorted(notices[1].split("\n")[:2]))
+        self.assertEqual("Cosmos Revisited, by Carl Sagan which is overdue (was due on 8)\n",
+                         notices[2])
+
+unittest.main()
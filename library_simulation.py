@@ -0,0 +1,225 @@
+# Simulation of a simple library program over many days
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import argparse
+import array
+import heapq
+import json
+import random
+import time
+
+from library import Library, status_done
+from library_bench import Workload
+
+#--------------------------------------------------------------
+
+class Script(object):
+    """A workload given in advance, as (day, name_of_patron, book_id,
+       action) entries in order of day, where the action is one of
+       those of Simulation.run_day."""
+
+    def __init__(self, entries):
+        """Creates a workload of the given entries."""
+        self.entries = iter(entries)
+        self.next_entry = next(self.entries, None)
+
+    def next_day(self):
+        """Returns the next day on which something happens, or None if
+           nothing more does."""
+        if self.next_entry is None:
+            return None
+        return self.next_entry[0]
+
+    def operations(self, day, library):
+        """Returns the (name_of_patron, book_id, action) operations of
+           the given day."""
+        operations = []
+        while self.next_entry is not None and self.next_entry[0] == day:
+            operations.append(self.next_entry[1:])
+            self.next_entry = next(self.entries, None)
+        return operations
+
+class RandomPatrons(object):
+    """A workload of the given number of patrons, each visiting the
+       library every mean_gap days on average, at random. On each visit
+       a patron picks up any books set aside for the patron, returns
+       each book with probability return_rate or else renews it with
+       probability renew_rate, and asks for the given number of books
+       chosen at random, placing a hold on each that is checked out.
+       The visits are kept in a heap by day, so that days on which
+       nobody visits cost nothing."""
+
+    def __init__(self, patrons, mean_gap=14.0, borrow=1, return_rate=0.6,
+                 renew_rate=0.5, seed=0):
+        """Creates the workload, with each patron's first visit within
+           mean_gap days of the start."""
+        self.random = random.Random(seed)
+        self.mean_gap = mean_gap
+        self.borrow = borrow
+        self.return_rate = return_rate
+        self.renew_rate = renew_rate
+        self.visits = [(1 + int(self.random.random() * mean_gap), number)
+                       for number in xrange(patrons)]
+        heapq.heapify(self.visits)
+
+    def next_day(self):
+        """Returns the next day on which a patron visits, or None if
+           there are no patrons."""
+        if not self.visits:
+            return None
+        return self.visits[0][0]
+
+    def operations(self, day, library):
+        """Returns the operations of the patrons visiting on the given
+           day, and chooses the day of each one's next visit."""
+        choose = self.random
+        operations = []
+        library.update_index()
+        number_of_books = len(library.books)
+        while self.visits[0][0] == day:
+            number = self.visits[0][1]
+            name = "Patron %d" % number
+            patron = library.patrons.get(name)
+            if patron:
+                if library.holds.get_books_set_aside(patron):
+                    operations.append((name, None, 'pick_up'))
+                for book in patron.get_loans():
+                    if choose.random() < self.return_rate:
+                        operations.append((name, book.get_id(), 'check_in'))
+                    elif choose.random() < self.renew_rate:
+                        operations.append((name, book.get_id(), 'renew'))
+            for i in xrange(self.borrow):
+                book = library.books.get(choose.randrange(number_of_books))
+                if library.is_available(book):
+                    operations.append((name, book.get_id(), 'check_out'))
+                else:
+                    operations.append((name, book.get_id(), 'hold'))
+            gap = 1 + int(choose.expovariate(1.0 / self.mean_gap))
+            heapq.heapreplace(self.visits, (day + gap, number))
+        return operations
+
+#--------------------------------------------------------------
+
+class Simulation(object):
+    """Runs a library through a workload, for capacity planning. The
+       calendar is advanced straight to the next day on which anything
+       happens, and the statistics for the days skipped, on which
+       nothing changed but the number of books overdue, are added up
+       all at once. Patrons are issued cards, at a desk of the
+       library's own, on their first visit."""
+
+    def __init__(self, library):
+        """Creates a simulation of the given library, with its
+           collection already in place."""
+        self.library = library
+        self.desk = library.open_desk()
+        self.statuses = array.array('B')
+        self.counted_to = library.get_date() + 1  # First day not counted
+        self.days = 0            # Days counted
+        self.active_days = 0     # Days on which the library opened
+        self.holds_placed = 0
+        self.loan_days = 0       # Sum over days of books checked out
+        self.overdue_days = 0    # Sum over days of books overdue
+        self.waiting_days = 0    # Sum over days of holds waiting
+        self.most_waiting = 0
+        self.seconds = 0.0
+
+    def run(self, workload, days):
+        """Runs the library for the given number of days, doing the
+           operations of the given workload (a Script or RandomPatrons)
+           on each day it has any. Returns the report."""
+        start = time.time()
+        last_day = self.counted_to + days
+        while True:
+            day = workload.next_day()
+            if day is None or day >= last_day:
+                break
+            self.run_day(day, workload.operations(day, self.library))
+        self.count_days(last_day)
+        self.seconds += time.time() - start
+        return self.report()
+
+    def run_day(self, day, operations):
+        """Opens the library on the given day, which must be later than
+           the last day it was open, does the given (name_of_patron,
+           book_id, action) operations, which are those of
+           Library.batch, and closes it."""
+        library = self.library
+        if library.is_open:
+            library.close()
+        if day <= library.get_date():
+            raise ValueError("Day %d has already passed" % day)
+        self.count_days(day)
+        library.open(day - library.get_date())
+        self.active_days += 1
+        for name_of_patron, book_id, action in operations:
+            if name_of_patron not in library.patrons:
+                self.desk.issue_card(name_of_patron)
+        first = len(self.statuses)
+        with library.lock:
+            library.batch_under_lock(operations, self.statuses)
+        for (name_of_patron, book_id, action), status in \
+                zip(operations, self.statuses[first:]):
+            if action == 'hold' and status == status_done:
+                self.holds_placed += 1
+        library.close()
+
+    def count_days(self, day):
+        """Adds the statistics of the days from the first not yet
+           counted up to (but not including) the given day, on which
+           nothing was checked out, in, or renewed."""
+        days = day - self.counted_to
+        if days <= 0:
+            return
+        library = self.library
+        waiting = len(library.holds.waiting)
+        self.days += days
+        self.loan_days += len(library.loans) * days
+        self.overdue_days += library.loans.count_overdue_days(self.counted_to, day)
+        self.waiting_days += waiting * days
+        self.most_waiting = max(self.most_waiting, waiting)
+        self.counted_to = day
+
+    def report(self):
+        """Returns a dictionary reporting the days simulated, the
+           operations done, the mean share of the copies that were
+           checked out (utilisation), the share of the books checked
+           out that were overdue, the mean and greatest number of holds
+           waiting, and the time taken."""
+        library = self.library
+        done = self.statuses.count(status_done)
+        return {'days': self.days,
+                'active_days': self.active_days,
+                'operations': len(self.statuses),
+                'operations_done': done,
+                'holds_placed': self.holds_placed,
+                'utilisation': self.loan_days / float(max(len(library.collection) * self.days, 1)),
+                'overdue_rate': self.overdue_days / float(max(self.loan_days, 1)),
+                'mean_waiting': self.waiting_days / float(max(self.days, 1)),
+                'most_waiting': self.most_waiting,
+                'seconds': self.seconds,
+                'days_per_second': self.days / max(self.seconds, 1e-9)}
+
+#--------------------------------------------------------------
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate the library "
+                                     "over many days, for capacity planning.")
+    parser.add_argument('--copies', type=int, default=10000)
+    parser.add_argument('--patrons', type=int, default=10000)
+    parser.add_argument('--days', type=int, default=365)
+    parser.add_argument('--mean-gap', type=float, default=14.0,
+                        help="mean days between a patron's visits")
+    parser.add_argument('--seed', type=int, default=0)
+    options = parser.parse_args()
+    library = Library()
+    for batch in Workload(options.copies, 0, options.seed).books():
+        library.add_to_collection(batch)
+    library.update_index()
+    simulation = Simulation(library)
+    report = simulation.run(RandomPatrons(options.patrons, options.mean_gap,
+                                          seed=options.seed), options.days)
+    print json.dumps(report, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Unit tests for the simulation of a simple library program
+# Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
+#--------------------------------------------------------------
+import unittest
+from library import *
+from library_simulation import *
+
+class SimulationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = Library()
+        self.library.set_collection(("Contact", "Carl Sagan"),
+                                    ("Cosmos", "Carl Sagan"))
+        self.library.update_index()
+
+    def test_open_skips_days(self):
+        library = self.library
+        self.assertEqual("Today is day 1.", library.open())
+        library.close()
+        self.assertEqual("Today is day 31.", library.open(30))
+
+    def test_open_rejects_bad_days(self):
+        library = self.library
+        self.assertRaises(ValueError, library.open, 0)
+        self.assertRaises(ValueError, library.open, -5)
+        self.assertRaises(TypeError, library.open, 1.5)
+        self.assertFalse(library.is_open)
+        self.assertEqual(0, library.get_date())
+
+    def test_script(self):
+        simulation = Simulation(self.library)
+        report = simulation.run(Script([(1, "Ellie", 0, 'check_out'),
+                                        (1, "Jo", 0, 'hold'),
+                                        (20, "Ellie", 0, 'check_in')]), 30)
+        self.assertEqual(20, self.library.get_date())
+        self.assertEqual(30, report['days'])
+        self.assertEqual(2, report['active_days'])
+        self.assertEqual(3, report['operations_done'])
+        self.assertEqual(1, report['holds_placed'])
+        self.assertAlmostEqual(19 / 60.0, report['utilisation'])
+        self.assertAlmostEqual(11 / 19.0, report['overdue_rate'])
+        self.assertAlmostEqual(19 / 30.0, report['mean_waiting'])
+        self.assertEqual(1, report['most_waiting'])
+        self.assertTrue(self.library.holds.is_set_aside(self.library.get_book(0)))
+
+    def test_pick_up(self):
+        library = self.library
+        Simulation(library).run(Script([(1, "Ellie", 0, 'check_out'),
+                                        (1, "Jo", 0, 'hold'),
+                                        (5, "Ellie", 0, 'check_in'),
+                                        (6, "Jo", None, 'pick_up')]), 10)
+        self.assertEqual(["Contact"], [book.get_title() for book
+                                       in library.patrons["Jo"].get_loans()])
+        self.assertEqual(13, library.get_book(0).get_due_date())
+
+    def test_random_patrons(self):
+        report = Simulation(self.library).run(RandomPatrons(20, mean_gap=7), 365)
+        self.assertEqual(365, report['days'])
+        self.assertTrue(report['holds_placed'] > 0)
+        self.assertTrue(0 < report['utilisation'] <= 1)
+        quiet = Library()
+        quiet.set_collection(("Contact", "Carl Sagan"))
+        report = Simulation(quiet).run(RandomPatrons(2, mean_gap=60), 365)
+        self.assertTrue(report['active_days'] < 50)
+
+unittest.main()
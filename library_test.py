@@ -1,6 +1,11 @@
 # Unit tests for a simple library program
 # Authors: Dave Matuszek and Kelley Loder and Nicki Hoffman
 #--------------------------------------------------------------
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
 import unittest
 from library import *
 
@@ -15,6 +20,15 @@ class CalendarTest(unittest.TestCase):
         cal.advance()
         self.assertEqual(1, cal.get_date())
 
+    def test_each_library_has_its_own_calendar(self):
+        first = Library()
+        first.open()
+        first.close()
+        first.open()
+        second = Library()
+        second.open()
+        self.assertEqual([2, 1], [first.get_date(), second.get_date()])
+
 class BookTest(unittest.TestCase):
 
     def setUp(self):
@@ -73,17 +87,998 @@ class PatronTest(unittest.TestCase):
         patron2.take(book2)
         self.assertEquals(set([book2]), patron2.get_books())
 
+    def test_loans_are_numbered_in_order(self):
+        patron1.take(book3)
+        patron1.take(book1)
+        patron1.take(book2)
+        self.assertEquals((book3, book1, book2), patron1.get_loans())
+        self.assertTrue(patron1.get_loan(2) is book1)
+        self.assertEquals(None, patron1.get_loan(4))
+        patron1.give_back(book1)
+        self.assertTrue(patron1.get_loan(2) is book2)
+        self.assertFalse(hasattr(patron1.get_books(), 'add'))
+
+    def test_check_in_numbers_shift_after_each_call(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"),
+                               ("Pale Blue Dot", "Carl Sagan"))
+        library.issue_card("Ellie")
+        library.search("sagan")
+        library.check_out(3, 1, 2)
+        self.assertEqual("Now serving Ellie.\n" +\
+                         "Ellie has the following books checked out:\n" +\
+                         "1. Pale Blue Dot, by Carl Sagan\n" +\
+                         "2. Contact, by Carl Sagan\n" +\
+                         "3. Cosmos, by Carl Sagan\n", library.serve("Ellie"))
+        self.assertEqual("Ellie has returned 2 books.", library.check_in(1, 3))
+        self.assertEqual(["Contact"], [book.get_title()
+                                       for book in library.current_patrons_books])
+        # Contact, which was book 2, is now book 1
+        self.assertEqual("The patron does not have book 2.\n",
+                         library.check_in(2))
+        self.assertEqual("Ellie has returned 1 books.", library.check_in(1))
+
+class SearchIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        global index
+        index = SearchIndex()
+        index.add(Book("Contact", "Carl Sagan"))
+        index.add(Book("The Jungle", "Upton Sinclair"))
+        index.add(Book("Contact", "Carl Sagan"))
+
+    def test_find(self):
+        self.assertEqual(["Contact, by Carl Sagan"],
+                         [str(work) for work in index.find("contact")])
+        self.assertEqual(["The Jungle, by Upton Sinclair"],
+                         [str(work) for work in index.find("e jung")])
+        self.assertEqual([], list(index.find("xkcd")))
+        # Every trigram occurs, but not as one substring
+        self.assertEqual([], list(index.find("jungleupton")))
+
+    def test_index_follows_collection(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"))
+        self.assertEqual("No books found.", library.search("jungle"))
+        library.collection.append(Book("The Jungle", "Upton Sinclair"))
+        self.assertEqual("1. The Jungle, by Upton Sinclair",
+                         library.search("jungle"))
+        library.collection = [Book("Cosmos", "Carl Sagan")]
+        self.assertEqual("1. Cosmos, by Carl Sagan", library.search("sagan"))
+
+    def test_copies_share_strings(self):
+        # Strings made at run time, so that they are not interned
+        index = SearchIndex()
+        for i in range(2):
+            index.add(Book(''.join(["Con", "tact"]), ''.join(["Carl ", "Sagan"])))
+        first, second = list(index.find("contact"))[0].copies
+        self.assertFalse(hasattr(first, '__dict__'))
+        self.assertTrue(first.get_title() is second.get_title())
+        self.assertTrue(first.get_author() is second.get_author())
+
+    def test_available_copies(self):
+        work = list(index.find("contact"))[0]
+        self.assertEqual(2, work.count_available())
+        first, second = work.copies
+        first.check_out(8)
+        first.check_out(15)
+        self.assertEqual(1, work.count_available())
+        self.assertTrue(work.get_available_copy() is second)
+        second.check_out(8)
+        self.assertEqual(None, work.get_available_copy())
+        first.check_in()
+        self.assertEqual(1, work.count_available())
+
+    def test_search_lists_each_title_once(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        self.assertEqual("1. Contact, by Carl Sagan\n" +\
+                         "2. Cosmos, by Carl Sagan", library.search("sagan"))
+        library.issue_card("Ellie")
+        library.check_out(1)
+        self.assertEqual("1. Contact, by Carl Sagan", library.search("contact"))
+        library.check_out(1)
+        self.assertEqual("No books found.", library.search("contact"))
+
+    def test_ranked_pages(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Stars of Cosmos", "Carl Sagan"),
+                               ("Cosmic Dust", "Ann Cosmos"),
+                               ("Cosmos Revisited", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"),
+                               *[("Cosmos Vol. %d" % i, "Carl Sagan")
+                                 for i in range(10)])
+        page = str(library.search("cosmos")).split("\n")
+        self.assertEqual(11, len(page))
+        self.assertEqual(["1. Cosmos, by Carl Sagan",
+                          "2. Cosmos Revisited, by Carl Sagan",
+                          "3. Cosmos Vol. 0, by Carl Sagan"], page[:3])
+        self.assertEqual("Use next_page() to see more.", page[-1])
+        self.assertEqual("1. Cosmos Vol. 8, by Carl Sagan\n" +\
+                         "2. Cosmos Vol. 9, by Carl Sagan\n" +\
+                         "3. Cosmic Dust, by Ann Cosmos\n" +\
+                         "4. Stars of Cosmos, by Carl Sagan",
+                         library.next_page())
+        library.issue_card("Ellie")
+        library.check_out(4)
+        self.assertEqual("Stars of Cosmos",
+                         list(library.patrons["Ellie"].get_books())[0].get_title())
+        self.assertEqual("No more books found.", library.next_page())
+
+    def test_search_similar(self):
+        library = Library()
+        library.open()
+        library.set_collection(("The Hobbit", "JRR Tolkien"),
+                               ("The Count of Monte Cristo", "Alexandre Dumas"),
+                               ("The Lord of the Rings", "JRR Tolkien"),
+                               ("Cosmos", "Carl Sagan"))
+        self.assertEqual("No books found.", library.search("tolkein"))
+        self.assertEqual("1. The Hobbit, by JRR Tolkien\n" +\
+                         "2. The Lord of the Rings, by JRR Tolkien",
+                         library.search_similar("tolkein"))
+        self.assertEqual("1. The Count of Monte Cristo, by Alexandre Dumas",
+                         library.search_similar("monte christo"))
+        self.assertEqual("1. The Lord of the Rings, by JRR Tolkien",
+                         library.search_similar("lord of the rigns"))
+        self.assertEqual("No books found.", library.search_similar("xkcd"))
+        library.collection.append(Book("Contact", "Carl Sagan"))
+        self.assertEqual("1. Contact, by Carl Sagan",
+                         library.search_similar("contcat"))
+        self.assertEqual(["contcat", "contact"],
+                         [text for similarity, text in
+                          library.word_index.corrections("contcat")])
+
+    def test_similar_search_builds_words_outside_the_lock(self):
+        library = Library()
+        library.open()
+        library.set_collection(("The Hobbit", "JRR Tolkien"))
+        library.update_index()
+        old = library.word_index
+        holding, done = threading.Event(), threading.Event()
+        def hold_lock():
+            with library.lock:
+                holding.set()
+                done.wait()
+        holder = threading.Thread(target=hold_lock)
+        holder.start()
+        holding.wait()
+        results = []
+        searcher = threading.Thread(
+            target=lambda: results.append(str(library.search_similar("tolkein"))))
+        searcher.start()
+        searcher.join(5)
+        finished_while_locked = list(results)
+        done.set()
+        holder.join()
+        searcher.join()
+        self.assertEqual(["1. The Hobbit, by JRR Tolkien"], finished_while_locked)
+        self.assertFalse(library.word_index is old)
+        self.assertEqual(0, old.works_indexed)
+
+    def test_search_cache(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        cache = library.search_cache
+        library.search("sagan")
+        library.search("contact")
+        self.assertEqual((0, 2), (cache.hits, cache.misses))
+        library.issue_card("Ellie")
+        self.assertEqual("1. Contact, by Carl Sagan\n2. Cosmos, by Carl Sagan",
+                         library.search("Sagan"))
+        library.check_out(2)
+        self.assertEqual("1. Contact, by Carl Sagan", library.search("sagan"))
+        self.assertEqual((2, 2), (cache.hits, cache.misses))
+        # A new work forgets only the searches it matches
+        library.collection.append(Book("Pale Blue Dot", "Carl Sagan"))
+        self.assertEqual("1. Contact, by Carl Sagan\n" +\
+                         "2. Pale Blue Dot, by Carl Sagan", library.search("sagan"))
+        library.search("contact")
+        self.assertEqual((3, 3), (cache.hits, cache.misses))
+        # Another copy of a work changes nothing
+        library.collection.append(Book("Cosmos", "Carl Sagan"))
+        library.search("sagan")
+        self.assertEqual((4, 3), (cache.hits, cache.misses))
+        # The least recently used search is forgotten
+        cache.size = 1
+        library.search("cosmos")
+        library.search("contact")
+        self.assertEqual(["contact"], list(cache.entries))
+
+class LoanTableTest(unittest.TestCase):
+
+    def book(self, book_id, title="Contact"):
+        book = Book(title, "Carl Sagan")
+        book.id = book_id
+        return book
+
+    def test_overdue_patrons(self):
+        loans = LoanTable()
+        amy, dave = Patron("Amy Gutmann"), Patron("Dr. Dave")
+        contact, jungle = self.book(0), self.book(1, "The Jungle")
+        contact.check_out(9)
+        dave.take(contact)
+        loans.add(dave, contact, 9)
+        jungle.check_out(5)
+        amy.take(jungle)
+        loans.add(amy, jungle, 5)
+        self.assertEqual([], list(loans.overdue_patrons(5)))
+        self.assertEqual([amy], list(loans.overdue_patrons(6)))
+        self.assertEqual([amy, dave], list(loans.overdue_patrons(10)))
+        loans.remove(jungle)
+        jungle.check_in()
+        self.assertEqual([dave], list(loans.overdue_patrons(10)))
+        contact.check_out(17)
+        loans.renew(contact, 17)
+        self.assertEqual([], list(loans.overdue_patrons(10)))
+        self.assertEqual([17], loans.dates)
+        # A patron with many overdue books is listed once
+        cosmos = self.book(2, "Cosmos")
+        cosmos.check_out(3)
+        dave.take(cosmos)
+        loans.add(dave, cosmos, 3)
+        self.assertEqual([dave], list(loans.overdue_patrons(20)))
+
+    def test_count_overdue_days(self):
+        loans = LoanTable()
+        patron = Patron("Dr. Dave")
+        for book_id, due_date in ((0, 5), (1, 5), (2, 9)):
+            loans.add(patron, self.book(book_id), due_date)
+        self.assertEqual(sum(loans.count_overdue(day) for day in range(3, 12)),
+                         loans.count_overdue_days(3, 12))
+        self.assertEqual(4, loans.count_overdue_days(7, 9))
+        self.assertEqual(0, loans.count_overdue_days(1, 6))
+
+    def check_loans(self, loans):
+        ellie, jo = Patron("Ellie"), Patron("Jo")
+        books = dict((book_id, self.book(book_id)) for book_id in range(10, 14))
+        loans.add(ellie, books[10], 8)
+        loans.add(jo, books[11], 8)
+        loans.add(ellie, books[12], 9)
+        loans.add(jo, books[13], 12)
+        self.assertEqual(4, len(loans))
+        loans.remove(books[10])
+        loans.remove(self.book(99))
+        loans.renew(books[13], 5)
+        self.assertEqual([(11, 2), (12, 1), (13, 5)],
+                         sorted((book_id, days) for name, book_id, days
+                                in loans.overdue(10)))
+        self.assertEqual([0, 0, 3], sorted(loans.days_overdue(8)))
+        self.assertEqual({"Ellie": (1, 25), "Jo": (2, 175)},
+                         loans.patron_totals(10, 25))
+        self.assertEqual({}, loans.patron_totals(5, 25))
+        self.assertEqual([5, 8, 9], loans.dates)
+        self.assertEqual(3, loans.count_overdue(10))
+
+    def test_without_numpy(self):
+        self.check_loans(LoanTable(use_numpy=False))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_with_numpy(self):
+        loans = LoanTable(use_numpy=True)
+        self.check_loans(loans)
+        for book_id in range(2000):
+            loans.add(Patron("Patron %d" % (book_id % 7)), self.book(100 + book_id),
+                      book_id % 20)
+        self.assertEqual(2003, len(loans))
+
+    def test_fines(self):
+        for use_numpy in [False] + [True] * (numpy is not None):
+            library = Library()
+            library.loans = LoanTable(use_numpy)
+            library.open()
+            library.set_collection(("Contact", "Carl Sagan"),
+                                   ("Cosmos", "Carl Sagan"))
+            library.issue_card("Ellie")
+            library.search("sagan")
+            library.check_out(1, 2)
+            library.check_in(1)
+            for i in range(10):
+                library.close()
+                library.open()
+            self.assertEqual({"Ellie": (1, 75)}, library.fines())
+
+class HoldsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.library = Library()
+        self.library.open()
+        self.library.set_collection(("Contact", "Carl Sagan"),
+                                    ("Cosmos", "Carl Sagan"))
+        for name in ("Ellie", "Jo", "Amy"):
+            self.library.issue_card(name)
+
+    def test_holds(self):
+        library = self.library
+        library.serve("Ellie")
+        library.search("contact")
+        library.check_out(1)
+        library.serve("Jo")
+        self.assertEqual("No books found.", library.search("contact"))
+        self.assertEqual("1. Contact, by Carl Sagan (all copies checked out)",
+                         library.search_all("contact"))
+        self.assertEqual("Book 1 is no longer available.\n", library.check_out(1))
+        self.assertEqual("Jo has placed 1 holds.", library.place_hold(1))
+        self.assertEqual("Jo is already waiting for book 1.\n", library.place_hold(1))
+        library.serve("Amy")
+        library.search_all("sagan")
+        self.assertEqual("Book 2 is available, and need not be held.\n" +\
+                         "Amy has placed 1 holds.", library.place_hold(2, 1))
+        self.assertEqual("No books are waiting for Amy.", library.pick_up())
+
+        # The returned copy is set aside for Jo, first in line
+        library.serve("Ellie")
+        library.check_in(1)
+        self.assertEqual("No books found.", library.search("contact"))
+        self.assertEqual("Now serving Jo.\nJo has no books checked out.\n" +\
+                         "1 books are waiting to be picked up.", library.serve("Jo"))
+        self.assertEqual("Jo has checked out 1 books.", library.pick_up())
+        library.check_in(1)
+
+        # Amy does not pick it up in time, so it goes back on the shelf
+        for i in range(4):
+            library.close()
+            library.open()
+        library.serve("Amy")
+        self.assertEqual("No books are waiting for Amy.", library.pick_up())
+        self.assertEqual("1. Contact, by Carl Sagan", library.search("contact"))
+
+    def test_many_returns_fill_holds(self):
+        library = Library()
+        library.open()
+        library.set_collection(*[("Contact", "Carl Sagan")] * 1000)
+        names = ["Patron %d" % i for i in range(2000)]
+        for name in names:
+            library.patrons[name] = Patron(name)
+        book_ids = range(1000)
+        library.batch([(name, book_id, 'check_out')
+                       for name, book_id in zip(names, book_ids)])
+        work = library.get_book(0).work
+        for name in names[1000:]:
+            library.holds.place(work, library.patrons[name])
+        statuses = library.batch([(name, book_id, 'check_in')
+                                  for name, book_id in zip(names, book_ids)])
+        self.assertEqual([status_done] * 1000, list(statuses))
+        self.assertEqual(0, work.count_available())
+        self.assertEqual(0, library.holds.count_waiting(work))
+        self.assertEqual([library.get_book(999)],
+                         library.holds.get_books_set_aside(library.patrons[names[-1]]))
+
+class ReadInCollectionTest(unittest.TestCase):
+
+    def test_read_in_collection(self):
+        library = Library()
+        library.open()
+        file = StringIO.StringIO('("Contact", "Carl Sagan")\n\n' +\
+                                 "('The Jungle', 'Upton Sinclair')\n" +\
+                                 '["Cosmos", "Carl Sagan"]\n' +\
+                                 'Emma\tJane Austen\n' +\
+                                 '("Don\\\'t Panic", "Neil Gaiman")\n')
+        report = library.read_in_collection(file, batch_size=2)
+        self.assertTrue(report.startswith("Read 5 books in "))
+        self.assertEqual(["Contact", "The Jungle", "Cosmos", "Emma",
+                          "Don't Panic"],
+                         [book.get_title() for book in library.collection])
+        self.assertEqual("1. Emma, by Jane Austen", library.search("austen"))
+
+    def test_read_in_collection_rejects_code(self):
+        library = Library()
+        file = StringIO.StringIO('("Contact", "Carl Sagan")\n' +\
+                                 '__import__("os").getcwd()\n')
+        self.assertRaises(ValueError, library.read_in_collection, file)
+
+class JournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.snapshot = os.path.join(self.directory, 'snapshot')
+        self.journal = os.path.join(self.directory, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def restarted(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        return library
+
+    def test_restore_from_journal_and_snapshot(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        library.checkpoint(self.snapshot)
+        library.open()
+        library.issue_card("Ellie")
+        library.search("sagan")
+        library.check_out(1, 2)
+        library.close()
+        library.open()
+        library.serve("Ellie")
+        library.renew(1)
+        library.journal.commit()
+
+        library = self.restarted()
+        self.assertEqual(2, library.get_date())
+        self.assertTrue(str(library.serve("Ellie")).startswith("Now serving Ellie."))
+        self.assertEqual([8, 9], sorted(book.get_due_date() for book
+                                        in library.patrons["Ellie"].get_books()))
+        library.check_in(1)
+        library.checkpoint(self.snapshot)
+        self.assertEqual([], list(Journal.entries(self.journal)))
+        library.check_in(1)
+        library.quit()
+
+        library = self.restarted()
+        self.assertEqual(set(), library.patrons["Ellie"].get_books())
+        library.open()
+        self.assertEqual("1. Contact, by Carl Sagan\n" +\
+                         "2. Cosmos, by Carl Sagan", library.search("sagan"))
+
+    def test_restore_holds(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.set_collection(("Contact", "Carl Sagan"))
+        library.open()
+        for name in ("Ellie", "Jo", "Amy"):
+            library.issue_card(name)
+        library.serve("Ellie")
+        library.search("contact")
+        library.check_out(1)
+        for name in ("Jo", "Amy"):
+            library.serve(name)
+            library.search_all("contact")
+            library.place_hold(1)
+        library.serve("Ellie")
+        library.check_in(1)
+        library.checkpoint(self.snapshot)
+        library.quit()
+
+        library = self.restarted()
+        library.open()
+        library.serve("Amy")
+        self.assertEqual("No books are waiting for Amy.", library.pick_up())
+        library.serve("Jo")
+        self.assertEqual("Jo has checked out 1 books.", library.pick_up())
+        library.journal.commit()
+
+        library = self.restarted()
+        self.assertEqual(1, library.patrons["Jo"].count_books())
+        library.serve("Jo")
+        library.check_in(1)
+        library.serve("Amy")
+        self.assertEqual("Amy has checked out 1 books.", library.pick_up())
+
+    def test_restore_hold_filled_by_a_return(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.set_collection(("Contact", "Carl Sagan"))
+        library.checkpoint(self.snapshot)
+        library.open()
+        library.issue_card("Ellie")
+        library.search("contact")
+        library.check_out(1)
+        library.issue_card("Jo")
+        library.search_all("contact")
+        library.place_hold(1)
+        library.serve("Ellie")
+        library.check_in(1)
+        library.quit()
+
+        library = self.restarted()
+        library.open()
+        self.assertEqual("Now serving Jo.\nJo has no books checked out.\n" +\
+                         "1 books are waiting to be picked up.",
+                         library.serve("Jo"))
+        self.assertEqual("Jo has checked out 1 books.", library.pick_up())
+
+    def test_snapshot_holds_the_holds(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        library.open()
+        for name in ("Ellie", "Jo", "Amy"):
+            library.issue_card(name)
+        library.serve("Ellie")
+        library.search("sagan")
+        library.check_out(1, 2)
+        library.serve("Jo")
+        library.search_all("sagan")
+        library.place_hold(1, 2)
+        library.serve("Amy")
+        library.place_hold(1)
+        library.serve("Ellie")
+        library.check_in(1)
+        library.checkpoint(self.snapshot)
+        library.quit()
+        os.remove(self.journal)
+
+        library = self.restarted()
+        library.open()
+        self.assertEqual(["Contact"], [book.get_title() for book in
+                         library.holds.get_books_set_aside(library.patrons["Jo"])])
+        cosmos = library.patrons["Ellie"].get_loan(1).work
+        self.assertTrue(library.holds.is_waiting(cosmos, library.patrons["Jo"]))
+        self.assertEqual(1, library.holds.count_waiting(cosmos))
+        contact = library.holds.get_books_set_aside(library.patrons["Jo"])[0].work
+        self.assertEqual(1, library.holds.count_waiting(contact))
+        library.serve("Jo")
+        self.assertEqual("Jo has checked out 1 books.", library.pick_up())
+
+    def test_restore_names_from_snapshot_and_journal(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.set_collection(("Contact", "Carl Sagan"))
+        library.open()
+        library.issue_card(u"Zo\xeb")
+        library.checkpoint(self.snapshot)
+        library.search("contact")
+        library.check_out(1)
+        library.quit()
+
+        library = self.restarted()
+        self.assertEqual([u"Zo\xeb"], library.patrons.keys())
+        self.assertEqual(1, library.patrons[u"Zo\xeb"].count_books())
+
+    def test_snapshot_creates_books_only_when_used(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("The Jungle", "Upton Sinclair"),
+                               ("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        library.issue_card("Ellie")
+        library.search("cosmos")
+        library.check_out(1)
+        library.checkpoint(self.snapshot)
+
+        library = Library()
+        library.load_snapshot(self.snapshot)
+        self.assertEqual(4, len(library.collection))
+        self.assertEqual([3], library.collection.books.keys())
+        self.assertEqual("1. Contact, by Carl Sagan", library.search("sagan"))
+        self.assertEqual([0, 2, 3], sorted(library.collection.books))
+        self.assertEqual("The Jungle", library.collection[1].get_title())
+        self.assertEqual(8, library.collection[3].get_due_date())
+
+        library.set_collection(("Cosmos", "Carl Sagan"), ("Emma", "Jane Austen"))
+        library.checkpoint(self.snapshot)
+        library = Library()
+        library.load_snapshot(self.snapshot)
+        self.assertEqual(6, len(library.collection))
+        self.assertEqual("1. Contact, by Carl Sagan\n" +\
+                         "2. Cosmos, by Carl Sagan", library.search("sagan"))
+        self.assertEqual("1. Emma, by Jane Austen", library.search("austen"))
+        self.assertEqual(2, len(library.search_index.find_work(
+            "Cosmos", "Carl Sagan").copies))
+
+    def test_restore_after_torn_write(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.open()
+        library.issue_card("Ellie")
+        library.quit()
+        file = open(self.journal, 'a')
+        file.write('["card", "J')   # The process died while writing
+        file.close()
+
+        library = self.restarted()
+        library.open()
+        library.issue_card("Kim")
+        library.quit()
+        library = self.restarted()
+        self.assertEqual(["Ellie", "Kim"], sorted(library.patrons))
+
+    def test_checkpoint_interrupted_before_journal_emptied(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.set_collection(("Contact", "Carl Sagan"))
+        library.open()
+        library.issue_card("Ellie")
+        library.search("contact")
+        library.check_out(1)
+        library.journal.commit()
+        shutil.copy(self.journal, self.journal + '.old')
+        library.checkpoint(self.snapshot)
+        library.quit()
+        # As if the process died before the journal was emptied
+        os.rename(self.journal + '.old', self.journal)
+
+        library = Library()
+        self.assertTrue(library.restore(self.snapshot, self.journal)
+                        .endswith("replayed 0 changes."))
+        self.assertEqual(1, library.patrons["Ellie"].count_books())
+        self.assertEqual([], list(Journal.entries(self.journal)))
+        library.serve("Ellie")
+        library.check_in(1)
+        library.quit()
+        library = self.restarted()
+        self.assertEqual(0, library.patrons["Ellie"].count_books())
+
+    def test_group_commit(self):
+        journal = Journal(self.journal, group_size=2)
+        journal.record('card', "Ellie")
+        self.assertEqual([], list(Journal.entries(self.journal)))
+        journal.record('open', 1)
+        self.assertEqual([['card', "Ellie"], ['open', 1]],
+                         list(Journal.entries(self.journal)))
+        first = journal.record('close')
+        journal.record('open', 2)
+        # Waiting for one entry saves all those waiting
+        journal.sync(first)
+        self.assertEqual(4, len(list(Journal.entries(self.journal))))
+        journal.close()
+
+    def test_changes_are_saved_before_they_are_confirmed(self):
+        library = Library()
+        library.restore(self.snapshot, self.journal)
+        library.set_collection(("Contact", "Carl Sagan"))
+        library.checkpoint(self.snapshot)
+        library.open()
+        library.issue_card("Ellie")
+        library.search("contact")
+        self.assertEqual("Ellie has checked out 1 books.", library.check_out(1))
+        # As if the process died now, without closing the journal
+        library = self.restarted()
+        self.assertEqual(1, library.patrons["Ellie"].count_books())
+
+class EventLogTest(unittest.TestCase):
+
+    def test_subscribe_and_replay(self):
+        library = Library()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        cursor = library.subscribe()
+        library.open()
+        library.issue_card("Ellie")
+        library.search("cosmos")
+        library.check_out(1)
+        library.renew(1)
+        library.check_in(1)
+        library.close()
+        book_id = library.collection[1].get_id()
+        events = [('open', 1), ('card', "Ellie"), ('out', "Ellie", book_id, 8),
+                  ('renew', "Ellie", book_id, 8), ('in', "Ellie", book_id),
+                  ('close',)]
+        self.assertEqual(events[:2], cursor.read(2))
+        self.assertEqual(events[2:], cursor.read())
+        self.assertEqual([], cursor.read())
+        self.assertEqual(events[4:], library.subscribe(4).read())
+
+    def test_dropped_events_are_counted(self):
+        log = EventLog(3)
+        cursor = log.subscribe()
+        for day in range(5):
+            log.append(('open', day))
+        self.assertEqual([('open', 2), ('open', 3), ('open', 4)], cursor.read())
+        self.assertEqual(2, cursor.missed)
+        self.assertEqual((2, [('open', 2)]), log.read(0, 1))
+
+    def test_full_log_blocks_until_read(self):
+        log = EventLog(2, overflow='block')
+        cursor = log.subscribe()
+        log.append(('open', 1))
+        log.append(('close',))
+        writer = threading.Thread(target=log.append, args=(('open', 2),))
+        writer.start()
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())
+        self.assertEqual([('open', 1)], cursor.read(1))
+        writer.join()
+        self.assertEqual([('close',), ('open', 2)], cursor.read(timeout=None))
+        self.assertEqual(0, cursor.missed)
+
+    def test_new_cursors_skip_staged_events(self):
+        log = EventLog(4)
+        end = log.stage(('open', 1))
+        cursor = log.subscribe()
+        self.assertEqual(1, cursor.offset)
+        self.assertEqual([], cursor.read())
+        self.assertEqual((1, []), log.read(1))
+        log.publish(end)
+        log.append(('close',))
+        self.assertEqual([('close',)], cursor.read())
+        self.assertEqual(0, cursor.missed)
+
+    def test_full_log_waits_outside_the_lock(self):
+        library = Library()
+        library.set_collection(("Contact", "Carl Sagan"))
+        library.keep_events(2, 'block')
+        cursor = library.subscribe()
+        library.open()
+        library.close()
+        writer = threading.Thread(target=library.open)
+        writer.start()
+        writer.join(0.1)
+        self.assertTrue(writer.is_alive())
+        # The writer waits for room without holding the lock
+        self.assertTrue(library.lock.acquire(False))
+        self.assertEqual("1. Contact, by Carl Sagan", library.search("contact"))
+        library.lock.release()
+        self.assertEqual([('open', 1), ('close',)], cursor.read())
+        writer.join()
+        self.assertEqual([('open', 2)], cursor.read(timeout=None))
+        cursor.close()
+
+class BookIdTest(unittest.TestCase):
+
+    def test_ids(self):
+        library = Library()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Contact", "Carl Sagan"))
+        first, second = library.collection
+        self.assertEqual([0, 1], [first.get_id(), second.get_id()])
+        self.assertTrue(library.get_book(1) is second)
+        self.assertEqual(None, library.get_book(2))
+        self.assertNotEqual(first, second)
+        self.assertEqual(2, len(set([first, second])))
+        library.collection = [Book("Cosmos", "Carl Sagan"), first]
+        self.assertEqual(2, library.get_book(2).get_id())
+        self.assertTrue(library.get_book(0) is first)
+        self.assertEqual(None, library.get_book(1))
+        self.assertEqual(None, Book("Cosmos", "Carl Sagan").get_id())
+
+    def test_hash_does_not_change_with_id(self):
+        library = Library()
+        book = Book("Contact", "Carl Sagan")
+        books = set([book])
+        library.collection.append(book)
+        self.assertEqual(0, library.get_book(0).get_id())
+        self.assertTrue(book in books)
+
+    def test_ids_survive_snapshot(self):
+        directory = tempfile.mkdtemp()
+        try:
+            snapshot = os.path.join(directory, 'snapshot')
+            library = Library()
+            library.set_collection(("Contact", "Carl Sagan"),
+                                   ("Cosmos", "Carl Sagan"),
+                                   ("Contact", "Carl Sagan"))
+            library.collection = [library.collection[2], library.collection[0]]
+            library.checkpoint(snapshot)
+            library = Library()
+            library.load_snapshot(snapshot)
+            self.assertEqual([2, 0], [book.get_id() for book in library.collection])
+            self.assertEqual(None, library.get_book(1))
+            self.assertTrue(library.get_book(0) is library.collection[1])
+            library.set_collection(("Emma", "Jane Austen"))
+            self.assertEqual("Emma", library.get_book(3).get_title())
+        finally:
+            shutil.rmtree(directory)
+
+class BatchTest(unittest.TestCase):
+
+    def test_batch(self):
+        library = Library()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"),
+                               ("The Jungle", "Upton Sinclair"),
+                               ("Emma", "Jane Austen"))
+        self.assertEqual([status_closed],
+                         list(library.batch([("Ellie", 0, "check_out")])))
+        library.open()
+        library.issue_card("Ellie")
+        library.issue_card("Jo")
+        statuses = library.batch([("Ellie", 0, "check_out"),
+                                  ("Jo", 0, "check_out"),
+                                  ("Ellie", 1, "check_out"),
+                                  ("Ellie", 2, "check_out"),
+                                  ("Ellie", 3, "check_out"),
+                                  ("Nobody", 3, "check_out"),
+                                  ("Jo", 4, "check_out"),
+                                  ("Jo", 1, "renew"),
+                                  ("Ellie", 1, "renew"),
+                                  ("Ellie", 0, "check_in"),
+                                  ("Jo", 3, "shelve")])
+        self.assertEqual([status_done, status_not_available, status_done,
+                          status_done, status_at_limit, status_no_card,
+                          status_no_such_book, status_not_borrowed,
+                          status_done, status_done, status_no_such_action],
+                         list(statuses))
+        self.assertEqual(8, library.collection[1].get_due_date())
+        self.assertEqual(None, library.collection[0].get_due_date())
+        self.assertEqual(2, len(library.patrons["Ellie"].get_books()))
+        statuses = library.batch([("Jo", 3, "hold"),
+                                  ("Jo", 1, "hold"),
+                                  ("Jo", 1, "hold"),
+                                  ("Jo", None, "pick_up"),
+                                  ("Ellie", 1, "check_in"),
+                                  ("Jo", None, "pick_up")])
+        self.assertEqual([status_not_available, status_done,
+                          status_not_available, status_not_available,
+                          status_done, status_done], list(statuses))
+        self.assertTrue(library.patrons["Jo"].has_book(library.collection[1]))
+
+class ResponseTest(unittest.TestCase):
+
+    def test_records_and_text(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        response = library.search("sagan")
+        self.assertEqual(None, response.text)
+        self.assertEqual(["Contact", "Cosmos"],
+                         [book.get_title() for book in response.records])
+        library.issue_card("Ellie")
+        response = library.check_out(2)
+        self.assertEqual(["Cosmos"], [book.get_title() for book in response.records])
+        self.assertEqual("Ellie has checked out 1 books.", response)
+        self.assertEqual("Ellie has checked out 1 books.", response.text)
+        self.assertFalse(isinstance(response, basestring))
+        stream = StringIO.StringIO()
+        library.serve("Ellie").write(stream)
+        self.assertEqual("Now serving Ellie.\n" +\
+                         "Ellie has the following books checked out:\n" +\
+                         "1. Cosmos, by Carl Sagan\n", stream.getvalue())
+
+    def test_text_is_fixed_when_made(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"))
+        library.issue_card("Ellie")
+        library.search("contact")
+        library.check_out(1)
+        for i in range(8):
+            library.close()
+            library.open()
+        response = library.list_overdue_books()
+        library.serve("Ellie")
+        library.check_in(1)
+        self.assertEqual("Ellie\nPatron has the following books checked out:\n" +\
+                         "Contact, by Carl Sagan which is overdue (was due on 8)\n",
+                         response)
+
+    def test_text_is_made_only_when_wanted(self):
+        made = []
+        class Value(object):
+            def __str__(self):
+                made.append(self)
+                return "value"
+        response = Response("%s\n", Value())
+        response.add("%d. %s", 1, Value())
+        self.assertTrue(response)
+        self.assertEqual([], made)
+        self.assertEqual("value\n1. value", response)
+        self.assertEqual(2, len(made))
+
+    def test_bad_numbers_fail_at_once(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        library.issue_card("Ellie")
+        library.search("sagan")
+        self.assertRaises(TypeError, library.check_out, 1, "x")
+        self.assertEqual("The library does not have book 0.\n" +\
+                         "The library does not have book -1.\n",
+                         library.check_out(0, -1))
+        self.assertEqual(0, library.patrons["Ellie"].count_books())
+        library.check_out(1, 2)
+        self.assertRaises(TypeError, library.check_in, 1, 2.0)
+        self.assertRaises(TypeError, library.renew, None)
+        self.assertEqual(2, library.patrons["Ellie"].count_books())
+
+    def test_percent_in_title(self):
+        library = Library()
+        library.open()
+        library.set_collection(("100% Sagan", "Carl Sagan"))
+        self.assertEqual("1. 100% Sagan, by Carl Sagan", library.search("sagan"))
+
+class DeskTest(unittest.TestCase):
+
+    def test_desks_serve_separately(self):
+        library = Library()
+        library.open()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        library.issue_card("Ellie")
+        library.issue_card("Jo")
+        desk1, desk2 = library.open_desk(), library.open_desk()
+        desk1.serve("Ellie")
+        desk2.serve("Jo")
+        desk1.search("contact")
+        desk2.search("sagan")
+        self.assertEqual("Ellie has checked out 1 books.", desk1.check_out(1))
+        self.assertEqual("Book 1 is no longer available.\n" +\
+                         "Jo has checked out 1 books.", desk2.check_out(1, 2))
+        self.assertEqual("Cosmos", list(library.patrons["Jo"].get_books())[0].get_title())
+        library.close()
+        self.assertEqual(None, desk1.patron_being_served)
+
+    def test_concurrent_check_outs(self):
+        library = Library()
+        library.open()
+        library.set_collection(*[("Contact", "Carl Sagan")] * 20)
+        def borrow(name):
+            desk = library.open_desk()
+            desk.issue_card(name)
+            for i in range(3):
+                desk.search("contact")
+                desk.check_out(1)
+        threads = [threading.Thread(target=borrow, args=("Patron %d" % i,))
+                   for i in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        loans = [book for patron in library.patrons.values()
+                 for book in patron.get_books()]
+        self.assertEqual(20, len(loans))
+        self.assertEqual(20, len(set(loans)))
+        self.assertEqual("No books found.", library.search("contact"))
+
+class MetricsTest(unittest.TestCase):
+
+    def test_metrics(self):
+        library = Library()
+        library.set_collection(("Contact", "Carl Sagan"),
+                               ("Cosmos", "Carl Sagan"))
+        self.assertFalse('search' in library.__dict__)
+        metrics = library.instrument()
+        calls = []
+        metrics.add_hook(lambda name, seconds: calls.append(name))
+        library.open()
+        library.issue_card("Ellie")
+        library.search("sagan")
+        library.check_out(1)
+        desk = library.open_desk()
+        desk.search("sagan")
+        self.assertRaises(TypeError, library.check_in, "x", "y")
+        self.assertEqual(['open', 'issue_card', 'search', 'check_out',
+                          'search', 'check_in'], calls)
+        self.assertEqual(2, metrics.calls['search'])
+        self.assertEqual(1, metrics.errors['check_in'])
+        self.assertEqual({'books': 2, 'patrons': 1, 'loans': 1, 'overdue': 0},
+                         metrics.read_gauges())
+        self.assertEqual({'search_cache_hits': 1, 'search_cache_misses': 1},
+                         metrics.read_counters())
+        for i in range(8):
+            library.close()
+            library.open()
+        self.assertEqual(1, metrics.read_gauges()['overdue'])
+        text = metrics.prometheus()
+        self.assertTrue('library_calls_total{method="search"} 2\n' in text)
+        self.assertTrue('library_call_seconds_bucket{method="search",le="+Inf"} 2\n' in text)
+        self.assertTrue('# TYPE library_loans gauge\nlibrary_loans 1\n' in text)
+        self.assertTrue('# TYPE library_search_cache_hits_total counter\n' +\
+                        'library_search_cache_hits_total 1\n' in text)
+
+        library.uninstrument()
+        library.search("sagan")
+        desk.search("sagan")
+        self.assertEqual(2, metrics.calls['search'])
+        self.assertFalse('search' in library.__dict__)
+
+class ParseCommandTest(unittest.TestCase):
+
+    def test_parse_command(self):
+        self.assertEqual(("search", ["tolkien"]), parse_command('search("tolkien")'))
+        self.assertEqual(("check_in", [1, 2]), parse_command(' check_in(1, 2) '))
+        self.assertEqual(("help", []), parse_command("help()"))
+        for command in ['search', '__import__("os").getcwd()',
+                        'search(open("x"))', 'search(x="y")', 'search("']:
+            self.assertRaises(ValueError, parse_command, command)
+
 class LibraryTest(unittest.TestCase):
 
     def setUp(self):
-        lib = Library()
-        lib.open()
+        # Every test starts on day 1, whatever the tests before it did
+        lib.calendar.day = 1
         global book1, book2, book3, book4
         book1 = ("Contact", "Carl Sagan")
         book2 = ("C0ntact", "Carl Sagan")
         book3 = ("C01ntact", "Carl Sagan")
         book4 = ("C02ntact", "Carl Sagan")
-        lib.set_collection(book1, book2, book3, book4)
 
     def test_get_date(self):
         self.assertEqual(1, lib.get_date())
@@ -171,6 +1166,11 @@ class LibraryTest(unittest.TestCase):
         self.assertEqual("Errol\nPatron has the following books checked " +\
                          "out:\nContact, by Carl Sagan which is overdue " +\
                          "(was due on 9)\n", lib.list_overdue_books())
+        sink = StringIO.StringIO()
+        self.assertEqual(1, lib.write_overdue_notices(sink))
+        self.assertEqual(lib.list_overdue_books(), sink.getvalue())
+        self.assertEqual(["Errol"], [patron.get_name() for patron, notice
+                                     in lib.overdue_notices()])
         
     def test_create_numbered_list(self):
         ul = []